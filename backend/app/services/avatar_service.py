@@ -0,0 +1,106 @@
+"""Avatar storage in the media store.
+
+Avatars used to be embedded in user documents as `photo_base64`. They are now
+written once to the blob store and the user document only keeps a
+`photo_url`, the same way uploaded profile pictures are handled. The startup
+migration moves any remaining embedded avatars out of `users`.
+"""
+
+import base64
+import binascii
+import logging
+from typing import Optional
+
+from app.services.blob_store import blob_store
+from app.services.http_client import get_http_client
+from app.services.user_cache import user_cache
+
+logger = logging.getLogger(__name__)
+
+MAX_AVATAR_BYTES = 5 * 1024 * 1024
+
+# Magic numbers of the formats the profile picture route knows how to serve
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png"),
+    (b"\xff\xd8\xff", "jpg"),
+    (b"GIF8", "gif"),
+)
+
+
+def guess_extension(data: bytes) -> str:
+    for signature, ext in _SIGNATURES:
+        if data.startswith(signature):
+            return ext
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return "jpg"
+
+
+class AvatarService:
+    """Writes avatars to disk and migrates embedded ones"""
+
+    async def store(self, db, data: bytes) -> str:
+        """Write avatar bytes to the blob store and return their URL"""
+        if len(data) > MAX_AVATAR_BYTES:
+            raise ValueError("Avatar too large")
+        blob = await blob_store.put_bytes(db, data, f".{guess_extension(data)}")
+        blob_store.schedule_derivatives(blob)
+        return blob_store.url_for(blob.name)
+
+    async def store_base64(self, db, encoded: str) -> str:
+        """Store a base64 avatar as sent by older clients. Raises ValueError if malformed."""
+        if encoded.startswith("data:") and "," in encoded:
+            encoded = encoded.split(",", 1)[1]
+        try:
+            data = base64.b64decode(encoded, validate=False)
+        except (binascii.Error, ValueError) as e:
+            raise ValueError(f"Invalid base64 avatar: {e}")
+        if not data:
+            raise ValueError("Empty avatar")
+        return await self.store(db, data)
+
+    async def import_remote(self, db, user_id: str, picture_url: str) -> Optional[str]:
+        """Download a remote avatar (e.g. the Google picture) into the media store"""
+        try:
+            resp = await get_http_client().get(picture_url)
+            if resp.status_code != 200 or not resp.content:
+                return None
+            return await self.store(db, resp.content)
+        except Exception as e:
+            logger.warning(f"⚠️ Could not import avatar for user {user_id}: {e}")
+            return None
+
+    async def migrate_embedded(self, db, batch_size: int = 100) -> int:
+        """Move photo_base64 blobs out of user documents into the media store"""
+        migrated = 0
+        failed = set()
+        while True:
+            query = {"photo_base64": {"$type": "string"}}
+            if failed:
+                query["_id"] = {"$nin": list(failed)}
+            users = await db.users.find(query, {"photo_base64": 1}).limit(batch_size).to_list(batch_size)
+            if not users:
+                break
+            for user in users:
+                try:
+                    url = await self.store_base64(db, user["photo_base64"])
+                except ValueError as e:
+                    logger.warning(f"⚠️ Skipping embedded avatar of user {user['_id']}: {e}")
+                    failed.add(user["_id"])
+                    continue
+                # Only unset the blob we actually copied
+                await db.users.update_one(
+                    {"_id": user["_id"], "photo_base64": user["photo_base64"]},
+                    {"$set": {"photo_url": url}, "$unset": {"photo_base64": ""}}
+                )
+                user_cache.invalidate(user["_id"])
+                migrated += 1
+        # Explicit nulls carry no data but still bloat every read
+        await db.users.update_many({"photo_base64": {"$type": "null"}}, {"$unset": {"photo_base64": ""}})
+        if migrated:
+            logger.info(f"🖼️ Moved {migrated} embedded avatars to the media store")
+        return migrated
+
+
+# Singleton instance
+avatar_service = AvatarService()
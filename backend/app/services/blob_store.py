@@ -0,0 +1,379 @@
+"""Content-addressed, deduplicated media storage.
+
+Uploaded bytes are stored once under their SHA-256 (`blobs/ab/<sha256><ext>`)
+no matter how many chats, messages or profiles use them. The `media_blobs`
+collection keeps one document per stored object, keyed by its full name
+(`<sha256><ext>`), with a reference count: every upload
+that resolves to an existing blob bumps the count instead of writing the
+bytes again, and release() drops it when a reference goes away (e.g. a
+replaced profile picture). Blobs that stay unreferenced past a grace period
+are removed by collect_garbage(), which start_gc() runs periodically.
+
+Blob bytes live in the configured storage backend (local disk or S3). With
+S3, clients can upload directly through a presigned PUT and then register
+the blob with register_direct_upload().
+
+Only extensions listed in MEDIA_TYPES are stored, and each is served with
+its fixed content type, never one guessed from a client-chosen name.
+
+Files uploaded before the blob store existed are moved into it by
+migrate_legacy(). Their old URLs keep working through `media_aliases`, which
+maps "<category>/<filename>" to the blob that now holds the bytes. A file
+whose alias already exists was counted by an earlier, interrupted run and is
+not counted again.
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import uuid
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+from app.services.image_derivatives import image_derivatives
+from app.services.media_writer import StoredMedia, media_writer
+from app.services.storage_backends import StorageBackend, storage_backend
+
+logger = logging.getLogger(__name__)
+
+LEGACY_CATEGORIES = ("profiles", "voices", "chat")
+BLOB_URL_SEGMENT = "/uploads/blobs/"
+HASH_CHUNK_SIZE = 1024 * 1024
+SHA256_HEX = re.compile(r"^[0-9a-f]{64}$")
+LEGACY_URL = re.compile(r"/uploads/(profiles|voices|chat)/([^/?#]+)")
+
+MEDIA_TYPES = {
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".png": "image/png",
+    ".webp": "image/webp",
+    ".gif": "image/gif",
+    ".m4a": "audio/mp4",
+    ".aac": "audio/aac",
+    ".mp3": "audio/mpeg",
+    ".ogg": "audio/ogg",
+    ".wav": "audio/wav",
+    ".mp4": "video/mp4",
+    ".webm": "video/webm",
+    ".mov": "video/quicktime",
+}
+
+
+@dataclass
+class BlobRef:
+    sha256: str
+    name: str
+    size: int
+    created: bool
+
+
+def _hash_file(path: Path) -> Tuple[str, int]:
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def media_type_for(name: str) -> Optional[str]:
+    """Content type to store and serve a file under; None if its extension is not allowed"""
+    return MEDIA_TYPES.get(Path(name).suffix.lower())
+
+
+def _check_extension(ext: str):
+    if ext.lower() not in MEDIA_TYPES:
+        raise ValueError(f"Unsupported file type: {ext or 'no extension'}")
+
+
+def blob_name_from_url(url: Optional[str]) -> Optional[str]:
+    if not url or BLOB_URL_SEGMENT not in url:
+        return None
+    return url.rsplit("/", 1)[-1] or None
+
+
+class BlobStore:
+    """SHA-256 keyed blob files plus their reference counts"""
+
+    def __init__(self, writer=media_writer, backend: StorageBackend = storage_backend, gc_grace_seconds: int = 3600,
+                 gc_interval_seconds: float = 3600):
+        self.writer = writer
+        self.backend = backend
+        self.gc_grace_seconds = gc_grace_seconds
+        self.gc_interval_seconds = gc_interval_seconds
+        self.dedup_hits = 0
+        self.blobs_written = 0
+        self.blobs_collected = 0
+        self._gc_task: Optional[asyncio.Task] = None
+
+    def start_gc(self, db):
+        """Run collect_garbage() every gc_interval_seconds until stop_gc()"""
+        self._gc_task = asyncio.create_task(self._gc_loop(db))
+
+    def stop_gc(self):
+        if self._gc_task is not None:
+            self._gc_task.cancel()
+
+    async def _gc_loop(self, db):
+        while True:
+            await asyncio.sleep(self.gc_interval_seconds)
+            try:
+                await self.collect_garbage(db)
+            except Exception as e:
+                logger.error(f"❌ Media blob garbage collection failed: {e}")
+
+    @staticmethod
+    def url_for(name: str, prefix: str = "/api") -> str:
+        return f"{prefix}{BLOB_URL_SEGMENT}{name}"
+
+    def path_for(self, name: str) -> Path:
+        return self.writer.path_for("blobs", name)
+
+    @staticmethod
+    def key_for(name: str) -> str:
+        return f"blobs/{name[:2]}/{name}"
+
+    @staticmethod
+    def name_for(sha256: str, ext: str) -> str:
+        return f"{sha256}{ext.lower()}"
+
+    @property
+    def is_local(self) -> bool:
+        return self.backend.name == "local"
+
+    def schedule_derivatives(self, blob: "BlobRef"):
+        """Render resized images for a newly created blob (local storage only)"""
+        if blob.created and self.is_local:
+            image_derivatives.schedule("blobs", blob.name)
+
+    def download_url(self, name: str) -> Optional[str]:
+        """A presigned URL to fetch the blob from the backend directly, if supported"""
+        if not self.backend.supports_presign:
+            return None
+        return self.backend.presign_get(self.key_for(name))
+
+    async def _reference(self, db, sha256: str, name: str, size: int) -> bool:
+        """Count one reference; True if the blob had no document yet"""
+        # Count the reference before the file is placed so a concurrent
+        # garbage collection never sees this blob as unreferenced
+        result = await db.media_blobs.update_one(
+            {"_id": name},
+            {
+                "$inc": {"refcount": 1},
+                "$unset": {"released_at": ""},
+                "$setOnInsert": {"sha256": sha256, "size": size, "created_at": datetime.now(timezone.utc)},
+            },
+            upsert=True,
+        )
+        return result.upserted_id is not None
+
+    async def is_referenced(self, db, name: str) -> bool:
+        return bool(await db.media_blobs.find_one({"_id": name, "refcount": {"$gt": 0}}, {"_id": 1}))
+
+    async def _place(self, source: Path, name: str) -> bool:
+        """Move `source` into the backend, or drop it if the blob already exists"""
+        return await self.backend.put_file(self.key_for(name), source, media_type_for(name))
+
+    async def _commit(self, db, staged: StoredMedia, ext: str) -> BlobRef:
+        name = self.name_for(staged.sha256, ext)
+        await self._reference(db, staged.sha256, name, staged.size)
+        created = await self._place(staged.path, name)
+        if created:
+            self.blobs_written += 1
+        else:
+            self.dedup_hits += 1
+        return BlobRef(sha256=staged.sha256, name=name, size=staged.size, created=created)
+
+    async def put_stream(self, db, chunks: AsyncIterator[bytes], ext: str,
+                         max_bytes: Optional[int] = None) -> BlobRef:
+        """Stream an upload into the store. Raises MediaTooLarge past max_bytes."""
+        _check_extension(ext)
+        staged = await self.writer.write_stream("blobs", f"incoming-{uuid.uuid4().hex}{ext}", chunks, max_bytes=max_bytes)
+        return await self._commit(db, staged, ext)
+
+    async def put_bytes(self, db, data: bytes, ext: str) -> BlobRef:
+        async def single():
+            yield data
+        return await self.put_stream(db, single(), ext)
+
+    def presign_upload(self, sha256: str, ext: str, content_type: str) -> Optional[Dict[str, Any]]:
+        """Presigned PUT for a direct client upload of the given content, if supported"""
+        if not SHA256_HEX.match(sha256):
+            raise ValueError("sha256 must be 64 lowercase hex characters")
+        _check_extension(ext)
+        name = self.name_for(sha256, ext)
+        upload = self.backend.presign_put(self.key_for(name), content_type, sha256)
+        if upload is not None:
+            upload["name"] = name
+        return upload
+
+    async def register_direct_upload(self, db, sha256: str, ext: str, max_bytes: Optional[int] = None) -> BlobRef:
+        """Reference a blob the client uploaded straight to the backend.
+
+        Raises ValueError if the object is missing or over max_bytes (in which
+        case it is deleted unless other references exist).
+        """
+        if not SHA256_HEX.match(sha256):
+            raise ValueError("sha256 must be 64 lowercase hex characters")
+        _check_extension(ext)
+        name = self.name_for(sha256, ext)
+        size = await self.backend.size(self.key_for(name))
+        if size is None:
+            raise ValueError("Upload not found in storage")
+        if max_bytes is not None and size > max_bytes:
+            if not await self.is_referenced(db, name):
+                await self.backend.delete(self.key_for(name))
+            raise ValueError(f"Upload exceeds {max_bytes} bytes")
+        # Presigned uploads of bytes already stored are skipped by the client,
+        # so an existing document means a dedup hit, as on the local write path
+        created = await self._reference(db, sha256, name, size)
+        if created:
+            self.blobs_written += 1
+        else:
+            self.dedup_hits += 1
+        return BlobRef(sha256=sha256, name=name, size=size, created=created)
+
+    async def _release_alias(self, db, category: str, filename: str) -> Optional[str]:
+        """The blob behind a migrated legacy URL, the first time that URL is released"""
+        alias = await db.media_aliases.find_one_and_update(
+            {"_id": f"{category}/{filename}", "released_at": {"$exists": False}},
+            {"$set": {"released_at": datetime.now(timezone.utc)}},
+        )
+        return alias["blob"] if alias else None
+
+    async def release(self, db, url_or_name: Optional[str]):
+        """Drop one reference to a blob; a no-op for URLs that are not in the store"""
+        name = blob_name_from_url(url_or_name)
+        if name is None and url_or_name:
+            legacy = LEGACY_URL.search(url_or_name)
+            # migrate_legacy() counted one reference per legacy file
+            name = await self._release_alias(db, *legacy.groups()) if legacy else url_or_name
+        if not name or "." not in name:
+            return
+        await db.media_blobs.update_one(
+            {"_id": name, "refcount": {"$gt": 0}},
+            {"$inc": {"refcount": -1}, "$set": {"released_at": datetime.now(timezone.utc)}},
+        )
+
+    async def blob_for_url(self, db, url: Optional[str]) -> Optional[str]:
+        """The blob behind a blob URL or a migrated legacy URL, if any"""
+        name = blob_name_from_url(url)
+        if name is not None or not url:
+            return name
+        legacy = LEGACY_URL.search(url)
+        if not legacy:
+            return None
+        alias = await db.media_aliases.find_one({"_id": "/".join(legacy.groups())}, {"blob": 1})
+        return alias["blob"] if alias else None
+
+    async def resolve(self, db, category: str, filename: str) -> Tuple[str, str]:
+        """Where a legacy category/filename lives now: itself, or its blob"""
+        if self.writer.path_for(category, filename).exists():
+            return category, filename
+        alias = await db.media_aliases.find_one({"_id": f"{category}/{filename}"}, {"blob": 1})
+        if alias:
+            return "blobs", alias["blob"]
+        return category, filename
+
+    async def collect_garbage(self, db) -> int:
+        """Delete blobs that have had no references for the grace period"""
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=self.gc_grace_seconds)
+        removed = 0
+        candidates = await db.media_blobs.find(
+            {"refcount": {"$lte": 0}, "released_at": {"$lt": cutoff}}, {"_id": 1}
+        ).to_list(1000)
+        for blob in candidates:
+            # Re-check atomically: a new upload may have referenced it meanwhile
+            deleted = await db.media_blobs.find_one_and_delete(
+                {"_id": blob["_id"], "refcount": {"$lte": 0}, "released_at": {"$lt": cutoff}}
+            )
+            if not deleted:
+                continue
+            await self.backend.delete(self.key_for(deleted["_id"]))
+            await self.writer.run_io(self._remove_derivatives, self.path_for(deleted["_id"]))
+            removed += 1
+        self.blobs_collected += removed
+        if removed:
+            logger.info(f"🧹 Removed {removed} unreferenced media blobs")
+        return removed
+
+    @staticmethod
+    def _remove_derivatives(path: Path):
+        if path.parent.is_dir():
+            for derivative in path.parent.glob(f"{path.stem}__*"):
+                derivative.unlink(missing_ok=True)
+
+    async def migrate_refcount_keys(self, db) -> int:
+        """Re-key reference counts that were stored per sha256 to the object name"""
+        migrated = 0
+        async for doc in db.media_blobs.find({"sha256": {"$exists": False}, "name": {"$exists": True}}):
+            on_insert = {"sha256": doc["_id"], "size": doc.get("size"), "created_at": doc.get("created_at")}
+            if doc.get("released_at") is not None:
+                on_insert["released_at"] = doc["released_at"]
+            # $inc rather than a copy: uploads since startup may already reference the new key
+            await db.media_blobs.update_one(
+                {"_id": doc["name"]},
+                {"$inc": {"refcount": doc.get("refcount", 0)}, "$setOnInsert": on_insert},
+                upsert=True,
+            )
+            await db.media_blobs.delete_one({"_id": doc["_id"]})
+            migrated += 1
+        if migrated:
+            logger.info(f"📦 Re-keyed {migrated} media blob reference counts by object name")
+        return migrated
+
+    async def migrate_legacy(self, db) -> int:
+        """Move files from the per-category upload directories into the blob store"""
+        migrated = 0
+        for category in LEGACY_CATEGORIES:
+            directory = self.writer.root / category
+            if not directory.is_dir():
+                continue
+            for path in sorted(directory.iterdir()):
+                # Skip temp files and derivatives; derivatives are re-rendered per blob
+                if not path.is_file() or path.name.startswith(".") or "__" in path.stem:
+                    continue
+                try:
+                    sha256, size = await self.writer.run_io(_hash_file, path)
+                    name = f"{sha256}{path.suffix.lower()}"
+                    alias_id = f"{category}/{path.name}"
+                    # The alias marks the file as counted; a rerun after a failed
+                    # move only retries the move
+                    if not await db.media_aliases.find_one({"_id": alias_id, "blob": name}, {"_id": 1}):
+                        await self._reference(db, sha256, name, size)
+                        await db.media_aliases.update_one(
+                            {"_id": alias_id},
+                            {"$set": {"blob": name, "migrated_at": datetime.now(timezone.utc)}},
+                            upsert=True,
+                        )
+                    created = await self._place(path, name)
+                    await self.writer.run_io(self._remove_derivatives, path)
+                    self.schedule_derivatives(BlobRef(sha256=sha256, name=name, size=size, created=created))
+                    if not created:
+                        self.dedup_hits += 1
+                    migrated += 1
+                except Exception as e:
+                    logger.error(f"❌ Failed to migrate {category}/{path.name} into the blob store: {e}")
+        if migrated:
+            logger.info(f"📦 Migrated {migrated} legacy uploads into the blob store")
+        return migrated
+
+    def stats(self):
+        return {
+            "backend": self.backend.name,
+            "blobs_written": self.blobs_written,
+            "dedup_hits": self.dedup_hits,
+            "blobs_collected": self.blobs_collected,
+        }
+
+
+# Singleton instance
+blob_store = BlobStore(
+    gc_grace_seconds=int(os.getenv("BLOB_GC_GRACE_SECONDS", "3600")),
+    gc_interval_seconds=float(os.getenv("BLOB_GC_INTERVAL_SECONDS", "3600")),
+)
@@ -0,0 +1,284 @@
+"""Fan-out of real-time events to connected WebSockets.
+
+Publishing an event never waits on the network. The payload is serialized
+once and put on a bounded send queue per socket, and each socket has its own
+writer task that drains the queue. A slow mobile connection therefore only
+delays itself, not the other members of a chat.
+
+When a socket's queue is full, that consumer is too slow, and the configured
+policy applies:
+
+- "disconnect" (default): close the socket with 1013 (try again later). The
+  client reconnects with its last event_id and the gap is replayed.
+- "drop": discard the oldest queued event to make room. Dropped events are
+  not replayed, so the next event the socket receives is preceded by a
+  replay:resync_required message and the client refetches.
+
+A single send that takes longer than send_timeout, or that fails, also closes
+the socket.
+
+Wire formats: clients that offer the "msgpack" subprotocol get binary
+MessagePack frames, and everyone else gets JSON text. Each event is encoded at
+most once per format (OutboundMessage) and the encoding is shared by every
+recipient. permessage-deflate is negotiated by the ASGI server (uvicorn's
+ws_per_message_deflate, on by default) for clients that offer it.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Iterable, Optional, Set, Union
+
+from starlette.websockets import WebSocket
+
+try:
+    import msgpack
+except ImportError:  # msgpack is optional; without it every client gets JSON
+    msgpack = None
+
+logger = logging.getLogger(__name__)
+
+SLOW_CONSUMER_POLICIES = ("drop", "disconnect")
+# "Try again later": clients treat it as a signal to reconnect
+SLOW_CONSUMER_CLOSE_CODE = 1013
+WIRE_FORMATS = ("json", "msgpack")
+RESYNC_REQUIRED = {"type": "replay:resync_required"}
+
+
+class OutboundMessage:
+    """One event to send, with its binary encoding built lazily and only once"""
+
+    __slots__ = ("text", "_payload", "_binary")
+
+    def __init__(self, text: str, payload: Any = None):
+        self.text = text
+        self._payload = payload
+        self._binary: Optional[bytes] = None
+
+    def binary(self) -> bytes:
+        if self._binary is None:
+            payload = self._payload if self._payload is not None else json.loads(self.text)
+            self._binary = msgpack.packb(payload, use_bin_type=True)
+        return self._binary
+
+
+def decode_client_frame(message: Dict[str, Any]) -> Optional[str]:
+    """Text of an inbound ASGI websocket.receive message; MessagePack frames become JSON text"""
+    if message.get("text") is not None:
+        return message["text"]
+    data = message.get("bytes")
+    if data is None or msgpack is None:
+        return None
+    decoded = msgpack.unpackb(data, raw=False)
+    return decoded if isinstance(decoded, str) else json.dumps(decoded)
+
+
+class Connection:
+    """One accepted WebSocket plus its send queue and writer task"""
+
+    def __init__(self, hub: "ConnectionHub", user_id: str, ws: WebSocket, queue_size: int,
+                 wire_format: str = "json"):
+        self.hub = hub
+        self.user_id = user_id
+        self.ws = ws
+        self.binary = wire_format == "msgpack"
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self.closed = False
+        self.dropped = 0
+        # Events were dropped since the last send; tell the client before the next one
+        self.resync_pending = False
+        self._writer: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._writer = asyncio.create_task(self._run())
+
+    def enqueue(self, message: OutboundMessage) -> bool:
+        if self.closed:
+            return False
+        try:
+            self.queue.put_nowait(message)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def drop_oldest(self):
+        try:
+            self.queue.get_nowait()
+            self.dropped += 1
+            self.resync_pending = True
+        except asyncio.QueueEmpty:
+            pass
+
+    def send(self, payload: Dict[str, Any]) -> bool:
+        """Queue a payload for this socket only (replies such as pong)"""
+        return self.hub.offer(self, OutboundMessage(json.dumps(payload), payload))
+
+    def send_text(self, text: str) -> bool:
+        """Queue a bare text frame for a JSON client (the plain "pong" reply)"""
+        return self.hub.offer(self, OutboundMessage(text))
+
+    async def _send(self, message: OutboundMessage):
+        if self.binary:
+            send = self.ws.send_bytes(message.binary())
+        else:
+            send = self.ws.send_text(message.text)
+        await asyncio.wait_for(send, timeout=self.hub.send_timeout)
+
+    async def _run(self):
+        try:
+            while True:
+                message = await self.queue.get()
+                if self.resync_pending:
+                    self.resync_pending = False
+                    await self._send(OutboundMessage(json.dumps(RESYNC_REQUIRED), RESYNC_REQUIRED))
+                await self._send(message)
+        except asyncio.CancelledError:
+            raise
+        except asyncio.TimeoutError:
+            logger.warning(f"🐢 WebSocket send timed out for user {self.user_id}, disconnecting")
+            self.hub.disconnect(self, reason="send timeout")
+        except Exception as e:
+            logger.info(f"🔌 WebSocket writer for user {self.user_id} stopped: {e}")
+            # Close it too, or the reader side would keep a socket nobody writes to
+            self.hub.disconnect(self, reason="send failed")
+
+    async def close(self, code: int, reason: str):
+        try:
+            await self.ws.close(code=code, reason=reason)
+        except Exception:
+            # Already closed by the client
+            pass
+
+    def stop(self):
+        self.closed = True
+        if self._writer is not None and self._writer is not asyncio.current_task():
+            self._writer.cancel()
+
+
+class ConnectionHub:
+    """Registry of live sockets per user with non-blocking fan-out"""
+
+    def __init__(self, queue_size: int = 256, policy: str = "disconnect", send_timeout: float = 10.0):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"Unknown slow consumer policy: {policy}")
+        self.queue_size = queue_size
+        self.policy = policy
+        self.send_timeout = send_timeout
+        self._connections: Dict[str, Set[Connection]] = {}
+        self._closing: Set[asyncio.Task] = set()
+        self.events_delivered = 0
+        self.messages_queued = 0
+        self.messages_dropped = 0
+        self.slow_disconnects = 0
+
+    @staticmethod
+    def negotiate(ws: WebSocket) -> str:
+        """Pick the wire format from the subprotocols the client offered"""
+        offered = ws.scope.get("subprotocols") or []
+        if "msgpack" in offered and msgpack is not None:
+            return "msgpack"
+        return "json"
+
+    async def accept(self, ws: WebSocket) -> str:
+        """Accept the socket with the negotiated subprotocol; returns the wire format"""
+        wire_format = self.negotiate(ws)
+        offered = ws.scope.get("subprotocols") or []
+        # Only echo a subprotocol the client asked for
+        await ws.accept(subprotocol=wire_format if wire_format in offered else None)
+        return wire_format
+
+    def register(self, user_id: str, ws: WebSocket, wire_format: str = "json") -> Connection:
+        """Track an accepted socket and start its writer"""
+        connection = Connection(self, user_id, ws, self.queue_size, wire_format)
+        self._connections.setdefault(user_id, set()).add(connection)
+        connection.start()
+        logger.info(f"📊 User {user_id} now has {len(self._connections[user_id])} active WebSocket connections")
+        return connection
+
+    def unregister(self, connection: Connection):
+        connection.stop()
+        connections = self._connections.get(connection.user_id)
+        if connections is None:
+            return
+        connections.discard(connection)
+        if not connections:
+            del self._connections[connection.user_id]
+
+    def disconnect(self, connection: Connection, reason: str):
+        """Unregister and close a socket without waiting for the close handshake"""
+        self.unregister(connection)
+        task = asyncio.create_task(connection.close(SLOW_CONSUMER_CLOSE_CODE, reason))
+        self._closing.add(task)
+        task.add_done_callback(self._closing.discard)
+
+    def is_connected(self, user_id: str) -> bool:
+        return bool(self._connections.get(user_id))
+
+    def connection_count(self, user_id: str) -> int:
+        return len(self._connections.get(user_id, ()))
+
+    def offer(self, connection: Connection, message: Union[str, OutboundMessage]) -> bool:
+        """Queue a serialized message, applying the slow consumer policy"""
+        if isinstance(message, str):
+            message = OutboundMessage(message)
+        if connection.enqueue(message):
+            self.messages_queued += 1
+            return True
+        if connection.closed:
+            return False
+        if self.policy == "drop":
+            connection.drop_oldest()
+            self.messages_dropped += 1
+            if connection.enqueue(message):
+                self.messages_queued += 1
+                return True
+            return False
+        self.slow_disconnects += 1
+        logger.warning(f"🐢 Disconnecting slow WebSocket consumer for user {connection.user_id}")
+        self.disconnect(connection, reason="slow consumer")
+        return False
+
+    def publish_serialized(self, user_ids: Iterable[str], message: Union[str, OutboundMessage]) -> int:
+        self.events_delivered += 1
+        if isinstance(message, str):
+            # Shared by all recipients, so each format is encoded once
+            message = OutboundMessage(message)
+        delivered = 0
+        for user_id in set(user_ids):
+            for connection in list(self._connections.get(user_id, ())):
+                if self.offer(connection, message):
+                    delivered += 1
+        return delivered
+
+    def publish(self, user_ids: Iterable[str], payload: Dict[str, Any]) -> int:
+        """Serialize once and queue for every socket of every user. Returns sockets reached."""
+        return self.publish_serialized(user_ids, OutboundMessage(json.dumps(payload), payload))
+
+    async def shutdown(self):
+        connections = [c for conns in self._connections.values() for c in conns]
+        for connection in connections:
+            self.unregister(connection)
+        await asyncio.gather(*(c.close(1001, "server shutdown") for c in connections), return_exceptions=True)
+
+    def stats(self) -> Dict[str, Any]:
+        connections = [c for conns in self._connections.values() for c in conns]
+        return {
+            "users": len(self._connections),
+            "connections": len(connections),
+            "msgpack_connections": sum(1 for c in connections if c.binary),
+            "queued_now": sum(c.queue.qsize() for c in connections),
+            "policy": self.policy,
+            "events_delivered": self.events_delivered,
+            "messages_queued": self.messages_queued,
+            "messages_dropped": self.messages_dropped,
+            "slow_disconnects": self.slow_disconnects,
+        }
+
+
+# Singleton instance
+connection_hub = ConnectionHub(
+    queue_size=int(os.getenv("WS_SEND_QUEUE_SIZE", "256")),
+    policy=os.getenv("WS_SLOW_CONSUMER_POLICY", "disconnect").lower(),
+    send_timeout=float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10")),
+)
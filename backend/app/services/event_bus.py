@@ -0,0 +1,323 @@
+"""Cross-worker pub/sub for real-time events.
+
+Each uvicorn worker only holds its own sockets (see connection_hub). The bus
+makes sure an event published in one worker reaches recipients connected to
+any worker. An event is one serialized message plus its recipient user ids.
+publish() hands the event to local sockets immediately, then forwards it to
+the backend. Every worker's subscriber delivers events from the other
+workers and skips its own.
+
+Backends, selected with EVENT_BUS=memory|mongo|redis:
+
+- memory: single process; nothing leaves the worker.
+- mongo: events go into a capped collection that every worker tails. This
+  works on a standalone server and needs no replica set.
+- redis: PUBLISH/SUBSCRIBE over a minimal RESP client (REDIS_URL). Any
+  server that speaks the Redis protocol works, including a local stand-in.
+"""
+
+import asyncio
+import logging
+import os
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# deliver(user_ids, message, event_id) hands an event to this worker's sockets
+Deliver = Callable[[Iterable[str], str, Optional[str]], int]
+
+RECONNECT_MIN_SECONDS = 0.5
+RECONNECT_MAX_SECONDS = 15.0
+
+
+class EventBus:
+    """In-process bus; also the base class of the cross-worker backends"""
+
+    name = "memory"
+
+    def __init__(self):
+        self.origin = uuid.uuid4().hex
+        self._deliver: Optional[Deliver] = None
+        self.published = 0
+        self.received = 0
+        self.publish_errors = 0
+
+    async def start(self, deliver: Deliver, db=None):
+        self._deliver = deliver
+
+    async def stop(self):
+        pass
+
+    def deliver_local(self, user_ids: Iterable[str], message: str, event_id: Optional[str] = None) -> int:
+        if self._deliver is None:
+            return 0
+        return self._deliver(user_ids, message, event_id)
+
+    async def _forward(self, user_ids: List[str], message: str, event_id: Optional[str]):
+        """Send an event to the other workers"""
+
+    async def publish(self, user_ids: Iterable[str], message: str, event_id: Optional[str] = None) -> int:
+        """Deliver to local sockets now and to other workers through the backend"""
+        recipients = list(dict.fromkeys(user_ids))
+        if not recipients:
+            return 0
+        delivered = self.deliver_local(recipients, message, event_id)
+        self.published += 1
+        try:
+            await self._forward(recipients, message, event_id)
+        except Exception as e:
+            # Remote delivery is best effort; the request that caused the event still succeeds
+            self.publish_errors += 1
+            logger.error(f"❌ Event bus ({self.name}) publish failed: {e}")
+        return delivered
+
+    def _receive(self, origin: str, user_ids: List[str], message: str, event_id: Optional[str]):
+        if origin == self.origin:
+            return
+        self.received += 1
+        self.deliver_local(user_ids, message, event_id)
+
+    async def _run_forever(self, loop_once: Callable[[], Any]):
+        """Run a subscriber loop, reconnecting with backoff"""
+        delay = RECONNECT_MIN_SECONDS
+        while True:
+            try:
+                await loop_once()
+                delay = RECONNECT_MIN_SECONDS
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ Event bus ({self.name}) subscriber error, retrying in {delay:.1f}s: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_SECONDS)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.name,
+            "published": self.published,
+            "received": self.received,
+            "publish_errors": self.publish_errors,
+        }
+
+
+class MongoEventBus(EventBus):
+    """Events in a capped collection, tailed by every worker"""
+
+    name = "mongo"
+
+    def __init__(self, collection: str = "realtime_events", size_bytes: int = 16 * 1024 * 1024):
+        super().__init__()
+        self.collection_name = collection
+        self.size_bytes = size_bytes
+        self._collection = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_ts: Optional[datetime] = None
+        # _ids seen at _last_ts, so re-tailing from it does not redeliver them
+        self._recent_ids: deque = deque(maxlen=1000)
+
+    async def _ensure_collection(self, db):
+        from pymongo.errors import CollectionInvalid, OperationFailure
+
+        try:
+            await db.create_collection(self.collection_name, capped=True, size=self.size_bytes)
+            # A tailable cursor on an empty capped collection dies immediately
+            await db[self.collection_name].insert_one({"origin": self.origin, "users": [], "message": "",
+                                                        "ts": datetime.now(timezone.utc)})
+        except (CollectionInvalid, OperationFailure):
+            pass  # Already exists
+        self._collection = db[self.collection_name]
+
+    async def start(self, deliver: Deliver, db=None):
+        await super().start(deliver)
+        await self._ensure_collection(db)
+        newest = await self._collection.find_one({}, sort=[("$natural", -1)])
+        self._last_ts = newest["ts"] if newest else datetime.now(timezone.utc)
+        if newest:
+            self._recent_ids.append(newest["_id"])
+        self._task = asyncio.create_task(self._run_forever(self._tail))
+        logger.info(f"📣 Event bus: tailing MongoDB capped collection {self.collection_name}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _forward(self, user_ids: List[str], message: str, event_id: Optional[str]):
+        await self._collection.insert_one({
+            "origin": self.origin,
+            "users": user_ids,
+            "message": message,
+            "event_id": event_id,
+            "ts": datetime.now(timezone.utc),
+        })
+
+    async def _tail(self):
+        from pymongo import CursorType
+
+        cursor = self._collection.find({"ts": {"$gte": self._last_ts}}, cursor_type=CursorType.TAILABLE_AWAIT)
+        while cursor.alive:
+            async for doc in cursor:
+                if doc["_id"] in self._recent_ids:
+                    continue
+                self._recent_ids.append(doc["_id"])
+                self._last_ts = doc["ts"]
+                if doc.get("users"):
+                    self._receive(doc.get("origin"), doc["users"], doc["message"], doc.get("event_id"))
+        raise ConnectionError("tailable cursor closed")
+
+
+class RespError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+
+class RespConnection:
+    """Just enough of RESP2 for AUTH/SELECT/PUBLISH/SUBSCRIBE"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def open(cls, url: str) -> "RespConnection":
+        parsed = urlparse(url)
+        reader, writer = await asyncio.open_connection(parsed.hostname or "localhost", parsed.port or 6379)
+        connection = cls(reader, writer)
+        if parsed.password:
+            args = ("AUTH", parsed.username, parsed.password) if parsed.username else ("AUTH", parsed.password)
+            await connection.command(*args)
+        database = (parsed.path or "/").lstrip("/")
+        if database and database != "0":
+            await connection.command("SELECT", database)
+        return connection
+
+    @staticmethod
+    def encode(*args: Any) -> bytes:
+        parts = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+            parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+        return b"".join(parts)
+
+    async def send(self, *args: Any):
+        self.writer.write(self.encode(*args))
+        await self.writer.drain()
+
+    async def read_reply(self) -> Any:
+        line = await self.reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        prefix, body = line[:1], line[1:-2]
+        if prefix == b"+":
+            return body.decode("utf-8")
+        if prefix == b"-":
+            raise RespError(body.decode("utf-8"))
+        if prefix == b":":
+            return int(body)
+        if prefix == b"$":
+            length = int(body)
+            if length < 0:
+                return None
+            data = await self.reader.readexactly(length + 2)
+            return data[:-2]
+        if prefix == b"*":
+            length = int(body)
+            if length < 0:
+                return None
+            return [await self.read_reply() for _ in range(length)]
+        raise RespError(f"Unexpected reply prefix {prefix!r}")
+
+    async def command(self, *args: Any) -> Any:
+        await self.send(*args)
+        return await self.read_reply()
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except Exception:
+            pass
+
+
+class RedisEventBus(EventBus):
+    """PUBLISH/SUBSCRIBE on one channel shared by all workers"""
+
+    name = "redis"
+
+    def __init__(self, url: str, channel: str = "realtime"):
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self._publisher: Optional[RespConnection] = None
+        self._publish_lock = asyncio.Lock()
+        self._task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def pack(origin: str, user_ids: List[str], message: str, event_id: Optional[str]) -> bytes:
+        # User and event ids never contain either separator
+        return f"{origin}\n{event_id or ''}\n{','.join(user_ids)}\n{message}".encode("utf-8")
+
+    @staticmethod
+    def unpack(data: bytes) -> Tuple[str, List[str], str, Optional[str]]:
+        origin, event_id, users, message = data.decode("utf-8").split("\n", 3)
+        return origin, users.split(","), message, event_id or None
+
+    async def start(self, deliver: Deliver, db=None):
+        await super().start(deliver)
+        self._task = asyncio.create_task(self._run_forever(self._subscribe))
+        logger.info(f"📣 Event bus: Redis channel {self.channel}")
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._publisher is not None:
+            await self._publisher.close()
+
+    async def _forward(self, user_ids: List[str], message: str, event_id: Optional[str]):
+        data = self.pack(self.origin, user_ids, message, event_id)
+        async with self._publish_lock:
+            for attempt in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = await RespConnection.open(self.url)
+                    await self._publisher.command("PUBLISH", self.channel, data)
+                    return
+                except (ConnectionError, OSError, asyncio.IncompleteReadError):
+                    # Stale connection: reconnect once
+                    if self._publisher is not None:
+                        await self._publisher.close()
+                    self._publisher = None
+                    if attempt:
+                        raise
+
+    async def _subscribe(self):
+        connection = await RespConnection.open(self.url)
+        try:
+            await connection.command("SUBSCRIBE", self.channel)
+            while True:
+                reply = await connection.read_reply()
+                if isinstance(reply, list) and len(reply) == 3 and reply[0] == b"message":
+                    self._receive(*self.unpack(reply[2]))
+        finally:
+            await connection.close()
+
+
+def create_event_bus() -> EventBus:
+    kind = os.getenv("EVENT_BUS", "memory").lower()
+    if kind == "mongo":
+        return MongoEventBus(
+            collection=os.getenv("EVENT_BUS_COLLECTION", "realtime_events"),
+            size_bytes=int(os.getenv("EVENT_BUS_CAPPED_BYTES", str(16 * 1024 * 1024))),
+        )
+    if kind == "redis":
+        return RedisEventBus(
+            url=os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+            channel=os.getenv("EVENT_BUS_CHANNEL", "realtime"),
+        )
+    return EventBus()
+
+
+# Singleton instance
+event_bus = create_event_bus()
@@ -0,0 +1,238 @@
+"""Per-user log of real-time events, replayed when a WebSocket reconnects.
+
+Every non-ephemeral event gets a time-ordered event_id before it is
+serialized, so clients see it in the payload and can send the last one they
+received when they reconnect (?last_event_id=...). Only the gap is replayed:
+
+- Each worker keeps a small in-memory ring of recent events per user while
+  the user is connected to it, and for a while after they disconnect. A quick
+  reconnect to the same worker is answered from the ring.
+- Every event is also spilled, one document per event, into the `event_log`
+  collection in batched writes. Reconnects to another worker, or after the
+  ring has rolled over, are answered from there. Documents expire after
+  EVENT_LOG_RETENTION_SECONDS.
+
+Ids sort by wall-clock milliseconds first, so an event published by another
+worker in the same millisecond (or on a clock that runs behind) can sort
+before the client's last id while the client has not seen it. Replay
+therefore reaches back overlap_ms before that id and skips only the events
+that are certainly seen (the last id itself, and older events of the same
+worker). Events inside the overlap may be sent twice, and clients drop
+event_ids they already have.
+
+A batch that fails to reach the durable log is queued again for the next
+flush, up to max_pending events.
+
+If the gap is older than the retention window, or longer than max_replay
+events, replay() returns None and the client must do a full resync.
+"""
+
+import asyncio
+import itertools
+import logging
+import os
+import time
+import uuid
+from collections import deque
+from datetime import datetime, timezone
+from typing import Deque, Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+EVENT_LOG_RETENTION_SECONDS = 24 * 3600
+DUPLICATE_KEY_ERROR = 11000
+# Transient state that a reconnecting client gets afresh anyway (presence:bulk)
+EPHEMERAL_EVENT_TYPES = {"presence:update", "presence:diff", "presence:bulk", "pong"}
+
+Event = Tuple[str, str]  # (event_id, serialized message)
+
+
+class EventLog:
+    """Ring buffers per connected user plus batched durable spillover"""
+
+    def __init__(self, ring_size: int = 200, idle_seconds: int = 300, max_replay: int = 500,
+                 flush_interval: float = 0.2, batch_size: int = 500, overlap_ms: int = 2000,
+                 max_pending: int = 100_000):
+        self.ring_size = ring_size
+        self.idle_seconds = idle_seconds
+        self.max_replay = max_replay
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.overlap_ms = overlap_ms
+        self.max_pending = max_pending
+        self.origin = uuid.uuid4().hex[:8]
+        self._counter = itertools.count()
+        self._rings: Dict[str, Deque[Event]] = {}
+        self._idle_since: Dict[str, float] = {}
+        # Milliseconds timestamp at which each ring started collecting
+        self._ring_started: Dict[str, int] = {}
+        self._pending: List[Dict] = []
+        self._db = None
+        self._flusher: Optional[asyncio.Task] = None
+        self.ring_replays = 0
+        self.durable_replays = 0
+        self.resyncs = 0
+        self.flush_errors = 0
+        self.dropped_writes = 0
+
+    def next_id(self) -> str:
+        """Sortable id: milliseconds, then worker, then a per-worker counter"""
+        return f"{int(time.time() * 1000):013d}-{self.origin}-{next(self._counter) & 0xFFFFFFFF:08x}"
+
+    @staticmethod
+    def age_seconds(event_id: str) -> Optional[float]:
+        try:
+            return time.time() - int(event_id[:13]) / 1000
+        except ValueError:
+            return None
+
+    def _overlap_filter(self, last_event_id: str):
+        """Lower _id bound of the replay, and a predicate for events that may be missing"""
+        window_start = f"{max(int(last_event_id[:13]) - self.overlap_ms, 0):013d}"
+        origin = last_event_id[14:22]
+
+        def unseen(event_id: str) -> bool:
+            if event_id < window_start or event_id == last_event_id:
+                return False
+            # One worker's ids are delivered in order, so its older ones were seen
+            return not (event_id[14:22] == origin and event_id < last_event_id)
+
+        return window_start, unseen
+
+    def start(self, db):
+        self._db = db
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._flusher is not None:
+            self._flusher.cancel()
+        await self.flush()
+
+    def append(self, user_ids: Iterable[str], event_id: str, message: str):
+        """Queue an event for the durable log (called once, by the publishing worker)"""
+        self._pending.append({
+            "_id": event_id,
+            "users": list(user_ids),
+            "message": message,
+            "created_at": datetime.now(timezone.utc),
+        })
+
+    def remember(self, user_ids: Iterable[str], event_id: str, message: str):
+        """Add a delivered event to the rings of users this worker tracks"""
+        for user_id in user_ids:
+            ring = self._rings.get(user_id)
+            if ring is not None:
+                ring.append((event_id, message))
+
+    def track(self, user_id: str):
+        """Start (or keep) a ring for a user connecting to this worker"""
+        if user_id not in self._rings:
+            self._rings[user_id] = deque(maxlen=self.ring_size)
+            self._ring_started[user_id] = int(time.time() * 1000)
+        self._idle_since.pop(user_id, None)
+
+    def release(self, user_id: str):
+        """The user's last socket on this worker closed; keep the ring for a while"""
+        if user_id in self._rings:
+            self._idle_since[user_id] = time.monotonic()
+
+    async def replay(self, user_id: str, last_event_id: str) -> Optional[List[Event]]:
+        """Events for the user after last_event_id, oldest first; None if a resync is needed.
+
+        Events delivered to this worker while the lookup runs are included,
+        so the caller must register the socket right after, without awaiting.
+        """
+        age = self.age_seconds(last_event_id)
+        if age is None or age > EVENT_LOG_RETENTION_SECONDS:
+            self.resyncs += 1
+            return None
+        window_start, unseen = self._overlap_filter(last_event_id)
+
+        ring = self._rings.get(user_id)
+        if ring:
+            ids = [event_id for event_id, _ in ring]
+            # The ring covers the gap if it holds everything since before the overlap window
+            complete = len(ring) < ring.maxlen and self._ring_started.get(user_id, 0) <= int(window_start)
+            if last_event_id in ids and (complete or ids[0] <= window_start):
+                self.ring_replays += 1
+                return [e for e in ring if unseen(e[0])]
+
+        seen_before = {event_id for event_id, _ in ring} if ring else set()
+        # Make this worker's own recent events visible to the query
+        await self.flush()
+        docs = await self._db.event_log.find(
+            {"users": user_id, "_id": {"$gte": window_start}}, {"message": 1}
+        ).sort("_id", 1).limit(self.max_replay + 1).to_list(self.max_replay + 1)
+        if len(docs) > self.max_replay:
+            self.resyncs += 1
+            return None
+        events = [(doc["_id"], doc["message"]) for doc in docs if unseen(doc["_id"])]
+        replayed = {event_id for event_id, _ in events}
+        if ring:
+            events.extend(e for e in ring if e[0] not in seen_before and e[0] not in replayed)
+        self.durable_replays += 1
+        return events
+
+    async def flush(self):
+        if not self._pending or self._db is None:
+            return
+        batch, self._pending = self._pending, []
+        failed: List[Dict] = []
+        for start in range(0, len(batch), self.batch_size):
+            chunk = batch[start:start + self.batch_size]
+            try:
+                await self._db.event_log.insert_many(chunk, ordered=False)
+            except Exception as e:
+                self.flush_errors += 1
+                failed.extend(self._unwritten(chunk, e))
+                logger.error(f"❌ Failed to write {len(chunk)} events to the event log, will retry: {e}")
+        if failed:
+            # Retry before anything published since; stay bounded while Mongo is down
+            self._pending = failed + self._pending
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                del self._pending[:overflow]
+                self.dropped_writes += overflow
+                logger.error(f"❌ Event log backlog full, dropped {overflow} unwritten events")
+
+    @staticmethod
+    def _unwritten(chunk: List[Dict], error: Exception) -> List[Dict]:
+        """Documents of a failed insert_many that are not in the collection"""
+        details = getattr(error, "details", None)
+        if not isinstance(details, dict):
+            return chunk
+        # A BulkWriteError: everything but the reported documents was written,
+        # and a duplicate key means a retry already wrote it
+        return [chunk[err["index"]] for err in details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY_ERROR]
+
+    def _sweep_idle(self):
+        cutoff = time.monotonic() - self.idle_seconds
+        for user_id, since in list(self._idle_since.items()):
+            if since < cutoff:
+                del self._idle_since[user_id]
+                self._rings.pop(user_id, None)
+                self._ring_started.pop(user_id, None)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+            self._sweep_idle()
+
+    def stats(self):
+        return {
+            "rings": len(self._rings),
+            "pending_writes": len(self._pending),
+            "ring_replays": self.ring_replays,
+            "durable_replays": self.durable_replays,
+            "resyncs": self.resyncs,
+            "flush_errors": self.flush_errors,
+            "dropped_writes": self.dropped_writes,
+        }
+
+
+# Singleton instance
+event_log = EventLog(
+    ring_size=int(os.getenv("EVENT_LOG_RING_SIZE", "200")),
+    max_replay=int(os.getenv("EVENT_LOG_MAX_REPLAY", "500")),
+)
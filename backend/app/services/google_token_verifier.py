@@ -0,0 +1,121 @@
+"""Local verification of Google ID tokens.
+
+Instead of asking Google's tokeninfo endpoint about every sign-in, the
+signature is checked against Google's published signing keys (JWKS). The key
+set is cached for as long as its Cache-Control max-age allows and refetched
+early only when a token names a key id we have not seen (key rotation).
+
+GOOGLE_JWKS_URL can point at a local JWKS stand-in for testing, and
+GOOGLE_CLIENT_IDS (comma separated) restricts the accepted audiences.
+"""
+
+import asyncio
+import logging
+import os
+import re
+import time
+from typing import Any, Dict, List, Optional
+
+from jose import jwt, JWTError
+
+from app.services.http_client import get_http_client
+
+logger = logging.getLogger(__name__)
+
+GOOGLE_JWKS_URL = "https://www.googleapis.com/oauth2/v3/certs"
+GOOGLE_ISSUERS = ("accounts.google.com", "https://accounts.google.com")
+
+# Used when the JWKS response carries no usable max-age
+DEFAULT_KEYS_TTL_SECONDS = 3600
+# Minimum gap between forced refetches triggered by unknown key ids
+MIN_REFRESH_INTERVAL_SECONDS = 60
+
+_MAX_AGE = re.compile(r"max-age=(\d+)")
+
+
+class GoogleTokenError(Exception):
+    """The ID token is malformed, expired, or not signed by Google"""
+
+
+class GoogleTokenVerifier:
+    """Verifies Google ID tokens against a cached JWKS"""
+
+    def __init__(self, jwks_url: str = GOOGLE_JWKS_URL, audiences: Optional[List[str]] = None,
+                 issuers=GOOGLE_ISSUERS):
+        self.jwks_url = jwks_url
+        self.audiences = [a for a in (audiences or []) if a]
+        self.issuers = issuers
+        self._keys: Dict[str, Dict[str, Any]] = {}
+        self._expires_at = 0.0
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+        if not self.audiences:
+            logger.warning("⚠️ GOOGLE_CLIENT_IDS not set - Google ID token audience is not checked")
+
+    async def _fetch_keys(self):
+        resp = await get_http_client().get(self.jwks_url)
+        resp.raise_for_status()
+        keys = {key["kid"]: key for key in resp.json().get("keys", []) if "kid" in key}
+        match = _MAX_AGE.search(resp.headers.get("cache-control", ""))
+        ttl = int(match.group(1)) if match else DEFAULT_KEYS_TTL_SECONDS
+
+        now = time.monotonic()
+        self._keys = keys
+        self._fetched_at = now
+        self._expires_at = now + ttl
+        logger.info(f"🔑 Loaded {len(keys)} Google signing keys (cached for {ttl}s)")
+
+    async def _get_key(self, kid: str) -> Optional[Dict[str, Any]]:
+        now = time.monotonic()
+        if kid in self._keys and now < self._expires_at:
+            return self._keys[kid]
+
+        async with self._lock:
+            # Another request may have refreshed while we waited
+            now = time.monotonic()
+            stale = now >= self._expires_at
+            unknown = kid not in self._keys and now - self._fetched_at >= MIN_REFRESH_INTERVAL_SECONDS
+            if stale or unknown:
+                try:
+                    await self._fetch_keys()
+                except Exception as e:
+                    # Keep serving the previous keys if Google is unreachable
+                    logger.error(f"❌ Failed to fetch Google signing keys: {e}")
+                    if not self._keys:
+                        raise GoogleTokenError("Google signing keys unavailable")
+            return self._keys.get(kid)
+
+    async def verify(self, id_token: str) -> Dict[str, Any]:
+        """Return the token claims. Raises GoogleTokenError if the token is not valid."""
+        try:
+            header = jwt.get_unverified_header(id_token)
+        except JWTError as e:
+            raise GoogleTokenError(f"Malformed ID token: {e}")
+
+        key = await self._get_key(header.get("kid", ""))
+        if key is None:
+            raise GoogleTokenError("ID token signed with an unknown key")
+
+        try:
+            claims = jwt.decode(
+                id_token,
+                key,
+                algorithms=[key.get("alg", "RS256")],
+                options={"verify_aud": False, "verify_at_hash": False},
+            )
+        except JWTError as e:
+            raise GoogleTokenError(f"Invalid ID token: {e}")
+
+        # Checked here because jose only accepts a single expected audience
+        if self.audiences and claims.get("aud") not in self.audiences:
+            raise GoogleTokenError("ID token was issued for another client")
+        if claims.get("iss") not in self.issuers:
+            raise GoogleTokenError("ID token was not issued by Google")
+        return claims
+
+
+# Singleton instance
+google_token_verifier = GoogleTokenVerifier(
+    jwks_url=os.getenv("GOOGLE_JWKS_URL", GOOGLE_JWKS_URL),
+    audiences=[a.strip() for a in os.getenv("GOOGLE_CLIENT_IDS", "").split(",")],
+)
@@ -0,0 +1,34 @@
+"""Shared async HTTP client for outbound calls.
+
+One httpx.AsyncClient per worker keeps a pool of keep-alive connections, so
+outbound calls (Google signing keys, avatar downloads) neither block the event
+loop nor pay a fresh TCP/TLS handshake each time. Close it on shutdown.
+"""
+
+import os
+from typing import Optional
+
+import httpx
+
+DEFAULT_TIMEOUT = httpx.Timeout(float(os.getenv("HTTP_CLIENT_TIMEOUT_SECONDS", "10")), connect=5.0)
+DEFAULT_LIMITS = httpx.Limits(
+    max_connections=int(os.getenv("HTTP_CLIENT_MAX_CONNECTIONS", "100")),
+    max_keepalive_connections=20,
+)
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_http_client() -> httpx.AsyncClient:
+    """Return the worker's shared client, creating it on first use"""
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(timeout=DEFAULT_TIMEOUT, limits=DEFAULT_LIMITS, follow_redirects=True)
+    return _client
+
+
+async def close_http_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
@@ -0,0 +1,149 @@
+"""Resized WebP/JPEG derivatives of uploaded images.
+
+Clients mostly render 48px avatars and small chat thumbnails, so every image
+upload is followed by a background job that renders a few fixed sizes in both
+WebP and JPEG. Rendering applies the EXIF orientation, then drops all metadata
+(EXIF, GPS, ICC) and recompresses. The CPU-heavy work runs in a process pool
+so it never competes with the event loop for the GIL.
+
+Derivatives sit next to the original as `<stem>__<size>.<webp|jpg>`. The media
+routes serve one when a `size` is requested and fall back to the original
+until it exists.
+"""
+
+import asyncio
+import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Set
+
+from app.services.media_writer import media_writer
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it originals are served as-is
+    Image = None
+    ImageOps = None
+
+logger = logging.getLogger(__name__)
+
+# Longest edge in pixels for each named size
+DERIVATIVE_SIZES: Dict[str, int] = {
+    "xs": 96,     # 48px avatars at 2x
+    "sm": 320,    # chat list and message thumbnails
+    "md": 1080,   # full-screen viewer on phones
+}
+DERIVATIVE_FORMATS = {"webp": "WEBP", "jpg": "JPEG"}
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
+
+
+def derivative_name(filename: str, size: str, fmt: str) -> str:
+    return f"{Path(filename).stem}__{size}.{fmt}"
+
+
+def _render(source: str, sizes: Dict[str, int]) -> List[str]:
+    """Runs in a worker process: write every derivative of `source`"""
+    source_path = Path(source)
+    written = []
+    with Image.open(source_path) as original:
+        image = ImageOps.exif_transpose(original)
+        has_alpha = image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info)
+        image = image.convert("RGBA" if has_alpha else "RGB")
+
+        for size, edge in sizes.items():
+            resized = image.copy()
+            resized.thumbnail((edge, edge), Image.LANCZOS)
+            for ext, pil_format in DERIVATIVE_FORMATS.items():
+                target = source_path.with_name(derivative_name(source_path.name, size, ext))
+                tmp = target.with_name(f".{target.name}.tmp")
+                frame = resized
+                if pil_format == "JPEG" and frame.mode != "RGB":
+                    # JPEG has no alpha channel; flatten onto white
+                    background = Image.new("RGB", frame.size, (255, 255, 255))
+                    background.paste(frame, mask=frame.getchannel("A"))
+                    frame = background
+                options = {"quality": 80, "method": 4} if pil_format == "WEBP" else {"quality": 82, "optimize": True, "progressive": True}
+                # No exif/icc_profile arguments: metadata is stripped
+                frame.save(tmp, pil_format, **options)
+                os.replace(tmp, target)
+                written.append(target.name)
+    return written
+
+
+class ImageDerivativeService:
+    """Schedules derivative rendering on a process pool"""
+
+    def __init__(self, max_workers: int = 2):
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self.generated = 0
+        self.failed = 0
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # Forking a process that already runs Motor and thread pools can deadlock the child
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    def is_image(self, filename: str) -> bool:
+        return Path(filename).suffix.lower() in IMAGE_EXTENSIONS
+
+    async def generate(self, category: str, filename: str) -> List[str]:
+        if not self.enabled or not self.is_image(filename):
+            return []
+        source = media_writer.path_for(category, filename)
+        try:
+            written = await asyncio.get_running_loop().run_in_executor(
+                self._pool(), _render, str(source), DERIVATIVE_SIZES
+            )
+        except Exception as e:
+            self.failed += 1
+            logger.warning(f"⚠️ Could not render derivatives for {category}/{filename}: {e}")
+            return []
+        self.generated += 1
+        return written
+
+    def schedule(self, category: str, filename: str):
+        """Render derivatives in the background after an upload"""
+        if not self.enabled or not self.is_image(filename):
+            return
+        task = asyncio.create_task(self.generate(category, filename))
+        # Keep a reference so the task is not garbage collected mid-flight
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def pick(self, category: str, filename: str, size: str, accept: str) -> Optional[Path]:
+        """Path of the best existing derivative for the request, if any"""
+        if size not in DERIVATIVE_SIZES or not self.is_image(filename):
+            return None
+        formats = ["webp", "jpg"] if "image/webp" in (accept or "") else ["jpg"]
+        for fmt in formats:
+            path = media_writer.path_for(category, derivative_name(filename, size, fmt))
+            if path.exists():
+                return path
+        return None
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            "enabled": self.enabled,
+            "in_progress": len(self._tasks),
+            "generated": self.generated,
+            "failed": self.failed,
+        }
+
+
+# Singleton instance
+image_derivatives = ImageDerivativeService(max_workers=int(os.getenv("IMAGE_DERIVATIVE_WORKERS", "2")))
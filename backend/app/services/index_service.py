@@ -0,0 +1,321 @@
+"""MongoDB index registry for the ADHDers API.
+
+Every query shape that server.py runs against a non-trivial collection is
+declared here, together with the index that serves it. The registry is applied
+idempotently on app startup and can be inspected from the command line:
+
+    python -m app.services.index_service ensure   # create missing indexes
+    python -m app.services.index_service report   # missing / extra / unused indexes
+    python -m app.services.index_service explain  # flag query shapes that COLLSCAN
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import ASCENDING, DESCENDING, IndexModel
+from pymongo.errors import OperationFailure
+
+from app.services.event_log import EVENT_LOG_RETENTION_SECONDS
+from app.services.presence_service import PRESENCE_DOC_TTL_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Server error codes for an index that already exists under different options/name
+INDEX_CONFLICT_CODES = {85, 86}
+
+
+@dataclass(frozen=True)
+class IndexSpec:
+    """A single index on a collection"""
+    collection: str
+    keys: Tuple[Tuple[str, int], ...]
+    name: str
+    unique: bool = False
+    sparse: bool = False
+    partial_filter: Optional[Dict[str, Any]] = None
+    expire_after_seconds: Optional[int] = None
+
+    def to_model(self) -> IndexModel:
+        options: Dict[str, Any] = {"name": self.name}
+        if self.unique:
+            options["unique"] = True
+        if self.sparse:
+            options["sparse"] = True
+        if self.partial_filter:
+            options["partialFilterExpression"] = self.partial_filter
+        if self.expire_after_seconds is not None:
+            options["expireAfterSeconds"] = self.expire_after_seconds
+        return IndexModel(list(self.keys), **options)
+
+
+@dataclass(frozen=True)
+class QueryShape:
+    """A representative query used to check that an index actually serves it"""
+    name: str
+    collection: str
+    filter: Dict[str, Any]
+    sort: Optional[Tuple[Tuple[str, int], ...]] = None
+
+
+INDEXES: List[IndexSpec] = [
+    # users
+    IndexSpec("users", (("email", ASCENDING),), "email_1"),
+    IndexSpec("users", (("google_sub", ASCENDING),), "google_sub_1", sparse=True),
+    IndexSpec("users", (("verification_token", ASCENDING),), "verification_token_1", sparse=True),
+    IndexSpec("users", (("reset_token", ASCENDING),), "reset_token_1", sparse=True),
+    IndexSpec("users", (("name_normalized", ASCENDING),), "name_normalized_1"),
+    IndexSpec("users", (("name_tokens", ASCENDING),), "name_tokens_1"),
+    IndexSpec("users", (("name_ngrams", ASCENDING),), "name_ngrams_1"),
+
+    # chats / messages
+    IndexSpec("chats", (("members", ASCENDING), ("created_at", DESCENDING)), "members_1_created_at_-1"),
+    IndexSpec("chats", (("invite_code", ASCENDING),), "invite_code_1", sparse=True),
+    IndexSpec("messages", (("chat_id", ASCENDING), ("server_timestamp", DESCENDING), ("_id", DESCENDING)), "chat_id_1_server_timestamp_-1__id_-1"),
+    IndexSpec("messages", (("author_id", ASCENDING),), "author_id_1"),
+    IndexSpec("messages", (("sender_id", ASCENDING),), "sender_id_1", sparse=True),
+    IndexSpec("message_reactions", (("message_id", ASCENDING), ("user_id", ASCENDING), ("type", ASCENDING)), "message_id_1_user_id_1_type_1"),
+    IndexSpec("message_reactions", (("message_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)), "message_id_1_created_at_1__id_1"),
+    IndexSpec("message_reactions", (("user_id", ASCENDING),), "user_id_1"),
+
+    # posts feed
+    IndexSpec("posts", (("author_id", ASCENDING), ("created_at", DESCENDING)), "author_id_1_created_at_-1"),
+    IndexSpec("posts", (("visibility", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)), "visibility_1_created_at_-1__id_-1"),
+    IndexSpec("posts", (("author_id", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)), "author_id_1_created_at_-1__id_-1_pull",
+              partial_filter={"fanout": "pull"}),
+    IndexSpec("timelines", (("user_id", ASCENDING), ("created_at", DESCENDING), ("post_id", DESCENDING)), "user_id_1_created_at_-1_post_id_-1"),
+    IndexSpec("timelines", (("post_id", ASCENDING),), "post_id_1"),
+    IndexSpec("timelines", (("author_id", ASCENDING),), "author_id_1"),
+    IndexSpec("post_reactions", (("post_id", ASCENDING), ("user_id", ASCENDING), ("type", ASCENDING)), "post_id_1_user_id_1_type_1"),
+    IndexSpec("comments", (("post_id", ASCENDING), ("created_at", ASCENDING), ("_id", ASCENDING)), "post_id_1_created_at_1__id_1"),
+    IndexSpec("comments", (("author_id", ASCENDING),), "author_id_1"),
+    IndexSpec("comments", (("id", ASCENDING),), "id_1", sparse=True),
+    IndexSpec("comment_likes", (("comment_id", ASCENDING), ("user_id", ASCENDING)), "comment_id_1_user_id_1"),
+
+    # friends
+    IndexSpec("friend_requests", (("recipient_id", ASCENDING), ("status", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)), "recipient_id_1_status_1_created_at_-1__id_-1"),
+    IndexSpec("friend_requests", (("sender_id", ASCENDING), ("recipient_id", ASCENDING), ("status", ASCENDING)), "sender_id_1_recipient_id_1_status_1"),
+    IndexSpec("friend_requests", (("from_user_id", ASCENDING), ("to_user_id", ASCENDING), ("status", ASCENDING)), "from_user_id_1_to_user_id_1_status_1", sparse=True),
+    IndexSpec("friend_requests", (("to_user_id", ASCENDING),), "to_user_id_1", sparse=True),
+    IndexSpec("friendships", (("user1_id", ASCENDING), ("user2_id", ASCENDING)), "user1_id_1_user2_id_1"),
+    IndexSpec("friendships", (("user2_id", ASCENDING),), "user2_id_1"),
+    IndexSpec("friends", (("user_id", ASCENDING), ("friend_id", ASCENDING)), "user_id_1_friend_id_1"),
+    IndexSpec("friends", (("friend_id", ASCENDING),), "friend_id_1"),
+    IndexSpec("blocked_users", (("blocker_id", ASCENDING), ("blocked_id", ASCENDING)), "blocker_id_1_blocked_id_1"),
+    IndexSpec("blocked_users", (("blocker_id", ASCENDING), ("blocked_at", DESCENDING), ("_id", DESCENDING)), "blocker_id_1_blocked_at_-1__id_-1"),
+
+    # community
+    IndexSpec("community_posts", (("category", ASCENDING), ("timestamp", DESCENDING), ("_id", DESCENDING)), "category_1_timestamp_-1__id_-1"),
+    IndexSpec("community_posts", (("timestamp", DESCENDING), ("_id", DESCENDING)), "timestamp_-1__id_-1"),
+    IndexSpec("community_posts", (("id", ASCENDING),), "id_1"),
+    IndexSpec("community_posts", (("author_id", ASCENDING),), "author_id_1"),
+    IndexSpec("community_replies", (("post_id", ASCENDING), ("timestamp", ASCENDING), ("_id", ASCENDING)), "post_id_1_timestamp_1__id_1"),
+    IndexSpec("community_replies", (("author_id", ASCENDING),), "author_id_1"),
+    IndexSpec("community_likes", (("post_id", ASCENDING), ("user_id", ASCENDING)), "post_id_1_user_id_1"),
+    IndexSpec("community_likes", (("user_id", ASCENDING),), "user_id_1"),
+    IndexSpec("community_shares", (("post_id", ASCENDING),), "post_id_1"),
+
+    # tasks
+    IndexSpec("tasks", (("user_id", ASCENDING), ("date", ASCENDING)), "user_id_1_date_1"),
+
+    # admin queues
+    IndexSpec("reports", (("status", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)), "status_1_created_at_-1__id_-1"),
+    IndexSpec("reports", (("type", ASCENDING), ("created_at", DESCENDING), ("_id", DESCENDING)), "type_1_created_at_-1__id_-1"),
+    IndexSpec("reports", (("created_at", DESCENDING), ("_id", DESCENDING)), "created_at_-1__id_-1"),
+    IndexSpec("reports", (("id", ASCENDING),), "id_1"),
+    IndexSpec("reports", (("reporter_id", ASCENDING),), "reporter_id_1"),
+    IndexSpec("deletion_requests", (("status", ASCENDING), ("requested_at", DESCENDING), ("_id", DESCENDING)), "status_1_requested_at_-1__id_-1"),
+    IndexSpec("deletion_requests", (("requested_at", DESCENDING), ("_id", DESCENDING)), "requested_at_-1__id_-1"),
+    IndexSpec("deletion_requests", (("id", ASCENDING), ("user_id", ASCENDING)), "id_1_user_id_1"),
+
+    # media
+    IndexSpec("media_blobs", (("refcount", ASCENDING), ("released_at", ASCENDING)), "refcount_1_released_at_1"),
+
+    # real-time event replay
+    IndexSpec("event_log", (("users", ASCENDING), ("_id", ASCENDING)), "users_1__id_1"),
+    IndexSpec("event_log", (("created_at", ASCENDING),), "created_at_1_ttl", expire_after_seconds=EVENT_LOG_RETENTION_SECONDS),
+
+    # presence shared between workers
+    IndexSpec("presence_sockets", (("user_id", ASCENDING),), "user_id_1"),
+    IndexSpec("presence_sockets", (("worker", ASCENDING),), "worker_1"),
+    IndexSpec("presence_sockets", (("updated_at", ASCENDING),), "updated_at_1_ttl", expire_after_seconds=PRESENCE_DOC_TTL_SECONDS),
+]
+
+QUERY_SHAPES: List[QueryShape] = [
+    QueryShape("login by email", "users", {"email": "x@example.com"}),
+    QueryShape("google sign-in", "users", {"google_sub": "x"}),
+    QueryShape("verify email", "users", {"verification_token": "x"}),
+    QueryShape("reset password", "users", {"reset_token": "x"}),
+    QueryShape("user search name prefix", "users", {"name_normalized": {"$regex": "^jo"}}),
+    QueryShape("user search word prefix", "users", {"name_tokens": {"$regex": "^jo"}}),
+    QueryShape("user search ngrams", "users", {"name_ngrams": {"$all": ["joh", "ohn"]}}),
+    QueryShape("list chats", "chats", {"members": "x"}, (("created_at", DESCENDING),)),
+    QueryShape("join chat by code", "chats", {"invite_code": "X"}),
+    QueryShape("chat history", "messages", {"chat_id": "x"}, (("server_timestamp", DESCENDING), ("_id", DESCENDING))),
+    QueryShape("chat history before cursor", "messages", {"chat_id": "x", "$or": [
+        {"server_timestamp": {"$lt": "2025-01-01T00:00:00+00:00"}},
+        {"server_timestamp": "2025-01-01T00:00:00+00:00", "_id": {"$lt": "x"}},
+    ]}, (("server_timestamp", DESCENDING), ("_id", DESCENDING))),
+    QueryShape("feed timeline", "timelines", {"user_id": "x"}, (("created_at", DESCENDING), ("post_id", DESCENDING))),
+    QueryShape("feed public posts", "posts", {"visibility": "public"}, (("created_at", DESCENDING), ("_id", DESCENDING))),
+    QueryShape("feed pulled posts", "posts", {"fanout": "pull", "author_id": {"$in": ["y"]}, "visibility": {"$in": ["public", "friends"]}},
+               (("created_at", DESCENDING), ("_id", DESCENDING))),
+    QueryShape("post comments", "comments", {"post_id": "x"}, (("created_at", ASCENDING), ("_id", ASCENDING))),
+    QueryShape("pending friend requests", "friend_requests", {"recipient_id": "x", "status": "pending"}, (("created_at", DESCENDING), ("_id", DESCENDING))),
+    QueryShape("duplicate friend request", "friend_requests", {"sender_id": "x", "recipient_id": "y", "status": "pending"}),
+    QueryShape("friends list", "friendships", {"$or": [{"user1_id": "x"}, {"user2_id": "x"}]}),
+    QueryShape("blocked users", "blocked_users", {"blocker_id": "x"}, (("blocked_at", DESCENDING), ("_id", DESCENDING))),
+    QueryShape("community posts by category", "community_posts", {"category": "x"}, (("timestamp", DESCENDING), ("_id", DESCENDING))),
+    QueryShape("community posts", "community_posts", {}, (("timestamp", DESCENDING), ("_id", DESCENDING))),
+    QueryShape("community replies", "community_replies", {"post_id": "x"}, (("timestamp", ASCENDING), ("_id", ASCENDING))),
+    QueryShape("message reactions", "message_reactions", {"message_id": "x"}, (("created_at", ASCENDING), ("_id", ASCENDING))),
+    QueryShape("admin reports", "reports", {"status": "pending"}, (("created_at", DESCENDING), ("_id", DESCENDING))),
+    QueryShape("event replay", "event_log", {"users": "x", "_id": {"$gt": "0"}}, (("_id", ASCENDING),)),
+    QueryShape("admin deletion requests", "deletion_requests", {"status": "pending"}, (("requested_at", DESCENDING), ("_id", DESCENDING))),
+]
+
+
+class IndexService:
+    """Applies and audits the declarative index registry"""
+
+    def __init__(self, indexes: List[IndexSpec], query_shapes: List[QueryShape]):
+        self.indexes = indexes
+        self.query_shapes = query_shapes
+
+    def by_collection(self) -> Dict[str, List[IndexSpec]]:
+        grouped: Dict[str, List[IndexSpec]] = {}
+        for spec in self.indexes:
+            grouped.setdefault(spec.collection, []).append(spec)
+        return grouped
+
+    async def ensure_indexes(self, db) -> Dict[str, List[str]]:
+        """Create every registered index. Safe to run on every startup."""
+        created: Dict[str, List[str]] = {}
+        for collection, specs in self.by_collection().items():
+            try:
+                names = await db[collection].create_indexes([spec.to_model() for spec in specs])
+                created[collection] = names
+            except OperationFailure as e:
+                if e.code not in INDEX_CONFLICT_CODES:
+                    raise
+                # An index with the same keys exists under another name/options -
+                # create the rest one by one so a single conflict doesn't block them.
+                logger.warning(f"⚠️ Index conflict on {collection}: {e}")
+                created[collection] = []
+                for spec in specs:
+                    try:
+                        created[collection].extend(await db[collection].create_indexes([spec.to_model()]))
+                    except OperationFailure as inner:
+                        if inner.code not in INDEX_CONFLICT_CODES:
+                            raise
+                        logger.warning(f"⚠️ Skipping index {collection}.{spec.name}: {inner}")
+        logger.info(f"✅ Ensured {len(self.indexes)} indexes across {len(created)} collections")
+        return created
+
+    async def report(self, db) -> Dict[str, Dict[str, List[str]]]:
+        """Compare the registry with the live database.
+
+        Returns per collection the registered indexes that are missing, the
+        indexes that exist but are not registered, and indexes that have not
+        served a single operation since the server last restarted.
+        """
+        result: Dict[str, Dict[str, List[str]]] = {}
+        existing_collections = set(await db.list_collection_names())
+        grouped = self.by_collection()
+
+        for collection in sorted(existing_collections | set(grouped)):
+            registered = {spec.name for spec in grouped.get(collection, [])}
+            live: Dict[str, int] = {}
+            if collection in existing_collections:
+                async for stats in db[collection].aggregate([{"$indexStats": {}}]):
+                    live[stats["name"]] = int(stats.get("accesses", {}).get("ops", 0))
+
+            missing = sorted(registered - set(live))
+            extra = sorted(name for name in live if name not in registered and name != "_id_")
+            unused = sorted(name for name, ops in live.items() if ops == 0 and name != "_id_")
+            if missing or extra or unused:
+                result[collection] = {"missing": missing, "extra": extra, "unused": unused}
+        return result
+
+    async def explain(self, db) -> List[Dict[str, Any]]:
+        """Run explain() on every known query shape and flag collection scans"""
+        results = []
+        for shape in self.query_shapes:
+            cursor = db[shape.collection].find(shape.filter)
+            if shape.sort:
+                cursor = cursor.sort(list(shape.sort))
+            plan = await cursor.explain()
+            stages = _collect_stages(plan.get("queryPlanner", {}).get("winningPlan", {}))
+            results.append({
+                "name": shape.name,
+                "collection": shape.collection,
+                "stages": stages,
+                "collscan": "COLLSCAN" in stages,
+            })
+        return results
+
+
+def _collect_stages(plan: Dict[str, Any]) -> List[str]:
+    """Flatten the stage names of a (possibly nested) winning plan"""
+    stages = []
+    if "stage" in plan:
+        stages.append(plan["stage"])
+    for key in ("inputStage", "queryPlan"):
+        if isinstance(plan.get(key), dict):
+            stages.extend(_collect_stages(plan[key]))
+    for child in plan.get("inputStages", []):
+        stages.extend(_collect_stages(child))
+    return stages
+
+
+# Singleton instance
+index_service = IndexService(INDEXES, QUERY_SHAPES)
+
+
+async def _run_cli(command: str) -> int:
+    from dotenv import load_dotenv
+    from motor.motor_asyncio import AsyncIOMotorClient
+
+    load_dotenv(os.path.join(os.path.dirname(__file__), "..", "..", ".env"))
+    mongo_url = os.environ.get("MONGO_URL")
+    if not mongo_url:
+        print("❌ MONGO_URL environment variable is required")
+        return 2
+
+    client = AsyncIOMotorClient(mongo_url, serverSelectionTimeoutMS=5000)
+    db = client[os.environ.get("DB_NAME", "adhders_social_club")]
+    exit_code = 0
+    try:
+        if command == "ensure":
+            created = await index_service.ensure_indexes(db)
+            for collection, names in sorted(created.items()):
+                print(f"✅ {collection}: {', '.join(map(str, names))}")
+        elif command == "report":
+            report = await index_service.report(db)
+            if not report:
+                print("✅ All registered indexes exist and are in use")
+            for collection, problems in report.items():
+                for kind in ("missing", "extra", "unused"):
+                    for name in problems[kind]:
+                        print(f"{kind.upper():8} {collection}.{name}")
+                if problems["missing"]:
+                    exit_code = 1
+        elif command == "explain":
+            for result in await index_service.explain(db):
+                marker = "❌ COLLSCAN" if result["collscan"] else "✅"
+                print(f"{marker} {result['collection']}: {result['name']} [{' > '.join(result['stages'])}]")
+                if result["collscan"]:
+                    exit_code = 1
+    finally:
+        client.close()
+    return exit_code
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Manage MongoDB indexes for the ADHDers API")
+    parser.add_argument("command", choices=["ensure", "report", "explain"])
+    args = parser.parse_args()
+    raise SystemExit(asyncio.run(_run_cli(args.command)))
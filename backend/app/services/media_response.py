@@ -0,0 +1,148 @@
+"""Cacheable, seekable responses for uploaded media.
+
+Upload filenames are unique and a file is never rewritten under the same name,
+so media responses are marked immutable and carry a strong ETag. Conditional
+requests (If-None-Match / If-Modified-Since) get a 304, and single byte
+ranges get a 206 so audio and video players can seek without downloading the
+whole file.
+
+Every response carries X-Content-Type-Options: nosniff, and anything that is
+not an image, audio or video is sent as an attachment, so an uploaded file is
+never rendered as a page on the API's origin.
+"""
+
+import hashlib
+import os
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, Optional, Tuple
+
+from aiofiles import open as aio_open
+from fastapi import HTTPException, Request
+from fastapi.responses import FileResponse, Response, StreamingResponse
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# For stand-in responses that will later be replaced (e.g. a derivative not rendered yet)
+SHORT_CACHE_CONTROL = "public, max-age=60"
+RANGE_CHUNK_SIZE = 64 * 1024
+INLINE_MEDIA_PREFIXES = ("image/", "audio/", "video/")
+
+
+def make_etag(stat: os.stat_result, name: str) -> str:
+    raw = f"{name}:{stat.st_size}:{stat.st_mtime_ns}".encode("utf-8")
+    return '"' + hashlib.sha256(raw).hexdigest()[:32] + '"'
+
+
+def _etag_matches(header: str, etag: str) -> bool:
+    if header.strip() == "*":
+        return True
+    # Weak comparison is what If-None-Match calls for
+    candidates = [tag.strip().removeprefix("W/") for tag in header.split(",")]
+    return etag in candidates
+
+
+def _not_modified(request: Request, etag: str, stat: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since
+        return _etag_matches(if_none_match, etag)
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+        return int(stat.st_mtime) <= since
+    return False
+
+
+def parse_range(header: str, size: int) -> Optional[Tuple[int, int]]:
+    """Parse a single `bytes=` range into inclusive (start, end).
+
+    Returns None when the header should be ignored (malformed or multiple
+    ranges - the full file is served instead). Raises ValueError when the
+    range cannot be satisfied.
+    """
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec or size == 0:
+        return None
+    start_text, sep, end_text = spec.strip().partition("-")
+    if not sep:
+        return None
+    try:
+        start = int(start_text) if start_text else None
+        end = int(end_text) if end_text else None
+    except ValueError:
+        return None
+    if (start is not None and start < 0) or (end is not None and end < 0):
+        return None
+
+    if start is None:
+        # Suffix range: the last N bytes
+        if end is None:
+            return None
+        if end == 0:
+            raise ValueError("Range not satisfiable")
+        return max(size - end, 0), size - 1
+    if end is not None and start > end:
+        # An invalid range spec is ignored, not unsatisfiable (RFC 9110 14.1.1)
+        return None
+    if start >= size:
+        raise ValueError("Range not satisfiable")
+    end = size - 1 if end is None else end
+    return start, min(end, size - 1)
+
+
+async def _file_range(path, start: int, end: int):
+    remaining = end - start + 1
+    async with aio_open(path, "rb") as f:
+        await f.seek(start)
+        while remaining > 0:
+            chunk = await f.read(min(RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+
+def media_response(request: Request, path, media_type: str, filename: str, not_found: str = "File not found",
+                   vary: Optional[str] = None, cache_control: str = IMMUTABLE_CACHE_CONTROL) -> Response:
+    """Serve an uploaded file with validators, immutable caching and Range support"""
+    try:
+        stat = os.stat(path)
+    except (FileNotFoundError, NotADirectoryError):
+        raise HTTPException(status_code=404, detail=not_found)
+
+    etag = make_etag(stat, filename)
+    headers: Dict[str, str] = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        "Accept-Ranges": "bytes",
+        "X-Content-Type-Options": "nosniff",
+    }
+    if not media_type.startswith(INLINE_MEDIA_PREFIXES):
+        headers["Content-Disposition"] = "attachment"
+    if vary:
+        headers["Vary"] = vary
+
+    if _not_modified(request, etag, stat):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (if_range is None or if_range.strip() in (etag, headers["Last-Modified"])):
+        try:
+            byte_range = parse_range(range_header, stat.st_size)
+        except ValueError:
+            headers["Content-Range"] = f"bytes */{stat.st_size}"
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+            headers["Content-Length"] = str(end - start + 1)
+            return StreamingResponse(
+                _file_range(path, start, end), status_code=206, media_type=media_type, headers=headers
+            )
+
+    return FileResponse(path=path, media_type=media_type, filename=filename, stat_result=stat, headers=headers)
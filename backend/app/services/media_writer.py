@@ -0,0 +1,144 @@
+"""Non-blocking, atomic writes into the media store.
+
+Every upload is streamed through the shared media_writer (the blob store
+stages its uploads here). Writes run on a small bounded thread pool so a slow
+disk only delays the upload itself, and each file is written to a temporary
+name in the target directory and renamed into place, so readers never see a
+partially written file.
+
+Files live under UPLOAD_DIR (default ./uploads) in one directory per category
+("profiles", "voices", "chat"), matching the /api/uploads/{category} routes.
+Content-addressed blobs live under "blobs", sharded by the first two
+characters of their name.
+"""
+
+import asyncio
+import hashlib
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, Optional
+
+MEDIA_CATEGORIES = ("profiles", "voices", "chat", "blobs")
+CHUNK_SIZE = 256 * 1024
+
+
+class MediaTooLarge(ValueError):
+    """The upload crossed its size limit while streaming"""
+
+
+@dataclass
+class StoredMedia:
+    path: Path
+    size: int
+    sha256: str
+
+
+async def iter_upload(upload, chunk_size: int = CHUNK_SIZE) -> AsyncIterator[bytes]:
+    """Read an UploadFile (or any object with async read(n)) in fixed-size chunks"""
+    while True:
+        chunk = await upload.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+
+
+class MediaWriter:
+    """Writes media files off the event loop"""
+
+    def __init__(self, root: str, max_workers: int = 4, fsync: bool = False):
+        self.root = Path(root)
+        self.max_workers = max_workers
+        self.fsync = fsync
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="media-writer")
+        self.files_written = 0
+        self.bytes_written = 0
+        self.pending = 0
+
+    def path_for(self, category: str, filename: str) -> Path:
+        if category not in MEDIA_CATEGORIES:
+            raise ValueError(f"Unknown media category: {category}")
+        # Filenames are generated server side, but never let one escape its directory
+        name = Path(filename).name
+        if category == "blobs":
+            return self.root / category / name[:2] / name
+        return self.root / category / name
+
+    def _temp_path(self, path: Path) -> Path:
+        return path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+
+    async def run_io(self, fn, *args):
+        """Run a blocking filesystem call on the writer pool"""
+        return await self._run(fn, *args)
+
+    async def _run(self, fn, *args):
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+        finally:
+            self.pending -= 1
+
+    async def write_stream(self, category: str, filename: str, chunks: AsyncIterator[bytes],
+                           max_bytes: Optional[int] = None) -> StoredMedia:
+        """Stream chunks to category/filename, hashing as they go.
+
+        Only one chunk is held in memory at a time. Raises MediaTooLarge as
+        soon as more than max_bytes have arrived; the partial file is removed.
+        """
+        path = self.path_for(category, filename)
+        tmp = self._temp_path(path)
+        digest = hashlib.sha256()
+        size = 0
+
+        def open_tmp():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            return open(tmp, "wb")
+
+        def write_chunk(f, chunk: bytes):
+            f.write(chunk)
+            digest.update(chunk)
+
+        def finish(f):
+            if self.fsync:
+                f.flush()
+                os.fsync(f.fileno())
+            f.close()
+            os.replace(tmp, path)
+
+        f = await self._run(open_tmp)
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if max_bytes is not None and size > max_bytes:
+                    raise MediaTooLarge(f"Upload exceeds {max_bytes} bytes")
+                await self._run(write_chunk, f, chunk)
+            await self._run(finish, f)
+        except BaseException:
+            f.close()
+            tmp.unlink(missing_ok=True)
+            raise
+
+        self.files_written += 1
+        self.bytes_written += size
+        return StoredMedia(path=path, size=size, sha256=digest.hexdigest())
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "pending": self.pending,
+            "files_written": self.files_written,
+            "bytes_written": self.bytes_written,
+        }
+
+
+# Singleton instance
+media_writer = MediaWriter(
+    root=os.getenv("UPLOAD_DIR", "./uploads"),
+    max_workers=int(os.getenv("MEDIA_WRITER_WORKERS", "4")),
+    fsync=os.getenv("MEDIA_WRITER_FSYNC", "false").lower() == "true",
+)
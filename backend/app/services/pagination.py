@@ -0,0 +1,132 @@
+"""Keyset (cursor) pagination helpers shared by the list endpoints.
+
+A cursor is an opaque, URL-safe token holding the sort-key values of the last
+document on a page. The next page is fetched with a range condition on those
+keys instead of skip(), so every page is a bounded index range scan.
+
+Listings over a small, ranked in-memory window (user search) use an offset
+cursor instead, built with the same encoding.
+"""
+
+import base64
+import json
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from bson import ObjectId
+
+SortSpec = Sequence[Tuple[str, int]]
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+_DATETIME_TAG = "$dt"
+_OBJECT_ID_TAG = "$oid"
+
+
+def clamp_limit(limit: Optional[int], default: int = DEFAULT_PAGE_SIZE, maximum: int = MAX_PAGE_SIZE) -> int:
+    """Bound a client supplied page size"""
+    if not limit or limit < 1:
+        return default
+    return min(limit, maximum)
+
+
+def _encode_value(value: Any) -> Any:
+    if isinstance(value, datetime):
+        return {_DATETIME_TAG: value.isoformat()}
+    if isinstance(value, ObjectId):
+        return {_OBJECT_ID_TAG: str(value)}
+    return value
+
+
+def _decode_value(value: Any) -> Any:
+    if isinstance(value, dict) and _DATETIME_TAG in value:
+        return datetime.fromisoformat(value[_DATETIME_TAG])
+    if isinstance(value, dict) and _OBJECT_ID_TAG in value:
+        return ObjectId(value[_OBJECT_ID_TAG])
+    return value
+
+
+def _get_path(doc: Dict[str, Any], path: str) -> Any:
+    value: Any = doc
+    for part in path.split("."):
+        value = value.get(part) if isinstance(value, dict) else None
+    return value
+
+
+def encode_cursor(doc: Dict[str, Any], sort: SortSpec) -> str:
+    """Build the cursor that points just past `doc` for the given sort"""
+    values = [_encode_value(_get_path(doc, field)) for field, _ in sort]
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(token: str, sort: SortSpec) -> List[Any]:
+    """Decode a cursor produced by encode_cursor. Raises ValueError if malformed."""
+    try:
+        padded = token + "=" * (-len(token) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+    except Exception as e:
+        raise ValueError(f"Malformed cursor: {e}")
+    if not isinstance(values, list) or len(values) != len(sort):
+        raise ValueError("Cursor does not match this listing")
+    return [_decode_value(v) for v in values]
+
+
+_OFFSET_SORT = (("offset", 1),)
+
+
+def encode_offset_cursor(offset: int) -> str:
+    return encode_cursor({"offset": offset}, _OFFSET_SORT)
+
+
+def decode_offset_cursor(token: str) -> int:
+    """Offset held by an encode_offset_cursor token. Raises ValueError if malformed."""
+    offset = decode_cursor(token, _OFFSET_SORT)[0]
+    # bool is an int subclass; floats and negatives are never produced by the encoder
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 0:
+        raise ValueError("Cursor offset must be a non-negative integer")
+    return offset
+
+
+def keyset_condition(sort: SortSpec, values: Sequence[Any]) -> Dict[str, Any]:
+    """Filter matching documents strictly after `values` in `sort` order.
+
+    For sort [(a, -1), (b, -1)] and values [x, y] this produces
+    {"$or": [{a: {"$lt": x}}, {a: x, b: {"$lt": y}}]}.
+    """
+    branches = []
+    for i, (field, direction) in enumerate(sort):
+        branch: Dict[str, Any] = {prev_field: values[j] for j, (prev_field, _) in enumerate(sort[:i])}
+        branch[field] = {"$gt" if direction > 0 else "$lt": values[i]}
+        branches.append(branch)
+    return branches[0] if len(branches) == 1 else {"$or": branches}
+
+
+def reverse_sort(sort: SortSpec) -> List[Tuple[str, int]]:
+    return [(field, -direction) for field, direction in sort]
+
+
+async def fetch_page(
+    collection,
+    query: Dict[str, Any],
+    sort: SortSpec,
+    limit: int,
+    cursor: Optional[str] = None,
+    projection: Optional[Dict[str, Any]] = None,
+) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    """Fetch one page of `collection` and the cursor for the page after it.
+
+    Reads limit + 1 documents to know whether another page exists; the
+    returned next cursor is None on the last page.
+    """
+    page_query = dict(query)
+    if cursor:
+        condition = keyset_condition(sort, decode_cursor(cursor, sort))
+        page_query = {"$and": [query, condition]} if query else condition
+
+    docs = await collection.find(page_query, projection).sort(list(sort)).limit(limit + 1).to_list(limit + 1)
+    if len(docs) > limit:
+        docs = docs[:limit]
+        return docs, encode_cursor(docs[-1], sort)
+    return docs, None
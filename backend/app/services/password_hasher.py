@@ -0,0 +1,90 @@
+"""Password hashing off the event loop.
+
+bcrypt deliberately costs 100-300 ms of CPU per hash or verify. Running it
+inside an async handler stalls every other request and WebSocket on the
+worker, so all hashing goes through a small dedicated thread pool (bcrypt
+releases the GIL while it works). The pool caps concurrency; requests beyond
+it wait in a bounded queue and are rejected with PasswordHasherBusy once that
+queue is full, so a login storm only slows down logins.
+"""
+
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict
+
+from passlib.context import CryptContext
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many hash operations are already waiting"""
+
+
+class PasswordHasher:
+    """Bounded executor for CryptContext hash/verify"""
+
+    def __init__(self, context: CryptContext, max_workers: int = 2, max_pending: int = 64):
+        self.context = context
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="bcrypt")
+        self.pending = 0
+        self.in_flight = 0
+        self.peak_pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self._wait_seconds = 0.0
+
+    async def _run(self, fn: Callable[..., Any], *args) -> Any:
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            raise PasswordHasherBusy("Too many password operations in progress")
+
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        queued_at = time.monotonic()
+
+        def work():
+            # Runs on a pool thread: the job has left the queue and started
+            self._wait_seconds += time.monotonic() - queued_at
+            self.in_flight += 1
+            try:
+                return fn(*args)
+            finally:
+                self.in_flight -= 1
+
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, work)
+        finally:
+            self.pending -= 1
+            self.completed += 1
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self.context.hash, password)
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        return await self._run(self.context.verify, password, password_hash)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "max_pending": self.max_pending,
+            "in_flight": self.in_flight,
+            "queue_depth": max(self.pending - self.in_flight, 0),
+            "peak_pending": self.peak_pending,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "avg_wait_ms": round(self._wait_seconds / self.completed * 1000, 2) if self.completed else 0.0,
+        }
+
+
+# Singleton instance
+password_hasher = PasswordHasher(
+    CryptContext(schemes=["bcrypt"], deprecated="auto"),
+    max_workers=int(os.getenv("PASSWORD_HASH_WORKERS", "2")),
+    max_pending=int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64")),
+)
@@ -0,0 +1,289 @@
+"""Debounced, batched online presence.
+
+Mobile clients flap: a socket drops and comes back a second later, often
+several times a minute. Sending presence:update to every friend on every
+connect and disconnect turns that into a storm of friends × reconnects
+messages. This service does the following:
+
+- counts connections per user, so a second tab or device does not toggle
+  anything;
+- waits offline_grace_seconds after the last socket closes before a user
+  goes offline, so a quick reconnect is invisible to friends;
+- treats a user as offline once no heartbeat (client ping) has been seen for
+  heartbeat_ttl_seconds, even if a half-dead socket is still registered;
+- collects changes and flushes them every flush_interval. Each friend gets
+  one message per flush with only the net changes: presence:update for a
+  single change, presence:diff with an {user_id: online} map for several;
+- caches friend lists for friends_ttl_seconds. Call invalidate_friends()
+  when a friendship changes.
+
+Connection counts and heartbeats are kept by the worker that holds the
+sockets. Each worker also writes one `presence_sockets` document per user it
+has online (keyed by user and worker) and refreshes them while it runs. A
+user going offline on one worker is only announced when no other worker
+still has them online, and online_map() answers for users on any worker.
+Documents of a worker that stopped refreshing are ignored after
+heartbeat_ttl_seconds and removed by a TTL index.
+"""
+
+import asyncio
+import logging
+import os
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+PRESENCE_DOC_TTL_SECONDS = 3600
+
+Publish = Callable[[Iterable[str], Dict[str, Any]], Awaitable[Any]]
+LoadFriends = Callable[[str], Awaitable[List[str]]]
+
+
+class PresenceService:
+    """Connection refcounts, heartbeats and coalesced friend notifications"""
+
+    def __init__(self, offline_grace_seconds: float = 10.0, heartbeat_ttl_seconds: float = 90.0,
+                 flush_interval: float = 1.0, friends_ttl_seconds: float = 60.0):
+        self.offline_grace_seconds = offline_grace_seconds
+        self.heartbeat_ttl_seconds = heartbeat_ttl_seconds
+        self.flush_interval = flush_interval
+        self.friends_ttl_seconds = friends_ttl_seconds
+        self._refcounts: Dict[str, int] = {}
+        self._last_seen: Dict[str, float] = {}
+        self._offline_at: Dict[str, float] = {}
+        self._online: Set[str] = set()
+        # Users whose state changed since the last flush
+        self._dirty: Set[str] = set()
+        # Users this worker last reported online (to friends and the shared store)
+        self._reported: Set[str] = set()
+        self._friends: Dict[str, Tuple[float, List[str]]] = {}
+        self._publish: Optional[Publish] = None
+        self._load_friends: Optional[LoadFriends] = None
+        self._task: Optional[asyncio.Task] = None
+        self.worker_id = uuid.uuid4().hex[:8]
+        self._db = None
+        self._last_refresh = 0.0
+        self.flushes = 0
+        self.notifications = 0
+        self.suppressed_flaps = 0
+        self.friend_cache_hits = 0
+        self.friend_cache_misses = 0
+        self.held_elsewhere = 0
+        self.store_errors = 0
+
+    def start(self, publish: Publish, load_friends: LoadFriends, db=None):
+        self._publish = publish
+        self._load_friends = load_friends
+        self._db = db
+        self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+        if self._db is not None:
+            try:
+                await self._db.presence_sockets.delete_many({"worker": self.worker_id})
+            except Exception as e:
+                logger.error(f"❌ Could not clear presence of worker {self.worker_id}: {e}")
+
+    def is_online(self, user_id: str) -> bool:
+        """Online on this worker; see online_map() for all workers"""
+        return user_id in self._online
+
+    async def remote_online(self, user_ids: Iterable[str]) -> Set[str]:
+        """Which of these users another live worker has online"""
+        user_ids = list(user_ids)
+        if self._db is None or not user_ids:
+            return set()
+        fresh = datetime.now(timezone.utc) - timedelta(seconds=self.heartbeat_ttl_seconds)
+        try:
+            docs = await self._db.presence_sockets.find(
+                {"user_id": {"$in": user_ids}, "worker": {"$ne": self.worker_id}, "updated_at": {"$gte": fresh}},
+                {"user_id": 1}
+            ).to_list(None)
+        except Exception as e:
+            self.store_errors += 1
+            logger.error(f"❌ Could not read shared presence: {e}")
+            return set()
+        return {doc["user_id"] for doc in docs}
+
+    async def online_map(self, user_ids: Iterable[str]) -> Dict[str, bool]:
+        """{user_id: online} across all workers"""
+        user_ids = list(user_ids)
+        elsewhere = await self.remote_online(u for u in user_ids if u not in self._online)
+        return {user_id: user_id in self._online or user_id in elsewhere for user_id in user_ids}
+
+    def _set(self, user_id: str, online: bool):
+        if online:
+            self._online.add(user_id)
+        else:
+            self._online.discard(user_id)
+        self._dirty.add(user_id)
+
+    def connect(self, user_id: str):
+        self._refcounts[user_id] = self._refcounts.get(user_id, 0) + 1
+        self._last_seen[user_id] = time.monotonic()
+        if self._offline_at.pop(user_id, None) is not None:
+            # Reconnected inside the grace period: friends never saw it leave
+            self.suppressed_flaps += 1
+        if user_id not in self._online:
+            self._set(user_id, True)
+
+    def disconnect(self, user_id: str):
+        remaining = self._refcounts.get(user_id, 0) - 1
+        if remaining > 0:
+            self._refcounts[user_id] = remaining
+            return
+        self._refcounts.pop(user_id, None)
+        self._offline_at[user_id] = time.monotonic() + self.offline_grace_seconds
+
+    def heartbeat(self, user_id: str):
+        self._last_seen[user_id] = time.monotonic()
+        if self._refcounts.get(user_id) and user_id not in self._online:
+            # A socket that went quiet is talking again
+            self._set(user_id, True)
+
+    async def friends_of(self, user_id: str) -> List[str]:
+        cached = self._friends.get(user_id)
+        now = time.monotonic()
+        if cached and cached[0] > now:
+            self.friend_cache_hits += 1
+            return cached[1]
+        self.friend_cache_misses += 1
+        friends = await self._load_friends(user_id)
+        self._friends[user_id] = (now + self.friends_ttl_seconds, friends)
+        return friends
+
+    def invalidate_friends(self, *user_ids: str):
+        for user_id in user_ids:
+            self._friends.pop(user_id, None)
+
+    def _expire(self, now: float):
+        for user_id, deadline in list(self._offline_at.items()):
+            if deadline <= now:
+                del self._offline_at[user_id]
+                self._last_seen.pop(user_id, None)
+                self._set(user_id, False)
+        stale = now - self.heartbeat_ttl_seconds
+        for user_id in list(self._online):
+            if self._refcounts.get(user_id) and self._last_seen.get(user_id, now) < stale:
+                self._set(user_id, False)
+        # Drop cached friend lists nobody has used for a while
+        for user_id, (expires, _) in list(self._friends.items()):
+            if expires <= now:
+                del self._friends[user_id]
+
+    async def _write_shared(self, went_online: List[str], went_offline: List[str]):
+        """Record this worker's changes in the shared store"""
+        if self._db is None or not (went_online or went_offline):
+            return
+        sockets = self._db.presence_sockets
+        now = datetime.now(timezone.utc)
+        try:
+            if went_offline:
+                await sockets.delete_many({"_id": {"$in": [f"{u}:{self.worker_id}" for u in went_offline]}})
+            await asyncio.gather(*(
+                sockets.update_one(
+                    {"_id": f"{user_id}:{self.worker_id}"},
+                    {"$set": {"user_id": user_id, "worker": self.worker_id, "updated_at": now}},
+                    upsert=True,
+                )
+                for user_id in went_online
+            ))
+        except Exception as e:
+            self.store_errors += 1
+            logger.error(f"❌ Could not write shared presence: {e}")
+
+    async def _refresh_shared(self, now: float):
+        """Keep this worker's documents fresh so other workers keep counting them"""
+        if self._db is None or now - self._last_refresh < self.heartbeat_ttl_seconds / 3:
+            return
+        self._last_refresh = now
+        try:
+            await self._db.presence_sockets.update_many(
+                {"worker": self.worker_id}, {"$set": {"updated_at": datetime.now(timezone.utc)}}
+            )
+        except Exception as e:
+            self.store_errors += 1
+            logger.error(f"❌ Could not refresh shared presence: {e}")
+
+    async def flush(self):
+        now = time.monotonic()
+        self._expire(now)
+        await self._refresh_shared(now)
+        if not self._dirty:
+            return
+        changed, self._dirty = self._dirty, set()
+        went_online: List[str] = []
+        went_offline: List[str] = []
+        for user_id in changed:
+            online = user_id in self._online
+            if (user_id in self._reported) == online:
+                # Went offline and back (or the reverse) within one flush
+                continue
+            if online:
+                self._reported.add(user_id)
+                went_online.append(user_id)
+            else:
+                self._reported.discard(user_id)
+                went_offline.append(user_id)
+
+        # Written before the read, so of two workers dropping a user at once
+        # at least one sees the other gone and announces it
+        await self._write_shared(went_online, went_offline)
+        elsewhere = await self.remote_online(went_offline)
+        self.held_elsewhere += len(elsewhere)
+
+        by_friend: Dict[str, Dict[str, bool]] = {}
+        for user_id in went_online + [u for u in went_offline if u not in elsewhere]:
+            online = user_id in self._online
+            try:
+                friends = await self.friends_of(user_id)
+            except Exception as e:
+                logger.error(f"❌ Could not load friends of {user_id} for presence: {e}")
+                continue
+            for friend_id in friends:
+                by_friend.setdefault(friend_id, {})[user_id] = online
+
+        self.flushes += 1
+        for friend_id, diff in by_friend.items():
+            if len(diff) == 1:
+                (user_id, online), = diff.items()
+                payload = {"type": "presence:update", "user_id": user_id, "online": online}
+            else:
+                payload = {"type": "presence:diff", "online": diff}
+            await self._publish([friend_id], payload)
+            self.notifications += 1
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"❌ Presence flush failed: {e}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "online": len(self._online),
+            "pending_offline": len(self._offline_at),
+            "cached_friend_lists": len(self._friends),
+            "flushes": self.flushes,
+            "notifications": self.notifications,
+            "suppressed_flaps": self.suppressed_flaps,
+            "friend_cache_hits": self.friend_cache_hits,
+            "friend_cache_misses": self.friend_cache_misses,
+            "held_elsewhere": self.held_elsewhere,
+            "store_errors": self.store_errors,
+        }
+
+
+# Singleton instance
+presence_service = PresenceService(
+    offline_grace_seconds=float(os.getenv("PRESENCE_OFFLINE_GRACE_SECONDS", "10")),
+    heartbeat_ttl_seconds=float(os.getenv("PRESENCE_HEARTBEAT_TTL_SECONDS", "90")),
+    flush_interval=float(os.getenv("PRESENCE_FLUSH_INTERVAL_SECONDS", "1")),
+)
@@ -0,0 +1,210 @@
+"""Where media bytes are kept: local disk or an S3-compatible object store.
+
+The blob store hands finished files to a StorageBackend under keys like
+"blobs/ab/<sha256>.jpg". LocalStorageBackend keeps them under UPLOAD_DIR and
+the API serves them itself. S3StorageBackend puts them in a bucket (AWS, or
+any S3-compatible endpoint such as MinIO via S3_ENDPOINT_URL) and hands out
+presigned GET URLs, and presigned PUT URLs so clients can upload directly
+without streaming through the API workers.
+
+Select with STORAGE_BACKEND=local|s3.
+"""
+
+import asyncio
+import base64
+import logging
+import os
+import shutil
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from app.services.media_writer import media_writer
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PRESIGN_EXPIRES_SECONDS = 900
+
+
+class StorageBackend(ABC):
+    """Interface of a media storage backend"""
+
+    name = "base"
+    supports_presign = False
+
+    @abstractmethod
+    async def put_file(self, key: str, source: Path, content_type: Optional[str] = None) -> bool:
+        """Move a local file to `key`. Returns False if the key already existed."""
+
+    @abstractmethod
+    async def get_file(self, key: str, dest: Path) -> bool:
+        """Copy the object at `key` to a local file. Returns False if it does not exist."""
+
+    @abstractmethod
+    async def size(self, key: str) -> Optional[int]:
+        """Size of the object at `key`, or None if it does not exist"""
+
+    @abstractmethod
+    async def delete(self, key: str):
+        """Remove the object at `key`; a no-op if it does not exist"""
+
+    def presign_get(self, key: str, expires_in: int = DEFAULT_PRESIGN_EXPIRES_SECONDS) -> Optional[str]:
+        return None
+
+    def presign_put(self, key: str, content_type: str, sha256_hex: str,
+                    expires_in: int = DEFAULT_PRESIGN_EXPIRES_SECONDS) -> Optional[Dict[str, Any]]:
+        return None
+
+
+class LocalStorageBackend(StorageBackend):
+    """Objects are plain files under the media writer's root"""
+
+    name = "local"
+
+    def path_for(self, key: str) -> Path:
+        category, _, name = key.partition("/")
+        return media_writer.path_for(category, Path(name).name)
+
+    def _put(self, key: str, source: Path) -> bool:
+        final = self.path_for(key)
+        if final.exists():
+            source.unlink(missing_ok=True)
+            return False
+        final.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(source, final)
+        return True
+
+    async def put_file(self, key: str, source: Path, content_type: Optional[str] = None) -> bool:
+        return await media_writer.run_io(self._put, key, source)
+
+    async def get_file(self, key: str, dest: Path) -> bool:
+        try:
+            await media_writer.run_io(shutil.copyfile, self.path_for(key), dest)
+            return True
+        except FileNotFoundError:
+            return False
+
+    async def size(self, key: str) -> Optional[int]:
+        try:
+            return (await media_writer.run_io(os.stat, self.path_for(key))).st_size
+        except FileNotFoundError:
+            return None
+
+    async def delete(self, key: str):
+        path = self.path_for(key)
+        await media_writer.run_io(lambda: path.unlink(missing_ok=True))
+
+
+class S3StorageBackend(StorageBackend):
+    """Objects live in an S3-compatible bucket"""
+
+    name = "s3"
+    supports_presign = True
+
+    def __init__(self, bucket: str, endpoint_url: Optional[str] = None, region: Optional[str] = None,
+                 key_prefix: str = ""):
+        import boto3
+        from botocore.config import Config
+
+        self.bucket = bucket
+        self.key_prefix = key_prefix.strip("/")
+        self._client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            config=Config(signature_version="s3v4", retries={"max_attempts": 3, "mode": "standard"}),
+        )
+
+    def _key(self, key: str) -> str:
+        return f"{self.key_prefix}/{key}" if self.key_prefix else key
+
+    async def _call(self, fn, *args, **kwargs):
+        # boto3 is blocking; keep it off the event loop
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+    async def size(self, key: str) -> Optional[int]:
+        from botocore.exceptions import ClientError
+
+        try:
+            head = await self._call(self._client.head_object, Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        return head["ContentLength"]
+
+    async def put_file(self, key: str, source: Path, content_type: Optional[str] = None) -> bool:
+        try:
+            if await self.size(key) is not None:
+                return False
+            extra = {"CacheControl": "public, max-age=31536000, immutable"}
+            if content_type:
+                extra["ContentType"] = content_type
+            await self._call(self._client.upload_file, str(source), self.bucket, self._key(key), ExtraArgs=extra)
+            return True
+        finally:
+            source.unlink(missing_ok=True)
+
+    async def get_file(self, key: str, dest: Path) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            await self._call(self._client.download_file, self.bucket, self._key(key), str(dest))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+        return True
+
+    async def delete(self, key: str):
+        await self._call(self._client.delete_object, Bucket=self.bucket, Key=self._key(key))
+
+    def presign_get(self, key: str, expires_in: int = DEFAULT_PRESIGN_EXPIRES_SECONDS) -> Optional[str]:
+        return self._client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket, "Key": self._key(key)}, ExpiresIn=expires_in
+        )
+
+    def presign_put(self, key: str, content_type: str, sha256_hex: str,
+                    expires_in: int = DEFAULT_PRESIGN_EXPIRES_SECONDS) -> Optional[Dict[str, Any]]:
+        # The signed checksum makes the store reject bytes that do not hash
+        # to the content address the client claimed
+        checksum = base64.b64encode(bytes.fromhex(sha256_hex)).decode("ascii")
+        url = self._client.generate_presigned_url(
+            "put_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": self._key(key),
+                "ContentType": content_type,
+                "ChecksumSHA256": checksum,
+                "CacheControl": "public, max-age=31536000, immutable",
+            },
+            ExpiresIn=expires_in,
+        )
+        return {
+            "url": url,
+            "method": "PUT",
+            "headers": {
+                "Content-Type": content_type,
+                "x-amz-checksum-sha256": checksum,
+                "Cache-Control": "public, max-age=31536000, immutable",
+            },
+            "expires_in": expires_in,
+        }
+
+
+def create_storage_backend() -> StorageBackend:
+    kind = os.getenv("STORAGE_BACKEND", "local").lower()
+    if kind == "s3":
+        backend = S3StorageBackend(
+            bucket=os.environ["S3_BUCKET"],
+            endpoint_url=os.getenv("S3_ENDPOINT_URL"),
+            region=os.getenv("S3_REGION"),
+            key_prefix=os.getenv("S3_KEY_PREFIX", ""),
+        )
+        logger.info(f"🪣 Media storage: S3 bucket {backend.bucket}")
+        return backend
+    return LocalStorageBackend()
+
+
+# Singleton instance
+storage_backend = create_storage_backend()
@@ -0,0 +1,222 @@
+"""Fan-out-on-write timelines for the personalized posts feed.
+
+Each user has a capped list of timeline entries (one small document per post)
+in the `timelines` collection. create_post writes an entry for the author and,
+in the background, for each of the author's friends. Two kinds of posts are
+not fanned out and are merged in when the feed is read instead:
+
+- public posts, which every user sees, read from the posts collection;
+- posts by authors with more friends than TIMELINE_FANOUT_MAX_RECIPIENTS,
+  flagged with fanout="pull" and read through a partial index.
+
+Timeline entries only carry ids and sort keys, so an edit needs no rewrite.
+A visibility change is pushed to the friends' timelines (visibility_changed),
+and posts are still hydrated and re-checked at read time; when that check
+filters posts out, the read fetches further back to fill the page.
+"""
+
+import logging
+import os
+import random
+from typing import Any, Dict, List, Sequence, Tuple
+
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+FRIEND_VISIBILITIES = ["public", "friends"]
+
+
+class TimelineService:
+    """Maintains and reads per-user feed timelines"""
+
+    def __init__(self, max_entries: int = 800, fanout_max_recipients: int = 2000,
+                 batch_size: int = 500, trim_sample_rate: float = 0.05):
+        self.max_entries = max_entries
+        self.fanout_max_recipients = fanout_max_recipients
+        self.batch_size = batch_size
+        self.trim_sample_rate = trim_sample_rate
+
+    # --- Write path ---
+
+    def uses_fanout(self, friend_ids: Sequence[str]) -> bool:
+        """Whether a post by an author with these friends is pushed to their timelines"""
+        return len(friend_ids) <= self.fanout_max_recipients
+
+    @staticmethod
+    def _entry(owner_id: str, post: Dict[str, Any]) -> Dict[str, Any]:
+        return {
+            "_id": f"{owner_id}:{post['_id']}",
+            "user_id": owner_id,
+            "post_id": post["_id"],
+            "author_id": post["author_id"],
+            "created_at": post["created_at"],
+        }
+
+    async def _insert_entries(self, db, entries: List[Dict[str, Any]]):
+        if not entries:
+            return
+        try:
+            await db.timelines.insert_many(entries, ordered=False)
+        except BulkWriteError as e:
+            # Re-delivering an entry that is already there is harmless
+            errors = [err for err in e.details.get("writeErrors", []) if err.get("code") != DUPLICATE_KEY_ERROR]
+            if errors:
+                raise
+
+    async def add_for_author(self, db, post: Dict[str, Any]):
+        """Put a new post on its author's own timeline"""
+        await self._insert_entries(db, [self._entry(post["author_id"], post)])
+        if random.random() < self.trim_sample_rate:
+            await self.trim(db, post["author_id"])
+
+    async def fan_out(self, db, post: Dict[str, Any], friend_ids: Sequence[str]) -> int:
+        """Push a post onto every friend's timeline. Returns the number of recipients."""
+        if post.get("visibility") not in FRIEND_VISIBILITIES or post.get("fanout") == "pull":
+            return 0
+
+        recipients = [fid for fid in friend_ids if fid != post["author_id"]]
+        for start in range(0, len(recipients), self.batch_size):
+            batch = recipients[start:start + self.batch_size]
+            await self._insert_entries(db, [self._entry(fid, post) for fid in batch])
+
+        # Trimming every recipient on every post would double the write cost;
+        # a sample keeps timelines near the cap on average.
+        for fid in recipients:
+            if random.random() < self.trim_sample_rate:
+                await self.trim(db, fid)
+
+        logger.info(f"📰 Fanned out post {post['_id']} to {len(recipients)} timelines")
+        return len(recipients)
+
+    async def backfill_author(self, db, owner_id: str, author_id: str, limit: int = 50):
+        """Copy an author's recent friend-visible posts onto a new friend's timeline"""
+        posts = await db.posts.find(
+            {"author_id": author_id, "visibility": {"$in": FRIEND_VISIBILITIES}},
+            {"_id": 1, "author_id": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(limit).to_list(limit)
+        await self._insert_entries(db, [self._entry(owner_id, post) for post in posts])
+
+    async def visibility_changed(self, db, post: Dict[str, Any], old_visibility: str,
+                                 friend_ids: Sequence[str]) -> int:
+        """Add or withdraw an edited post on friends' timelines. Returns entries added or removed."""
+        was_shared = old_visibility in FRIEND_VISIBILITIES
+        is_shared = post.get("visibility") in FRIEND_VISIBILITIES
+        if is_shared and not was_shared:
+            return await self.fan_out(db, post, friend_ids)
+        if was_shared and not is_shared:
+            result = await db.timelines.delete_many({"post_id": post["_id"], "user_id": {"$ne": post["author_id"]}})
+            logger.info(f"📰 Withdrew post {post['_id']} from {result.deleted_count} timelines")
+            return result.deleted_count
+        return 0
+
+    async def remove_post(self, db, post_id: str):
+        await db.timelines.delete_many({"post_id": post_id})
+
+    async def remove_user(self, db, user_id: str):
+        await db.timelines.delete_many({"user_id": user_id})
+        await db.timelines.delete_many({"author_id": user_id})
+
+    async def trim(self, db, owner_id: str):
+        """Drop entries beyond the per-user cap, oldest first"""
+        overflow = await db.timelines.find({"user_id": owner_id}, {"_id": 1}).sort(
+            [("created_at", -1), ("post_id", -1)]
+        ).skip(self.max_entries).to_list(None)
+        if overflow:
+            await db.timelines.delete_many({"_id": {"$in": [entry["_id"] for entry in overflow]}})
+
+    async def rebuild(self, db, user: Dict[str, Any]):
+        """Materialize a timeline for a user who has never had one"""
+        friends = user.get("friends", [])
+        posts = await db.posts.find(
+            {
+                "$or": [
+                    {"author_id": user["_id"]},
+                    {"author_id": {"$in": friends}, "visibility": {"$in": FRIEND_VISIBILITIES}},
+                ]
+            },
+            {"_id": 1, "author_id": 1, "created_at": 1}
+        ).sort("created_at", -1).limit(self.max_entries).to_list(self.max_entries)
+        await self._insert_entries(db, [self._entry(user["_id"], post) for post in posts])
+        await db.users.update_one({"_id": user["_id"]}, {"$set": {"timeline_built": True}})
+        logger.info(f"📰 Built timeline for user {user['_id']} with {len(posts)} entries")
+
+    # --- Read path ---
+
+    @staticmethod
+    def can_view(post: Dict[str, Any], user_id: str, friend_ids: set) -> bool:
+        if post["author_id"] == user_id:
+            return True
+        if post.get("visibility") == "public":
+            return True
+        return post.get("visibility") == "friends" and post["author_id"] in friend_ids
+
+    async def _candidates(self, db, user_id: str, friends: List[str], fetch: int) -> Tuple[List[str], bool]:
+        """Newest `fetch` post ids from all sources, and whether any source has more"""
+        sort = [("created_at", -1), ("_id", -1)]
+        candidates: Dict[str, Any] = {}
+
+        entries = await db.timelines.find({"user_id": user_id}, {"post_id": 1, "created_at": 1}).sort(
+            [("created_at", -1), ("post_id", -1)]
+        ).limit(fetch).to_list(fetch)
+        for entry in entries:
+            candidates[entry["post_id"]] = entry["created_at"]
+        more = len(entries) == fetch
+
+        public = await db.posts.find({"visibility": "public"}, {"_id": 1, "created_at": 1}).sort(sort).limit(fetch).to_list(fetch)
+        for post in public:
+            candidates[post["_id"]] = post["created_at"]
+        more = more or len(public) == fetch
+
+        if friends:
+            pulled = await db.posts.find(
+                {"fanout": "pull", "author_id": {"$in": friends}, "visibility": {"$in": FRIEND_VISIBILITIES}},
+                {"_id": 1, "created_at": 1}
+            ).sort(sort).limit(fetch).to_list(fetch)
+            for post in pulled:
+                candidates[post["_id"]] = post["created_at"]
+            more = more or len(pulled) == fetch
+
+        ordered_ids = [post_id for post_id, _ in sorted(
+            candidates.items(), key=lambda item: (str(item[1] or ""), item[0]), reverse=True
+        )][:fetch]
+        return ordered_ids, more
+
+    async def read_feed(self, db, user: Dict[str, Any], limit: int, max_rounds: int = 4) -> List[Dict[str, Any]]:
+        """Newest `limit` posts visible to the user, merged from all sources.
+
+        Entries whose post was deleted or is no longer visible are skipped; if
+        that leaves the page short, the candidates are fetched again twice as
+        deep, up to max_rounds times.
+        """
+        user_id = user["_id"]
+        friends = user.get("friends", [])
+        if not user.get("timeline_built"):
+            await self.rebuild(db, user)
+
+        friend_set = set(friends)
+        fetch = limit
+        visible: List[Dict[str, Any]] = []
+        for _ in range(max_rounds):
+            ordered_ids, more = await self._candidates(db, user_id, friends, fetch)
+            if not ordered_ids:
+                return []
+
+            posts = await db.posts.find({"_id": {"$in": ordered_ids}}).to_list(len(ordered_ids))
+            by_id = {post["_id"]: post for post in posts}
+            visible = [
+                by_id[post_id] for post_id in ordered_ids
+                if post_id in by_id and self.can_view(by_id[post_id], user_id, friend_set)
+            ]
+            if len(visible) >= limit or not more:
+                break
+            fetch *= 2
+        return visible[:limit]
+
+
+# Singleton instance
+timeline_service = TimelineService(
+    max_entries=int(os.getenv("TIMELINE_MAX_ENTRIES", "800")),
+    fanout_max_recipients=int(os.getenv("TIMELINE_FANOUT_MAX_RECIPIENTS", "2000")),
+)
@@ -0,0 +1,78 @@
+"""In-process cache of authenticated user records.
+
+get_current_user runs on every authenticated request, so the user document it
+loads is cached here keyed by user id. Entries expire after a short TTL and the
+cache is bounded with LRU eviction. Handlers that write to a user document
+must call invalidate() so the next request sees the change; the TTL bounds
+staleness for writes made by other worker processes.
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+
+class UserCache:
+    """Bounded TTL + LRU cache of user documents"""
+
+    def __init__(self, max_entries: int = 10000, ttl_seconds: float = 30.0):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        # Handlers treat the user as their own dict - never hand out the cached one
+        return dict(user)
+
+    def set(self, user_id: str, user: Dict[str, Any]):
+        self._entries[user_id] = (time.monotonic() + self.ttl_seconds, dict(user))
+        self._entries.move_to_end(user_id)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, *user_ids: str):
+        for user_id in user_ids:
+            if self._entries.pop(user_id, None) is not None:
+                self.invalidations += 1
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+# Singleton instance
+user_cache = UserCache(
+    max_entries=int(os.getenv("USER_CACHE_MAX_ENTRIES", "10000")),
+    ttl_seconds=float(os.getenv("USER_CACHE_TTL_SECONDS", "30")),
+)
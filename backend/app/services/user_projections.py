@@ -0,0 +1,62 @@
+"""Named projection profiles for reads from the users collection.
+
+User documents hold secrets (password hash, one-time tokens), derived search
+fields and potentially large embedded data. Every db.users read picks the
+smallest profile that covers what the handler uses, so neither the Mongo
+transfer nor the API response carries more than it needs.
+"""
+
+# Fields the request-scoped current user needs (get_current_user / WebSocket auth)
+USER_AUTH_PROJECTION = {
+    "name": 1,
+    "email": 1,
+    "friends": 1,
+    "palette": 1,
+    "profile_image": 1,
+    "photo_url": 1,
+    "bio": 1,
+    "location": 1,
+    "email_verified": 1,
+    "timeline_built": 1,
+}
+
+# Enough to show another user in a list, notification or chat header
+USER_PUBLIC_CARD_PROJECTION = {
+    "name": 1,
+    "email": 1,
+    "profile_image": 1,
+    "profile_picture": 1,
+    "photo_url": 1,
+}
+
+# Another user's profile page
+USER_PUBLIC_PROFILE_PROJECTION = {
+    "name": 1,
+    "email": 1,
+    "bio": 1,
+    "interests": 1,
+    "location": 1,
+    "age": 1,
+    "profile_picture": 1,
+    "profile_image": 1,
+    "photo_url": 1,
+    "created_at": 1,
+    "updated_at": 1,
+}
+
+# The user's own full profile - everything except secrets and derived fields
+USER_SELF_PROFILE_PROJECTION = {
+    "password_hash": 0,
+    "verification_token": 0,
+    "verification_expires": 0,
+    "reset_token": 0,
+    "reset_expires": 0,
+    "google_sub": 0,
+    "name_normalized": 0,
+    "name_tokens": 0,
+    "name_ngrams": 0,
+    "timeline_built": 0,
+}
+
+# Existence checks and lookups that only need the id
+USER_ID_PROJECTION = {"_id": 1}
@@ -0,0 +1,137 @@
+"""Indexed user search by name.
+
+Every user document carries three derived fields, written whenever the name
+changes and backfilled on startup for older documents:
+
+- name_normalized: casefolded, accent-stripped, whitespace-collapsed name
+- name_tokens: the words of name_normalized
+- name_ngrams: character trigrams of name_normalized without spaces
+
+Searches are anchored prefix matches on name_normalized / name_tokens, which
+Mongo turns into index range scans, plus an optional trigram match for
+infix queries. Candidates are bounded, ranked and then paginated.
+"""
+
+import logging
+import re
+import unicodedata
+from typing import Any, Dict, List, Optional, Tuple
+
+from pymongo import UpdateOne
+
+logger = logging.getLogger(__name__)
+
+NGRAM_SIZE = 3
+MAX_NGRAMS = 64
+MAX_CANDIDATES = 200
+
+# Rank of each kind of match; higher sorts first
+RANK_EXACT = 3
+RANK_NAME_PREFIX = 2
+RANK_WORD_PREFIX = 1
+RANK_NGRAM = 0
+
+SEARCH_PROJECTION = {"name": 1, "email": 1, "name_normalized": 1, "name_tokens": 1}
+
+
+def normalize_name(name: Optional[str]) -> str:
+    """Casefold, strip accents and collapse whitespace"""
+    if not name:
+        return ""
+    decomposed = unicodedata.normalize("NFKD", name)
+    stripped = "".join(ch for ch in decomposed if not unicodedata.combining(ch))
+    return " ".join(stripped.casefold().split())
+
+
+def name_ngrams(normalized: str) -> List[str]:
+    compact = normalized.replace(" ", "")
+    if len(compact) < NGRAM_SIZE:
+        return [compact] if compact else []
+    grams = []
+    seen = set()
+    for i in range(len(compact) - NGRAM_SIZE + 1):
+        gram = compact[i:i + NGRAM_SIZE]
+        if gram not in seen:
+            seen.add(gram)
+            grams.append(gram)
+    return grams[:MAX_NGRAMS]
+
+
+def search_fields(name: Optional[str]) -> Dict[str, Any]:
+    """Derived fields to $set on a user document alongside `name`"""
+    normalized = normalize_name(name)
+    return {
+        "name_normalized": normalized,
+        "name_tokens": normalized.split(),
+        "name_ngrams": name_ngrams(normalized),
+    }
+
+
+class UserSearchService:
+    """Ranked name search over the derived search fields"""
+
+    def rank(self, user: Dict[str, Any], query: str) -> int:
+        normalized = user.get("name_normalized", "")
+        if normalized == query:
+            return RANK_EXACT
+        if normalized.startswith(query):
+            return RANK_NAME_PREFIX
+        if any(token.startswith(query) for token in user.get("name_tokens", [])):
+            return RANK_WORD_PREFIX
+        return RANK_NGRAM
+
+    async def search(self, db, raw_query: str, exclude_ids: Optional[List[str]] = None,
+                     offset: int = 0, limit: int = 20) -> Tuple[List[Dict[str, Any]], bool]:
+        """Return one page of ranked matches and whether more exist"""
+        query = normalize_name(raw_query)
+        if not query:
+            return [], False
+
+        base: Dict[str, Any] = {}
+        if exclude_ids:
+            base["_id"] = {"$nin": exclude_ids}
+
+        prefix = {"$regex": f"^{re.escape(query)}"}
+        candidates: Dict[str, Dict[str, Any]] = {}
+
+        # Anchored prefix on the whole name or on any single word
+        for clause in ({"name_normalized": prefix}, {"name_tokens": prefix}):
+            docs = await db.users.find({**base, **clause}, SEARCH_PROJECTION).limit(MAX_CANDIDATES).to_list(MAX_CANDIDATES)
+            for doc in docs:
+                candidates.setdefault(doc["_id"], doc)
+
+        # Infix matches only when prefixes did not fill the candidate window
+        grams = name_ngrams(query)
+        if len(candidates) < MAX_CANDIDATES and len(query.replace(" ", "")) >= NGRAM_SIZE:
+            remaining = MAX_CANDIDATES - len(candidates)
+            docs = await db.users.find({**base, "name_ngrams": {"$all": grams}}, SEARCH_PROJECTION).limit(remaining).to_list(remaining)
+            for doc in docs:
+                candidates.setdefault(doc["_id"], doc)
+
+        ranked = sorted(
+            candidates.values(),
+            key=lambda doc: (-self.rank(doc, query), doc.get("name_normalized", ""), doc["_id"])
+        )
+        page = ranked[offset:offset + limit]
+        return page, len(ranked) > offset + limit
+
+    async def backfill(self, db, batch_size: int = 500) -> int:
+        """Populate search fields on users created before they existed"""
+        updated = 0
+        while True:
+            users = await db.users.find(
+                {"name_normalized": {"$exists": False}}, {"name": 1}
+            ).limit(batch_size).to_list(batch_size)
+            if not users:
+                break
+            await db.users.bulk_write([
+                UpdateOne({"_id": u["_id"]}, {"$set": search_fields(u.get("name"))}) for u in users
+            ], ordered=False)
+            updated += len(users)
+        if updated:
+            logger.info(f"🔎 Backfilled search fields for {updated} users")
+        return updated
+
+
+# Singleton instance
+user_search_service = UserSearchService()
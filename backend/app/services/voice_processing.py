@@ -0,0 +1,258 @@
+"""Background processing of voice notes.
+
+After a voice message is stored, process() runs in the background and:
+
+- decodes the audio (stdlib `wave` for PCM WAV, ffmpeg for anything else);
+- measures the real duration, replacing a client-reported duration_ms that
+  disagrees with the audio;
+- computes a downsampled peak array with NumPy so clients can draw the
+  waveform before downloading the audio;
+- transcodes uncompressed WAV to mono AAC (.m4a) when ffmpeg is available,
+  swapping the message's voice_url to the much smaller blob.
+
+Results are written onto the message document (waveform, duration_ms,
+voice_url, processed_at). Without ffmpeg, non-WAV notes keep their original
+audio and get no waveform. With S3 storage the audio is downloaded to a
+temporary file first.
+
+Notes stored before this existed (mostly legacy `.wav` files) are processed
+by backfill(), which runs at startup and only picks up messages without
+processed_at, so it is safe to run again.
+"""
+
+import asyncio
+import logging
+import os
+import shutil
+import tempfile
+import wave
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional
+
+import numpy as np
+
+from app.services.blob_store import blob_store
+
+logger = logging.getLogger(__name__)
+
+WAVEFORM_BUCKETS = 64
+DECODE_SAMPLE_RATE = 8000
+# Client durations within this tolerance of the measured one are kept
+DURATION_TOLERANCE_MS = 500
+DURATION_TOLERANCE_RATIO = 0.1
+TRANSCODE_BITRATE = "32k"
+# A backfill claim older than this was left by a worker that died mid-way
+BACKFILL_CLAIM_TIMEOUT_SECONDS = 3600
+
+
+@dataclass
+class VoiceAnalysis:
+    duration_ms: int
+    waveform: List[float]
+
+
+def compute_peaks(samples: np.ndarray, buckets: int = WAVEFORM_BUCKETS) -> List[float]:
+    """Max absolute amplitude per bucket, normalized to 0..1"""
+    if samples.size == 0:
+        return [0.0] * buckets
+    magnitudes = np.abs(samples.astype(np.float32))
+    edges = np.linspace(0, magnitudes.size, buckets + 1).astype(np.int64)
+    peaks = np.array([
+        magnitudes[start:end].max() if end > start else 0.0
+        for start, end in zip(edges[:-1], edges[1:])
+    ], dtype=np.float32)
+    top = peaks.max()
+    if top > 0:
+        peaks = peaks / top
+    return [round(float(p), 3) for p in peaks]
+
+
+def _read_wav(path: Path) -> Optional[VoiceAnalysis]:
+    """Decode PCM WAV with the stdlib; None if it is not a WAV we can read"""
+    try:
+        with wave.open(str(path), "rb") as wav:
+            channels = wav.getnchannels()
+            width = wav.getsampwidth()
+            rate = wav.getframerate()
+            frames = wav.readframes(wav.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    dtypes = {1: np.uint8, 2: np.int16, 4: np.int32}
+    if width not in dtypes or rate <= 0:
+        return None
+    samples = np.frombuffer(frames, dtype=dtypes[width])
+    if width == 1:
+        # 8-bit WAV is unsigned
+        samples = samples.astype(np.int16) - 128
+    if channels > 1:
+        samples = samples[: samples.size - samples.size % channels].reshape(-1, channels).mean(axis=1)
+    duration_ms = int(samples.size / rate * 1000)
+    return VoiceAnalysis(duration_ms=duration_ms, waveform=compute_peaks(samples))
+
+
+class VoiceProcessingService:
+    """Decodes, measures and transcodes voice notes off the request path"""
+
+    def __init__(self, ffmpeg_path: Optional[str] = None, max_concurrent: int = 2):
+        self.ffmpeg = ffmpeg_path or shutil.which("ffmpeg")
+        self._slots = asyncio.Semaphore(max_concurrent)
+        self._tasks = set()
+        self.processed = 0
+        self.transcoded = 0
+        self.failed = 0
+        self.backfilled = 0
+        if not self.ffmpeg:
+            logger.warning("⚠️ ffmpeg not found - voice notes will not be transcoded")
+
+    async def _ffmpeg(self, *args: str) -> bytes:
+        proc = await asyncio.create_subprocess_exec(
+            self.ffmpeg, "-hide_banner", "-loglevel", "error", *args,
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        stdout, stderr = await proc.communicate()
+        if proc.returncode != 0:
+            raise RuntimeError(f"ffmpeg failed: {stderr.decode(errors='replace')[:200]}")
+        return stdout
+
+    async def analyze(self, path: Path) -> Optional[VoiceAnalysis]:
+        analysis = await asyncio.to_thread(_read_wav, path)
+        if analysis is not None or not self.ffmpeg:
+            return analysis
+        # Any other codec: let ffmpeg decode to mono 16-bit PCM
+        pcm = await self._ffmpeg("-i", str(path), "-f", "s16le", "-ac", "1", "-ar", str(DECODE_SAMPLE_RATE), "pipe:1")
+        samples = np.frombuffer(pcm, dtype=np.int16)
+        return VoiceAnalysis(
+            duration_ms=int(samples.size / DECODE_SAMPLE_RATE * 1000),
+            waveform=await asyncio.to_thread(compute_peaks, samples),
+        )
+
+    async def transcode(self, db, path: Path):
+        """Encode to mono AAC and store it as a new blob"""
+        with tempfile.TemporaryDirectory() as tmp:
+            out = Path(tmp) / "voice.m4a"
+            await self._ffmpeg("-i", str(path), "-vn", "-ac", "1", "-c:a", "aac", "-b:a", TRANSCODE_BITRATE,
+                               "-movflags", "+faststart", "-y", str(out))
+            data = await asyncio.to_thread(out.read_bytes)
+        return await blob_store.put_bytes(db, data, ".m4a")
+
+    @staticmethod
+    def duration_matches(reported: Optional[int], measured: int) -> bool:
+        if reported is None:
+            return False
+        tolerance = max(DURATION_TOLERANCE_MS, measured * DURATION_TOLERANCE_RATIO)
+        return abs(reported - measured) <= tolerance
+
+    @staticmethod
+    @asynccontextmanager
+    async def _audio_file(name: str) -> AsyncIterator[Optional[Path]]:
+        """A local path holding the blob's audio, or None if it is not stored"""
+        if blob_store.is_local:
+            path = blob_store.path_for(name)
+            yield path if path.exists() else None
+            return
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / name
+            yield path if await blob_store.backend.get_file(blob_store.key_for(name), path) else None
+
+    async def process(self, db, message: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Analyze (and maybe transcode) one voice message. Returns the fields updated."""
+        name = await blob_store.blob_for_url(db, message.get("voice_url"))
+        if not name:
+            return None
+
+        async with self._slots, self._audio_file(name) as path:
+            if path is None:
+                return None
+            try:
+                analysis = await self.analyze(path)
+                updates: Dict[str, Any] = {"processed_at": datetime.now(timezone.utc).isoformat()}
+                if analysis is not None:
+                    updates["waveform"] = analysis.waveform
+                    if not self.duration_matches(message.get("duration_ms"), analysis.duration_ms):
+                        logger.info(f"🎙️ Corrected duration of voice message {message['_id']}: "
+                                    f"{message.get('duration_ms')}ms -> {analysis.duration_ms}ms")
+                        updates["duration_ms"] = analysis.duration_ms
+                        updates["reported_duration_ms"] = message.get("duration_ms")
+
+                if self.ffmpeg and path.suffix.lower() == ".wav":
+                    blob = await self.transcode(db, path)
+                    updates["voice_url"] = blob_store.url_for(blob.name, prefix="")
+                    updates["original_voice_url"] = message["voice_url"]
+                    self.transcoded += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"❌ Voice processing failed for message {message['_id']}: {e}")
+                return None
+
+        await db.messages.update_one({"_id": message["_id"]}, {"$set": updates})
+        if "voice_url" in updates:
+            # The message now references the compact version only
+            await blob_store.release(db, message["voice_url"])
+        self.processed += 1
+        return updates
+
+    async def backfill(self, db) -> int:
+        """Process voice notes stored before processing existed. Returns how many were handled."""
+        if not self.ffmpeg:
+            logger.warning("⚠️ ffmpeg not found - skipping the voice note backfill")
+            return 0
+        handled = 0
+        stale = datetime.now(timezone.utc) - timedelta(seconds=BACKFILL_CLAIM_TIMEOUT_SECONDS)
+        pending = {"type": "voice", "processed_at": {"$exists": False}}
+        async for message in db.messages.find(pending, {"voice_url": 1, "duration_ms": 1}):
+            # Claim the note so workers starting together do not process it twice
+            claimed = await db.messages.update_one(
+                {
+                    **pending,
+                    "_id": message["_id"],
+                    "$or": [
+                        {"processing_claimed_at": {"$exists": False}},
+                        {"processing_claimed_at": {"$lt": stale}},
+                    ],
+                },
+                {"$set": {"processing_claimed_at": datetime.now(timezone.utc)}},
+            )
+            if not claimed.modified_count:
+                continue
+            if await self.process(db, message) is None:
+                # Missing or undecodable audio: record it instead of retrying on every start
+                await db.messages.update_one(
+                    {"_id": message["_id"]},
+                    {"$set": {"processed_at": datetime.now(timezone.utc).isoformat(), "processing_error": True}},
+                )
+            handled += 1
+        if handled:
+            self.backfilled += handled
+            logger.info(f"🎙️ Backfilled {handled} voice notes")
+        return handled
+
+    def schedule(self, db, message: Dict[str, Any], on_done=None):
+        """Process a voice message in the background; on_done(updates) runs on success"""
+        async def run():
+            updates = await self.process(db, message)
+            if updates and on_done is not None:
+                await on_done(updates)
+
+        task = asyncio.create_task(run())
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ffmpeg": bool(self.ffmpeg),
+            "in_progress": len(self._tasks),
+            "processed": self.processed,
+            "transcoded": self.transcoded,
+            "failed": self.failed,
+            "backfilled": self.backfilled,
+        }
+
+
+# Singleton instance
+voice_processing = VoiceProcessingService(
+    ffmpeg_path=os.getenv("FFMPEG_PATH"),
+    max_concurrent=int(os.getenv("VOICE_PROCESSING_CONCURRENCY", "2")),
+)
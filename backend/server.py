@@ -1,31 +1,55 @@
-from fastapi import FastAPI, APIRouter, HTTPException, Header, Depends, Request, Query, WebSocket, WebSocketDisconnect, Form, UploadFile, File
-from fastapi.responses import FileResponse
-from starlette.websockets import WebSocketState
+from fastapi import FastAPI, APIRouter, HTTPException, Header, Depends, Request, Query, WebSocket, WebSocketDisconnect, Form, UploadFile, File, BackgroundTasks
+from fastapi.responses import JSONResponse, RedirectResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 import time
+import hmac
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne
 import os
+import asyncio
 import logging
 import json
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional, Dict, Any, Set
+from typing import List, Optional, Dict, Any, Iterable
 import uuid
 from datetime import datetime, timezone, timedelta, date
 import base64
-import requests
 from jose import jwt, JWTError
-from passlib.context import CryptContext
 import aiosmtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 import jinja2
 import random
-from aiofiles import open as aio_open
 
 # Import subscription router
 from app.routers.subscriptions import router as subscriptions_router
+from app.services.index_service import index_service
+from app.services.pagination import clamp_limit, decode_offset_cursor, encode_cursor, encode_offset_cursor, fetch_page, reverse_sort
+from app.services.user_cache import user_cache
+from app.services.timeline_service import timeline_service
+from app.services.user_search_service import search_fields, user_search_service
+from app.services.avatar_service import avatar_service
+from app.services.blob_store import blob_store, media_type_for
+from app.services.connection_hub import connection_hub, decode_client_frame
+from app.services.event_bus import event_bus
+from app.services.event_log import EPHEMERAL_EVENT_TYPES, event_log
+from app.services.presence_service import presence_service
+from app.services.google_token_verifier import GoogleTokenError, google_token_verifier
+from app.services.http_client import close_http_client
+from app.services.image_derivatives import DERIVATIVE_SIZES, image_derivatives
+from app.services.media_response import IMMUTABLE_CACHE_CONTROL, SHORT_CACHE_CONTROL, media_response
+from app.services.media_writer import MediaTooLarge, iter_upload, media_writer
+from app.services.password_hasher import PasswordHasherBusy, password_hasher
+from app.services.voice_processing import voice_processing
+from app.services.user_projections import (
+    USER_AUTH_PROJECTION,
+    USER_ID_PROJECTION,
+    USER_PUBLIC_CARD_PROJECTION,
+    USER_PUBLIC_PROFILE_PROJECTION,
+    USER_SELF_PROFILE_PROJECTION,
+)
 
 ROOT_DIR = Path(__file__).parent
 load_dotenv(ROOT_DIR / '.env')
@@ -58,7 +82,8 @@ if not JWT_SECRET:
     raise ValueError("JWT_SECRET environment variable is required for production")
 ALGO = "HS256"
 ACCESS_EXPIRES_DAYS = 7
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Bearer token for /api/metrics; the endpoint is disabled when unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
 
 # Email Configuration
 SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
@@ -230,6 +255,37 @@ async def health_check():
             "timestamp": datetime.now(timezone.utc).isoformat()
         }
 
+def require_metrics_token(authorization: str = Header(default=None)):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not authorization or not authorization.lower().startswith("bearer "):
+        raise HTTPException(status_code=401, detail="Missing bearer token")
+    if not hmac.compare_digest(authorization.split(" ", 1)[1].encode(), METRICS_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid metrics token")
+
+# In-process metrics for this worker
+@app.get("/api/metrics", dependencies=[Depends(require_metrics_token)])
+async def get_metrics():
+    """Cache and queue counters for monitoring (needs METRICS_TOKEN as a bearer token)"""
+    return {
+        "user_cache": user_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "media_writer": media_writer.stats(),
+        "image_derivatives": image_derivatives.stats(),
+        "blob_store": blob_store.stats(),
+        "websockets": connection_hub.stats(),
+        "event_bus": event_bus.stats(),
+        "event_log": event_log.stats(),
+        "presence": presence_service.stats(),
+        "voice_processing": voice_processing.stats(),
+        "timestamp": datetime.now(timezone.utc).isoformat()
+    }
+
+@app.exception_handler(PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: PasswordHasherBusy):
+    """Shed auth load instead of queueing without bound"""
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers={"Retry-After": "1"})
+
 # Ads Configuration Endpoint (Feature Flag for Ad Display)
 @app.get("/api/config/ads")
 async def get_ads_config():
@@ -260,13 +316,14 @@ async def update_user_profile(
     """Update user profile with optional profile picture upload"""
     try:
         # Find user in database
-        user = await db.users.find_one({"_id": user_id})
+        user = await db.users.find_one({"_id": user_id}, {"profile_picture": 1})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
         # Update profile data
         update_data = {
             "name": name,
+            **search_fields(name),
             "bio": bio,
             "interests": interests.split(",") if interests else [],
             "location": location,
@@ -278,29 +335,22 @@ async def update_user_profile(
 
         # Handle profile picture upload
         if profile_picture and profile_picture.filename:
-            # Create uploads directory if it doesn't exist
-            upload_dir = Path(os.getenv('UPLOAD_DIR', './uploads/profiles'))
-            upload_dir.mkdir(parents=True, exist_ok=True)
-            
             # Generate unique filename
             file_extension = Path(profile_picture.filename).suffix.lower()
             if file_extension not in ['.jpg', '.jpeg', '.png', '.webp']:
                 raise HTTPException(status_code=400, detail="Invalid file type. Only JPG, PNG, and WebP are allowed.")
             
-            unique_filename = f"{user_id}_{int(time.time())}{file_extension}"
-            file_path = upload_dir / unique_filename
             
             # Validate file size (max 5MB)
             if profile_picture.size > 5 * 1024 * 1024:
                 raise HTTPException(status_code=400, detail="File too large. Maximum size is 5MB.")
             
             # Save file
-            with open(file_path, "wb") as buffer:
-                content = await profile_picture.read()
-                buffer.write(content)
+            blob = await blob_store.put_stream(db, iter_upload(profile_picture), file_extension, max_bytes=5 * 1024 * 1024)
+            blob_store.schedule_derivatives(blob)
             
             # Save profile picture URL
-            update_data["profile_picture"] = f"/api/uploads/profiles/{unique_filename}"
+            update_data["profile_picture"] = blob_store.url_for(blob.name)
 
         # Update user in database
         result = await db.users.update_one(
@@ -308,11 +358,16 @@ async def update_user_profile(
             {"$set": update_data}
         )
 
+        user_cache.invalidate(user_id)
+        if "profile_picture" in update_data:
+            # The user held one reference to the old picture (possibly the same blob)
+            await blob_store.release(db, user.get("profile_picture"))
+
         if result.modified_count == 0:
             raise HTTPException(status_code=400, detail="Profile update failed")
 
         # Get updated user
-        updated_user = await db.users.find_one({"_id": user_id})
+        updated_user = await db.users.find_one({"_id": user_id}, USER_PUBLIC_PROFILE_PROJECTION)
         
         return {
             "success": True,
@@ -340,7 +395,7 @@ async def update_user_profile(
 async def get_user_profile(user_id: str):
     """Get user profile information"""
     try:
-        user = await db.users.find_one({"_id": user_id})
+        user = await db.users.find_one({"_id": user_id}, USER_PUBLIC_PROFILE_PROJECTION)
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
 
@@ -368,14 +423,53 @@ async def get_user_profile(user_id: str):
 
 # --- File Serving ---
 
+def remote_blob_redirect(category: str, filename: str):
+    """Send the client to object storage for blobs that do not live on this server"""
+    if category != "blobs" or blob_store.is_local:
+        return None
+    return RedirectResponse(blob_store.download_url(filename), status_code=307)
+
+def serve_file(request: Request, category: str, filename: str, media_type: str, not_found: str):
+    redirect = remote_blob_redirect(category, filename)
+    if redirect is not None:
+        return redirect
+    return media_response(request, media_writer.path_for(category, filename), media_type, filename, not_found=not_found)
+
+def serve_image(request: Request, category: str, filename: str, media_type: str, size: Optional[str], not_found: str):
+    """Serve an image, or its resized derivative when a size is requested.
+
+    Until the derivative has been rendered the original stands in with a short
+    max-age, so the sized URL is not cached forever with full-size bytes.
+    """
+    redirect = remote_blob_redirect(category, filename)
+    if redirect is not None:
+        return redirect
+    cache_control = IMMUTABLE_CACHE_CONTROL
+    if size:
+        if size not in DERIVATIVE_SIZES:
+            raise HTTPException(status_code=400, detail=f"Unknown size. Allowed: {', '.join(DERIVATIVE_SIZES)}")
+        derived = image_derivatives.pick(category, filename, size, request.headers.get("accept", ""))
+        if derived is not None:
+            derived_type = "image/webp" if derived.suffix == ".webp" else "image/jpeg"
+            return media_response(request, derived, derived_type, derived.name, vary="Accept")
+        cache_control = SHORT_CACHE_CONTROL
+    file_path = media_writer.path_for(category, filename)
+    return media_response(request, file_path, media_type, filename, not_found=not_found, cache_control=cache_control)
+
+@api_router.get("/uploads/blobs/{filename}")
+async def get_blob(filename: str, request: Request, size: Optional[str] = None):
+    """Serve content-addressed media; images can be resized (size=xs|sm|md)"""
+    media_type = media_type_for(filename) or "application/octet-stream"
+    if media_type.startswith("image/"):
+        return serve_image(request, "blobs", filename, media_type, size, not_found="Media file not found")
+    return serve_file(request, "blobs", filename, media_type, not_found="Media file not found")
+
 @api_router.get("/uploads/voices/{filename}")
-async def get_voice_file(filename: str):
+async def get_voice_file(filename: str, request: Request):
     """Serve voice message files"""
     try:
-        file_path = f"{os.getenv('UPLOAD_DIR', './uploads')}/voices/{filename}"
-        
-        if not os.path.exists(file_path):
-            raise HTTPException(status_code=404, detail="Voice file not found")
+        # Files uploaded before the blob store may have been moved into it
+        category, name = await blob_store.resolve(db, "voices", filename)
         
         # Determine media type based on file extension
         if filename.endswith('.m4a'):
@@ -387,25 +481,18 @@ async def get_voice_file(filename: str):
         else:
             media_type = "audio/mpeg"
         
-        return FileResponse(
-            path=file_path,
-            media_type=media_type,
-            filename=filename
-        )
+        return serve_file(request, category, name, media_type, not_found="Voice file not found")
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Failed to serve voice file {filename}: {e}")
         raise HTTPException(status_code=500, detail="Failed to serve voice file")
 
 @api_router.get("/uploads/profiles/{filename}")
-async def get_profile_picture(filename: str):
-    """Serve profile picture files"""
+async def get_profile_picture(filename: str, request: Request, size: Optional[str] = None):
+    """Serve profile picture files, optionally resized (size=xs|sm|md)"""
     try:
-        file_path = f"{os.getenv('UPLOAD_DIR', './uploads')}/profiles/{filename}"
-        
-        if not os.path.exists(file_path):
-            raise HTTPException(status_code=404, detail="Profile picture not found")
-        
         # Determine media type based on file extension
         if filename.lower().endswith(('.png', '.jpg', '.jpeg')):
             media_type = f"image/{filename.split('.')[-1].lower()}"
@@ -414,24 +501,20 @@ async def get_profile_picture(filename: str):
         else:
             media_type = "image/jpeg"
         
-        return FileResponse(
-            path=file_path,
-            media_type=media_type,
-            filename=filename
-        )
+        category, name = await blob_store.resolve(db, "profiles", filename)
+        return serve_image(request, category, name, media_type, size, not_found="Profile picture not found")
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Failed to serve profile picture {filename}: {e}")
         raise HTTPException(status_code=500, detail="Failed to serve profile picture")
 
 @api_router.get("/uploads/chat/{filename}")
-async def get_chat_media(filename: str):
-    """Serve chat media files"""
+async def get_chat_media(filename: str, request: Request, size: Optional[str] = None):
+    """Serve chat media files; images can be resized (size=xs|sm|md)"""
     try:
-        file_path = f"{os.getenv('UPLOAD_DIR', './uploads')}/chat/{filename}"
-        
-        if not os.path.exists(file_path):
-            raise HTTPException(status_code=404, detail="Media file not found")
+        category, name = await blob_store.resolve(db, "chat", filename)
         
         # Determine media type based on file extension
         file_ext = filename.lower().split('.')[-1]
@@ -452,78 +535,98 @@ async def get_chat_media(filename: str):
         else:
             media_type = "application/octet-stream"
         
-        return FileResponse(
-            path=file_path,
-            media_type=media_type,
-            filename=filename
-        )
+        if media_type.startswith("image/"):
+            return serve_image(request, category, name, media_type, size, not_found="Media file not found")
+        return serve_file(request, category, name, media_type, not_found="Media file not found")
         
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"❌ Failed to serve chat media {filename}: {e}")
         raise HTTPException(status_code=500, detail="Failed to serve chat media")
 
 # --- WebSocket connection store ---
-CONNECTIONS: Dict[str, Set[WebSocket]] = {}
-ONLINE: Set[str] = set()
+# Sockets and send queues live in connection_hub; event_bus carries events between workers.
+# Who is online is tracked by presence_service.
 
 async def ws_broadcast_to_user(user_id: str, payload: dict):
-    """Broadcast WebSocket message to all connections of a specific user."""
-    connections = CONNECTIONS.get(user_id, set())
-    logger.info(f"📡 Attempting to broadcast to user {user_id}. Active connections: {len(connections)}")
-    
-    if not connections:
-        logger.warning(f"❌ No WebSocket connections found for user {user_id}. Total users with connections: {len(CONNECTIONS)}")
-        # Debug: Show all connected users
-        connected_users = list(CONNECTIONS.keys())
-        logger.info(f"🔍 Currently connected users: {connected_users}")
-        return
-    
-    # Prepare message payload
+    """Queue a WebSocket event for all connections of a specific user."""
+    await ws_broadcast_to_users([user_id], payload)
+
+async def ws_broadcast_to_users(user_ids: Iterable[str], payload: dict):
+    """Serialize an event once and queue it for every connection of the given users."""
+    user_ids = list(user_ids)
+    event_id = None
+    if payload.get("type") not in EPHEMERAL_EVENT_TYPES:
+        # Clients send the last event_id they saw when reconnecting to get the gap replayed
+        event_id = event_log.next_id()
+        payload = {**payload, "event_id": event_id}
     message = json.dumps(payload)
-    
-    # Send to all active connections for this user
-    active_connections = set()
-    for ws in list(connections):  # Create a copy to iterate safely
-        try:
-            if ws.client_state == WebSocketState.CONNECTED:
-                await ws.send_text(message)
-                active_connections.add(ws)
-                logger.info(f"✅ Message sent to user {user_id} connection")
-            else:
-                logger.warning(f"🔌 Removing disconnected WebSocket for user {user_id}")
-                connections.discard(ws)
-        except Exception as e:
-            logger.error(f"❌ Failed to send WebSocket message to user {user_id}: {e}")
-            # Remove failed connection
-            connections.discard(ws)
-    
-    # Update connections list with only active ones
-    if active_connections:
-        CONNECTIONS[user_id] = active_connections
-        logger.info(f"📊 User {user_id} now has {len(active_connections)} active connections")
-    else:
-        # Remove user from connections if no active connections remain
-        if user_id in CONNECTIONS:
-            del CONNECTIONS[user_id]
-            logger.info(f"🗑️ Removed user {user_id} from connections (no active connections)")
-    
-    logger.info(f"📡 Broadcast completed for user {user_id}. Message type: {payload.get('type', 'unknown')}")
+    if event_id:
+        event_log.append(user_ids, event_id, message)
+    delivered = await event_bus.publish(user_ids, message, event_id)
+    logger.debug(f"📡 Queued {payload.get('type', 'unknown')} for {delivered} local connections")
+    return delivered
+
+def deliver_event(user_ids: Iterable[str], message: str, event_id: Optional[str] = None) -> int:
+    """Event bus callback: hand an event from any worker to this worker's sockets"""
+    if event_id:
+        event_log.remember(user_ids, event_id, message)
+    return connection_hub.publish_serialized(user_ids, message)
+
+async def open_realtime_connection(user_id: str, ws: WebSocket, last_event_id: Optional[str] = None,
+                                   wire_format: str = "json"):
+    """Register an accepted socket, first queueing the events missed since last_event_id"""
+    event_log.track(user_id)
+    presence_service.connect(user_id)
+    try:
+        missed = await event_log.replay(user_id, last_event_id) if last_event_id else []
+    except BaseException:
+        # Nothing is registered yet, so the caller has no connection to close
+        presence_service.disconnect(user_id)
+        if not connection_hub.is_connected(user_id):
+            event_log.release(user_id)
+        raise
+    # No await between the replay and registering, so no event falls in between
+    connection = connection_hub.register(user_id, ws, wire_format)
+    if not last_event_id:
+        return connection
+    if missed is None:
+        connection.send({"type": "replay:resync_required"})
+        logger.info(f"🔁 User {user_id} must resync: gap since {last_event_id} cannot be replayed")
+        return connection
+    for _, message in missed:
+        connection_hub.offer(connection, message)
+    connection.send({"type": "replay:complete", "count": len(missed)})
+    logger.info(f"🔁 Replayed {len(missed)} missed events to user {user_id}")
+    return connection
+
+async def send_presence_bulk(connection):
+    """Queue the online state of all friends; presence events are never replayed"""
+    friends = await presence_service.friends_of(connection.user_id)
+    online_map = await presence_service.online_map(friends)
+    connection.send({"type": "presence:bulk", "online": online_map})
+    logger.info(f"📨 Queued initial presence:bulk for user {connection.user_id}")
+
+async def receive_client_text(ws: WebSocket) -> Optional[str]:
+    """Next inbound frame as text; frames from msgpack clients are decoded"""
+    message = await ws.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000))
+    return decode_client_frame(message)
+
+def close_realtime_connection(connection):
+    connection_hub.unregister(connection)
+    presence_service.disconnect(connection.user_id)
+    if not connection_hub.is_connected(connection.user_id):
+        event_log.release(connection.user_id)
+
+async def load_friend_ids(user_id: str) -> List[str]:
+    user = await db.users.find_one({"_id": user_id}, {"friends": 1})
+    return user.get("friends", []) if user else []
 
 async def ws_broadcast_to_friends(user_id: str, payload: Dict[str, Any]):
-  user = await db.users.find_one({"_id": user_id})
-  if not user:
-    return
-  friends = user.get("friends", [])
-  for fid in friends:
-    await ws_broadcast_to_user(fid, payload)
-
-async def ws_set_presence(user_id: str, online: bool):
-  if online:
-    ONLINE.add(user_id)
-  else:
-    if user_id in ONLINE:
-      ONLINE.remove(user_id)
-  await ws_broadcast_to_friends(user_id, {"type": "presence:update", "user_id": user_id, "online": online})
+  await ws_broadcast_to_users(await presence_service.friends_of(user_id), payload)
 
 # Utils
 
@@ -538,26 +641,23 @@ async def get_or_create_user_by_google(google_payload: Dict[str, Any]):
     if not sub:
         raise HTTPException(status_code=400, detail="Invalid Google token: missing sub")
 
-    user = await db.users.find_one({"google_sub": sub})
+    user = await db.users.find_one({"google_sub": sub}, USER_AUTH_PROJECTION)
     if user:
         return user
 
-    photo_b64 = None
+    user_id = str(uuid.uuid4())
+    photo_url = None
     picture_url = google_payload.get("picture")
     if picture_url:
-        try:
-            resp = requests.get(picture_url, timeout=10)
-            if resp.status_code == 200:
-                photo_b64 = base64.b64encode(resp.content).decode('utf-8')
-        except Exception:
-            photo_b64 = None
+        photo_url = await avatar_service.import_remote(db, user_id, picture_url)
 
     new_user = {
-        "_id": str(uuid.uuid4()),
+        "_id": user_id,
         "google_sub": sub,
         "email": google_payload.get("email"),
         "name": google_payload.get("name") or "User",
-        "photo_base64": photo_b64,
+        **search_fields(google_payload.get("name") or "User"),
+        "photo_url": photo_url,
         "palette": {"primary": "#A3C9FF", "secondary": "#FFCFE1", "accent": "#B8F1D9"},
         "friends": [],
         "created_at": now_iso(),
@@ -580,6 +680,15 @@ def create_access_token(sub: str, email: Optional[str] = None) -> str:
     }
     return jwt.encode(payload, JWT_SECRET, algorithm=ALGO)
 
+async def load_current_user(user_id: str) -> Optional[Dict[str, Any]]:
+    """Load the authenticated user, served from user_cache when fresh"""
+    user = user_cache.get(user_id)
+    if user is None:
+        user = await db.users.find_one({"_id": user_id}, USER_AUTH_PROJECTION)
+        if user:
+            user_cache.set(user_id, user)
+    return user
+
 async def get_current_user(authorization: str = Header(default=None)):
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=401, detail="Missing bearer token")
@@ -591,7 +700,7 @@ async def get_current_user(authorization: str = Header(default=None)):
     user_id = data.get("sub")
     if not user_id:
         raise HTTPException(status_code=403, detail="Invalid token payload")
-    user = await db.users.find_one({"_id": user_id})
+    user = await load_current_user(user_id)
     if not user:
         raise HTTPException(status_code=401, detail="User not found")
     return user
@@ -603,8 +712,7 @@ async def get_user_from_token(token: str):
         user_id = data.get("sub")
         if not user_id:
             return None
-        user = await db.users.find_one({"_id": user_id})
-        return user
+        return await load_current_user(user_id)
     except JWTError:
         return None
 
@@ -839,7 +947,7 @@ async def get_status_checks():
 @api_router.post("/dev/seed-demo")
 async def seed_demo(user=Depends(get_current_user)):
     async def ensure_user(name: str, email: str, password: str) -> str:
-        u = await db.users.find_one({"email": email.lower()})
+        u = await db.users.find_one({"email": email.lower()}, USER_ID_PROJECTION)
         if u:
             return u["_id"]
         uid = str(uuid.uuid4())
@@ -847,7 +955,8 @@ async def seed_demo(user=Depends(get_current_user)):
             "_id": uid,
             "email": email.lower(),
             "name": name,
-            "password_hash": pwd_context.hash(password),
+            **search_fields(name),
+            "password_hash": await password_hasher.hash(password),
             "palette": {"primary": "#A3C9FF", "secondary": "#FFCFE1", "accent": "#B8F1D9"},
             "friends": [],
             "created_at": now_iso(),
@@ -869,7 +978,7 @@ async def seed_demo(user=Depends(get_current_user)):
         fr = {"_id": rid, "from_user_id": from_id, "to_user_id": to_id, "status": "pending", "created_at": now_iso()}
         await db.friend_requests.insert_one(fr)
         # Push realtime to recipient
-        fu = await db.users.find_one({"_id": from_id})
+        fu = await db.users.find_one({"_id": from_id}, USER_PUBLIC_CARD_PROJECTION)
         await ws_broadcast_to_user(to_id, {"type": "friend_request:incoming", "request_id": rid, "from": {"id": from_id, "name": fu.get("name"), "email": fu.get("email")}})
         return rid
 
@@ -889,12 +998,12 @@ async def seed_demo(user=Depends(get_current_user)):
 # --- DEV: List all users for debugging ---
 @api_router.get("/dev/users")
 async def list_users():
-    users = await db.users.find({}, {"password_hash": 0}).to_list(100)
+    users = await db.users.find({}, USER_SELF_PROFILE_PROJECTION).to_list(100)
     return {"users": users}
 
 # --- WebSocket endpoint ---
 @api_router.websocket("/ws")
-async def websocket_endpoint(ws: WebSocket, token: str = Query(...)):
+async def websocket_endpoint(ws: WebSocket, token: str = Query(...), last_event_id: Optional[str] = Query(None)):
     logger.info(f"🔌 New WebSocket connection attempt. Token provided: {bool(token)}")
     
     # Aggressive token cleaning - handle URL decoding and quotes
@@ -925,32 +1034,26 @@ async def websocket_endpoint(ws: WebSocket, token: str = Query(...)):
         return
     
     logger.info(f"✅ WebSocket accepted for user {user_id}")
-    await ws.accept()
+    wire_format = await connection_hub.accept(ws)
     
-    if user_id not in CONNECTIONS:
-        CONNECTIONS[user_id] = set()
-        logger.info(f"🆕 Created new connection set for user {user_id}")
+    connection = await open_realtime_connection(user_id, ws, last_event_id, wire_format)
     
-    CONNECTIONS[user_id].add(ws)
-    logger.info(f"📊 User {user_id} now has {len(CONNECTIONS[user_id])} active WebSocket connections")
-    
-    await ws_set_presence(user_id, True)
-    user = await db.users.find_one({"_id": user_id})
-    friends = user.get("friends", []) if user else []
-    online_map = {fid: (fid in ONLINE) for fid in friends}
-    try:
-        await ws.send_json({"type": "presence:bulk", "online": online_map})
-        logger.info(f"📨 Sent initial presence:bulk to user {user_id}")
-    except Exception as e:
-        logger.error(f"❌ Failed to send initial presence:bulk to user {user_id}: {e}")
+    await send_presence_bulk(connection)
     
     try:
         while True:
-            msg = await ws.receive_text()
+            msg = await receive_client_text(ws)
+            presence_service.heartbeat(user_id)
+            if msg is None:
+                continue
             
             # Handle simple ping-pong
             if msg == "ping":
-                await ws.send_text("pong")
+                # JSON clients keep the bare "pong" text; msgpack frames must carry an object
+                if connection.binary:
+                    connection.send({"type": "pong"})
+                else:
+                    connection.send_text("pong")
                 logger.debug(f"🏓 Simple ping-pong with user {user_id}")
                 continue
             
@@ -960,7 +1063,7 @@ async def websocket_endpoint(ws: WebSocket, token: str = Query(...)):
                 message_type = data.get("type")
                 
                 if message_type == "ping":
-                    await ws.send_json({"type": "pong"})
+                    connection.send({"type": "pong"})
                     logger.debug(f"💓 JSON heartbeat ping-pong with user {user_id}")
                 else:
                     logger.info(f"📨 WebSocket JSON message from user {user_id}: {message_type}")
@@ -970,22 +1073,21 @@ async def websocket_endpoint(ws: WebSocket, token: str = Query(...)):
                 
     except WebSocketDisconnect:
         logger.info(f"🔌 WebSocket disconnected for user {user_id}")
-        try:
-            CONNECTIONS.get(user_id, set()).discard(ws)
-            remaining = len(CONNECTIONS.get(user_id, set()))
-            logger.info(f"📊 User {user_id} now has {remaining} active WebSocket connections")
-        except Exception as e:
-            logger.error(f"❌ Error removing WebSocket for user {user_id}: {e}")
-        await ws_set_presence(user_id, False)
+    except Exception as e:
+        # e.g. receiving after the hub closed a slow consumer
+        logger.info(f"🔌 WebSocket closed for user {user_id}: {e}")
+    finally:
+        close_realtime_connection(connection)
+        logger.info(f"📊 User {user_id} now has {connection_hub.connection_count(user_id)} active WebSocket connections")
 
 # --- Auth (Google) ---
 @api_router.post("/auth/google")
 async def auth_google(payload: GoogleAuthRequest):
-    tokeninfo_url = f"https://oauth2.googleapis.com/tokeninfo?id_token={payload.id_token}"
-    r = requests.get(tokeninfo_url, timeout=10)
-    if r.status_code != 200:
+    try:
+        data = await google_token_verifier.verify(payload.id_token)
+    except GoogleTokenError as e:
+        logger.warning(f"⚠️ Google sign-in rejected: {e}")
         raise HTTPException(status_code=401, detail="Invalid Google id_token")
-    data = r.json()
     user = await get_or_create_user_by_google(data)
     access = create_access_token(sub=user["_id"], email=user.get("email"))
     return {"access_token": access, "token_type": "bearer"}
@@ -993,7 +1095,7 @@ async def auth_google(payload: GoogleAuthRequest):
 # --- Auth (Email+Password) ---
 @api_router.post("/auth/register")
 async def auth_register(req: RegisterRequest):
-    existing = await db.users.find_one({"email": req.email.lower()})
+    existing = await db.users.find_one({"email": req.email.lower()}, USER_ID_PROJECTION)
     if existing:
         raise HTTPException(status_code=400, detail="Email already registered")
     
@@ -1007,7 +1109,8 @@ async def auth_register(req: RegisterRequest):
         "_id": uid,
         "email": req.email.lower(),
         "name": req.name,
-        "password_hash": pwd_context.hash(req.password),
+        **search_fields(req.name),
+        "password_hash": await password_hasher.hash(req.password),
         "palette": {"primary": "#A3C9FF", "secondary": "#FFCFE1", "accent": "#B8F1D9"},
         "friends": [],
         "email_verified": False,
@@ -1033,7 +1136,7 @@ async def auth_register(req: RegisterRequest):
 @api_router.get("/auth/verify")
 async def verify_email(token: str):
     """Verify email address using token"""
-    user = await db.users.find_one({"verification_token": token})
+    user = await db.users.find_one({"verification_token": token}, {"email": 1, "verification_expires": 1})
     
     if not user:
         raise HTTPException(status_code=400, detail="Invalid or expired verification token")
@@ -1057,6 +1160,7 @@ async def verify_email(token: str):
             }
         }
     )
+    user_cache.invalidate(user["_id"])
     
     # Create access token
     access = create_access_token(sub=user["_id"], email=user["email"])
@@ -1070,7 +1174,7 @@ async def verify_email(token: str):
 @api_router.post("/auth/forgot-password")
 async def forgot_password(req: PasswordResetRequest):
     """Send password reset email"""
-    user = await db.users.find_one({"email": req.email.lower()})
+    user = await db.users.find_one({"email": req.email.lower()}, USER_ID_PROJECTION)
     
     # Always return success message for security (don't reveal if email exists)
     success_message = "If this email exists in our system, you will receive a password reset link shortly."
@@ -1106,7 +1210,7 @@ async def forgot_password(req: PasswordResetRequest):
 @api_router.post("/auth/reset-password")
 async def reset_password(req: PasswordResetConfirm):
     """Reset password using token"""
-    user = await db.users.find_one({"reset_token": req.token})
+    user = await db.users.find_one({"reset_token": req.token}, {"email": 1, "reset_expires": 1})
     
     if not user:
         raise HTTPException(status_code=400, detail="Invalid or expired reset token")
@@ -1117,7 +1221,7 @@ async def reset_password(req: PasswordResetConfirm):
         raise HTTPException(status_code=400, detail="Reset token has expired")
     
     # Update password and clear reset token
-    new_password_hash = pwd_context.hash(req.new_password)
+    new_password_hash = await password_hasher.hash(req.new_password)
     await db.users.update_one(
         {"_id": user["_id"]},
         {
@@ -1138,10 +1242,10 @@ async def reset_password(req: PasswordResetConfirm):
 
 @api_router.post("/auth/login", response_model=Token)
 async def auth_login(req: LoginRequest):
-    user = await db.users.find_one({"email": req.email.lower()})
+    user = await db.users.find_one({"email": req.email.lower()}, {"email": 1, "password_hash": 1})
     if not user or not user.get("password_hash"):
         raise HTTPException(status_code=401, detail="Invalid credentials")
-    if not pwd_context.verify(req.password, user["password_hash"]):
+    if not await password_hasher.verify(req.password, user["password_hash"]):
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
     # TEMPORARY: Skip email verification for development
@@ -1160,7 +1264,7 @@ async def get_me_auth(user=Depends(get_current_user)):
         "_id": str(user["_id"]),
         "name": user.get("name"),
         "email": user.get("email"),
-        "photo_base64": user.get("photo_base64")
+        "photo_url": user.get("photo_url")
     }
 
 @api_router.get("/me")
@@ -1175,7 +1279,7 @@ async def get_me(user=Depends(get_current_user)):
         "_id": uid,
         "name": user.get("name"),
         "email": user.get("email"),
-        "photo_base64": user.get("photo_base64"),
+        "photo_url": user.get("photo_url"),
         "palette": user.get("palette"),
         "today": {"total_goal": total_goal, "total_progress": total_progress, "ratio": daily_ratio},
     }
@@ -1186,28 +1290,56 @@ async def update_me(update: UserProfileUpdate, user=Depends(get_current_user)):
     if not updates:
         return {"updated": False}
     updates["updated_at"] = now_iso()
+    if "name" in updates:
+        updates.update(search_fields(updates["name"]))
+    if "photo_base64" in updates:
+        # Avatars live in the media store; the user document only keeps the URL
+        try:
+            updates["photo_url"] = await avatar_service.store_base64(db, updates.pop("photo_base64"))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        await blob_store.release(db, user.get("photo_url"))
     await db.users.update_one({"_id": user["_id"]}, {"$set": updates})
-    user = await db.users.find_one({"_id": user["_id"]})
+    user_cache.invalidate(user["_id"])
+    user = await db.users.find_one({"_id": user["_id"]}, USER_SELF_PROFILE_PROJECTION)
     return {"updated": True, "user": user}
 
 # --- Friends (unchanged endpoints below) ---
 @api_router.get("/friends/find")
-async def friends_find(q: str = Query(..., min_length=1), user=Depends(get_current_user)):
+async def friends_find(
+    q: str = Query(..., min_length=1),
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    user=Depends(get_current_user)
+):
+    """Find users by email, or by name with ranked, paginated results"""
     query = q.strip()
     if "@" in query:
-        u = await db.users.find_one({"email": query.lower()})
+        u = await db.users.find_one({"email": query.lower()}, {"name": 1, "email": 1})
         if not u:
             raise HTTPException(status_code=404, detail="User not found")
         return {"user": {"_id": u["_id"], "name": u.get("name"), "email": u.get("email")}}
-    cursor = db.users.find({"name": {"$regex": query, "$options": "i"}}).limit(2)
-    items = await cursor.to_list(2)
+    
+    # The cursor is an opaque offset into the bounded, ranked candidate list
+    try:
+        offset = decode_offset_cursor(cursor) if cursor else 0
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    limit = clamp_limit(limit, default=20, maximum=50)
+    
+    items, has_more = await user_search_service.search(db, query, exclude_ids=[user["_id"]], offset=offset, limit=limit)
     if not items:
         raise HTTPException(status_code=404, detail="User not found")
-    if len(items) > 1:
-        u = items[0]
-        return {"user": {"_id": u["_id"], "name": u.get("name"), "email": u.get("email")}, "ambiguous": True}
-    u = items[0]
-    return {"user": {"_id": u["_id"], "name": u.get("name"), "email": u.get("email")}}
+    
+    results = [{"_id": u["_id"], "name": u.get("name"), "email": u.get("email")} for u in items]
+    response = {
+        "user": results[0],
+        "results": results,
+        "next_cursor": encode_offset_cursor(offset + limit) if has_more else None
+    }
+    if len(results) > 1 or has_more:
+        response["ambiguous"] = True
+    return response
 
 @api_router.post("/friends/accept")
 async def accept_friend_request(payload: FriendAcceptReq, user=Depends(get_current_user)):
@@ -1217,6 +1349,9 @@ async def accept_friend_request(payload: FriendAcceptReq, user=Depends(get_curre
     await db.friend_requests.update_one({"_id": fr["_id"]}, {"$set": {"status": "accepted", "updated_at": now_iso()}})
     await db.users.update_one({"_id": user["_id"]}, {"$addToSet": {"friends": fr["from_user_id"]}})
     await db.users.update_one({"_id": fr["from_user_id"]}, {"$addToSet": {"friends": user["_id"]}})
+    user_cache.invalidate(user["_id"], fr["from_user_id"])
+    await timeline_service.backfill_author(db, user["_id"], fr["from_user_id"])
+    await timeline_service.backfill_author(db, fr["from_user_id"], user["_id"])
 
     # Create automatic 1-to-1 chat for these friends
     participants = sorted([user["_id"], fr["from_user_id"]])  # Sort for consistent chat_id
@@ -1238,6 +1373,7 @@ async def accept_friend_request(payload: FriendAcceptReq, user=Depends(get_curre
         logger.info(f"✅ Created automatic 1-to-1 chat {chat_id} for users {participants}")
 
     await ws_broadcast_to_user(fr["from_user_id"], {"type": "friend_request:accepted", "by": {"id": user["_id"], "name": user.get("name"), "email": user.get("email")}})
+    presence_service.invalidate_friends(user["_id"], fr["from_user_id"])
     await ws_broadcast_to_friends(user["_id"], {"type": "friends:list:update"})
     await ws_broadcast_to_friends(fr["from_user_id"], {"type": "friends:list:update"})
     return {"accepted": True, "chat_id": chat_id}
@@ -1253,31 +1389,76 @@ async def reject_friend_request(payload: FriendRejectReq, user=Depends(get_curre
 
 # --- Community Posts CRUD System ---
 
+async def backfill_comment_counts(posts: List[Dict[str, Any]]):
+    """Make comments_count exact on posts created before the counter existed.
+
+    Comment writes always $inc the counter, so on such a post it only holds the
+    changes since then. Counts for all of them are computed in one aggregation
+    and applied as a delta (recounted - stored), guarded on the stored value
+    read with the post: if a comment lands in between, the update matches
+    nothing and the post is simply recounted on a later read.
+    """
+    pending = {post["_id"]: post.get("comments_count") for post in posts if not post.get("comments_counted")}
+    if not pending:
+        return
+
+    counts = {post_id: 0 for post_id in pending}
+    async for row in db.comments.aggregate([
+        {"$match": {"post_id": {"$in": list(pending)}}},
+        {"$group": {"_id": "$post_id", "count": {"$sum": 1}}}
+    ]):
+        counts[row["_id"]] = row["count"]
+
+    for post in posts:
+        if post["_id"] in counts:
+            post["comments_count"] = counts[post["_id"]]
+
+    await db.posts.bulk_write([
+        UpdateOne(
+            {
+                "_id": post_id,
+                "comments_counted": {"$exists": False},
+                "comments_count": {"$exists": False} if pending[post_id] is None else pending[post_id],
+            },
+            {"$inc": {"comments_count": count - (pending[post_id] or 0)}, "$set": {"comments_counted": True}},
+        )
+        for post_id, count in counts.items()
+    ], ordered=False)
+
+async def backfill_comment_dates() -> int:
+    """Convert ISO-string created_at on older comments to BSON dates.
+
+    Comment pages are keyed on created_at; with strings and dates mixed, type
+    bracketing makes a range condition skip one whole group at a page boundary.
+    """
+    result = await db.comments.update_many(
+        {"created_at": {"$type": "string"}},
+        [{"$set": {"created_at": {"$dateFromString": {"dateString": "$created_at"}}}}],
+    )
+    if result.modified_count:
+        logger.info(f"🕒 Converted created_at to dates on {result.modified_count} comments")
+    return result.modified_count
+
+async def backfill_reaction_dates() -> int:
+    """Convert ISO-string created_at on older message reactions to BSON dates (see backfill_comment_dates)"""
+    result = await db.message_reactions.update_many(
+        {"created_at": {"$type": "string"}},
+        [{"$set": {"created_at": {"$dateFromString": {"dateString": "$created_at"}}}}],
+    )
+    if result.modified_count:
+        logger.info(f"🕒 Converted created_at to dates on {result.modified_count} message reactions")
+    return result.modified_count
+
 @api_router.get("/posts/feed")
 async def posts_feed(limit: int = 50, user=Depends(get_current_user)):
     """Get personalized feed - friends' posts + public posts"""
-    # Get user's friends list
-    user_friends = user.get("friends", [])
-    
-    # Create SECURE privacy-aware filter query (2025 best practices)
-    filter_query = {
-        "$or": [
-            # User's own posts (any visibility level)
-            {"author_id": user["_id"]},
-            # Friends' posts that are NOT private
-            {
-                "author_id": {"$in": user_friends},
-                "visibility": {"$in": ["public", "friends"]}
-            },
-            # Public posts from anyone (except user's own, already covered above)
-            {
-                "author_id": {"$ne": user["_id"]},
-                "visibility": "public"
-            }
-        ]
-    }
-    
-    posts = await db.posts.find(filter_query).sort("created_at", -1).limit(limit).to_list(limit)
+    # Own and friends' posts come from the precomputed timeline; public posts and
+    # posts by very high-friend authors are merged in at read time.
+    was_built = user.get("timeline_built", False)
+    posts = await timeline_service.read_feed(db, user, clamp_limit(limit))
+    if not was_built:
+        user_cache.invalidate(user["_id"])
+    await backfill_comment_counts(posts)
     
     # Enrich posts with reaction counts and user info
     for post in posts:
@@ -1291,14 +1472,10 @@ async def posts_feed(limit: int = 50, user=Depends(get_current_user)):
         }
         post["total_reactions"] = sum(post["reaction_counts"].values())
         
-        # Add comments count
-        comment_count = await db.comments.count_documents({"post_id": post["_id"]})
-        post["comments_count"] = comment_count
-        
     return {"posts": posts}
 
 @api_router.post("/posts")
-async def create_post(payload: PostCreate, user=Depends(get_current_user)):
+async def create_post(payload: PostCreate, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
     """Create a new community post"""
     # Check rate limiting for posts
     if not check_rate_limit(user["_id"]):
@@ -1316,11 +1493,20 @@ async def create_post(payload: PostCreate, user=Depends(get_current_user)):
         "tags": payload.tags or [],
         "visibility": payload.visibility or "friends",
         "reactions": {"like": 0, "heart": 0, "clap": 0, "star": 0},
+        "comments_count": 0,
+        "comments_counted": True,
         "created_at": now_iso(),
         "updated_at": now_iso()
     }
     
+    friend_ids = user.get("friends", [])
+    if not timeline_service.uses_fanout(friend_ids):
+        # Too many recipients to push to - friends pull this post at read time
+        doc["fanout"] = "pull"
+    
     await db.posts.insert_one(doc)
+    await timeline_service.add_for_author(db, doc)
+    background_tasks.add_task(timeline_service.fan_out, db, doc, friend_ids)
     logger.info(f"✅ Created post: {doc['_id']} by {user.get('name')}")
     return doc
 
@@ -1346,7 +1532,7 @@ async def get_post(post_id: str, user=Depends(get_current_user)):
     return post
 
 @api_router.put("/posts/{post_id}")
-async def update_post(post_id: str, payload: PostUpdate, user=Depends(get_current_user)):
+async def update_post(post_id: str, payload: PostUpdate, background_tasks: BackgroundTasks, user=Depends(get_current_user)):
     """Update user's own post"""
     post = await db.posts.find_one({"_id": post_id})
     if not post:
@@ -1371,6 +1557,10 @@ async def update_post(post_id: str, payload: PostUpdate, user=Depends(get_curren
     await db.posts.update_one({"_id": post_id}, {"$set": update_data})
     
     updated_post = await db.posts.find_one({"_id": post_id})
+    if updated_post.get("visibility") != post.get("visibility"):
+        background_tasks.add_task(
+            timeline_service.visibility_changed, db, updated_post, post.get("visibility"), user.get("friends", [])
+        )
     logger.info(f"✅ Updated post: {post_id} by {user.get('name')}")
     return updated_post
 
@@ -1387,6 +1577,7 @@ async def delete_post(post_id: str, user=Depends(get_current_user)):
     # Delete post and related comments
     await db.posts.delete_one({"_id": post_id})
     await db.comments.delete_many({"post_id": post_id})
+    await timeline_service.remove_post(db, post_id)
     
     logger.info(f"✅ Deleted post: {post_id} by {user.get('name')}")
     return {"deleted": True}
@@ -1465,10 +1656,12 @@ async def add_comment(post_id: str, payload: CommentCreate, user=Depends(get_cur
         "author_id": user["_id"],
         "author_name": user.get("name"),
         "text": payload.text.strip(),
-        "created_at": now_iso()
+        # A datetime like /api/comments writes, so the created_at cursor compares one BSON type
+        "created_at": datetime.now(timezone.utc)
     }
     
     await db.comments.insert_one(comment_doc)
+    await db.posts.update_one({"_id": post_id}, {"$inc": {"comments_count": 1}})
     logger.info(f"✅ Added comment to post {post_id} by {user.get('name')}")
     return comment_doc
 
@@ -1477,7 +1670,7 @@ async def add_comment(post_id: str, payload: CommentCreate, user=Depends(get_cur
 @api_router.get("/profile/settings")
 async def get_profile_settings(user=Depends(get_current_user)):
     """Get user profile and settings"""
-    user_data = await db.users.find_one({"_id": user["_id"]})
+    user_data = await db.users.find_one({"_id": user["_id"]}, USER_SELF_PROFILE_PROJECTION)
     if not user_data:
         raise HTTPException(status_code=404, detail="User not found")
     
@@ -1523,6 +1716,7 @@ async def update_profile(payload: ProfileUpdate, user=Depends(get_current_user))
     
     if payload.name is not None:
         update_data["name"] = payload.name.strip()
+        update_data.update(search_fields(update_data["name"]))
     if payload.bio is not None:
         update_data["bio"] = payload.bio.strip()
     if payload.location is not None:
@@ -1538,51 +1732,79 @@ async def update_profile(payload: ProfileUpdate, user=Depends(get_current_user))
         {"_id": user["_id"]}, 
         {"$set": update_data}
     )
+    user_cache.invalidate(user["_id"])
     
-    updated_user = await db.users.find_one({"_id": user["_id"]})
+    updated_user = await db.users.find_one({"_id": user["_id"]}, USER_SELF_PROFILE_PROJECTION)
     logger.info(f"✅ Updated profile for user {user['_id']}")
     return updated_user
 
+PROFILE_PICTURE_MAX_BYTES = 5 * 1024 * 1024  # 5MB
+PROFILE_PICTURE_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "gif"}
+
+def file_extension_of(original: Optional[str], default: str) -> str:
+    file_extension = default
+    if original and "." in original:
+        file_extension = original.split('.')[-1].lower()
+    return f".{file_extension}"
+
+async def set_profile_image(user: Dict[str, Any], blob) -> Dict[str, Any]:
+    """Point the user's profile image at a stored blob"""
+    blob_store.schedule_derivatives(blob)
+    profile_image_url = blob_store.url_for(blob.name, prefix="")
+    await db.users.update_one(
+        {"_id": user["_id"]},
+        {"$set": {
+            "profile_image": profile_image_url,
+            "updated_at": now_iso()
+        }}
+    )
+    user_cache.invalidate(user["_id"])
+    # The user held one reference to the old picture (possibly the same blob)
+    await blob_store.release(db, user.get("profile_image"))
+    
+    logger.info(f"✅ Profile picture uploaded for user {user['_id']}")
+    return {
+        "success": True,
+        "profile_image_url": profile_image_url,
+        "filename": blob.name
+    }
+
+@api_router.post("/profile/picture/upload")
+async def upload_profile_picture_file(file: UploadFile = File(...), user=Depends(get_current_user)):
+    """Upload and set user profile picture as a multipart file, streamed straight to storage"""
+    file_extension = file_extension_of(file.filename, "jpg")
+    if file_extension[1:] not in PROFILE_PICTURE_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Invalid file type. Only JPG, PNG, WebP and GIF are allowed.")
+    if file.size is not None and file.size > PROFILE_PICTURE_MAX_BYTES:
+        raise HTTPException(status_code=400, detail="File too large. Maximum size is 5MB.")
+    
+    try:
+        blob = await blob_store.put_stream(db, iter_upload(file), file_extension, max_bytes=PROFILE_PICTURE_MAX_BYTES)
+    except MediaTooLarge:
+        raise HTTPException(status_code=400, detail="File too large. Maximum size is 5MB.")
+    except Exception as e:
+        raise HTTPException(status_code=400, detail=f"Failed to upload image: {str(e)}")
+    
+    return await set_profile_image(user, blob)
+
 @api_router.post("/profile/picture")
 async def upload_profile_picture(payload: ProfilePictureUpload, user=Depends(get_current_user)):
-    """Upload and set user profile picture"""
+    """Upload and set user profile picture (base64 JSON; prefer /profile/picture/upload)"""
     try:
         # Decode base64 image
         image_data = base64.b64decode(payload.image_data)
         
-        # Generate filename
-        file_extension = "jpg"  # Default to jpg
-        if payload.filename:
-            file_extension = payload.filename.split('.')[-1].lower()
-        
-        filename = f"profile_{user['_id'][:8]}_{uuid.uuid4().hex[:8]}.{file_extension}"
-        
-        # Create uploads directory if not exists
-        upload_dir = os.getenv('UPLOAD_DIR', './uploads/profiles')
-        os.makedirs(upload_dir, exist_ok=True)
+        file_extension = file_extension_of(payload.filename, "jpg")
+        if file_extension[1:] not in PROFILE_PICTURE_EXTENSIONS:
+            raise HTTPException(status_code=400, detail="Invalid file type. Only JPG, PNG, WebP and GIF are allowed.")
         
         # Save file
-        filepath = os.path.join(upload_dir, filename)
-        with open(filepath, "wb") as f:
-            f.write(image_data)
-        
-        # Update user profile with image URL
-        profile_image_url = f"/uploads/profiles/{filename}"
-        await db.users.update_one(
-            {"_id": user["_id"]},
-            {"$set": {
-                "profile_image": profile_image_url,
-                "updated_at": now_iso()
-            }}
-        )
+        blob = await blob_store.put_bytes(db, image_data, file_extension)
         
-        logger.info(f"✅ Profile picture uploaded for user {user['_id']}")
-        return {
-            "success": True,
-            "profile_image_url": profile_image_url,
-            "filename": filename
-        }
+        return await set_profile_image(user, blob)
         
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=400, detail=f"Failed to upload image: {str(e)}")
 
@@ -1602,104 +1824,147 @@ async def update_profile_settings(payload: UserSettings, user=Depends(get_curren
         {"_id": user["_id"]},
         {"$set": update_data}
     )
+    user_cache.invalidate(user["_id"])
     
     logger.info(f"✅ Updated settings for user {user['_id']}")
     return {"success": True}
 
 # --- Voice Message APIs ---
 
-@api_router.post("/chats/{chat_id}/voice")
-async def send_voice_message(chat_id: str, payload: VoiceMessageCreate, user=Depends(get_current_user)):
-    """Send voice message to chat"""
+VOICE_MAX_BYTES = 10 * 1024 * 1024  # 10MB
+VOICE_EXTENSIONS = {"m4a", "mp4", "aac", "ogg", "webm", "mp3", "wav"}
+
+async def authorize_voice_message(chat_id: str, user: Dict[str, Any]) -> Dict[str, Any]:
+    """Check chat membership and rate limit before accepting any audio"""
+    chat = await db.chats.find_one({"_id": chat_id})
+    if not chat:
+        raise HTTPException(status_code=404, detail="Chat not found")
+    
+    if user["_id"] not in chat.get("members", []):
+        raise HTTPException(status_code=403, detail="Not a member of this chat")
+    
+    # Check rate limiting for voice messages
+    if not check_rate_limit(user["_id"]):
+        logger.warning(f"🚫 Voice message rate limit exceeded for user {user['_id']}")
+        raise HTTPException(status_code=429, detail="Too many voice messages. Please slow down.")
+    return chat
+
+async def publish_voice_message(chat: Dict[str, Any], user: Dict[str, Any], blob, duration_ms: int):
+    """Store the message for an already stored voice blob and broadcast it"""
+    chat_id = chat["_id"]
+    message_id = str(uuid.uuid4())
+    voice_url = blob_store.url_for(blob.name, prefix="")
+    
+    message_doc = {
+        "_id": message_id,
+        "chat_id": chat_id,
+        "author_id": user["_id"],
+        "author_name": user.get("name", "Unknown User"),
+        "type": "voice",
+        "voice_url": voice_url,
+        "duration_ms": duration_ms,
+        "status": "sent",
+        "reactions": {"like": 0, "heart": 0, "clap": 0, "star": 0},
+        "created_at": now_iso(),
+        "updated_at": now_iso(),
+        "server_timestamp": now_iso()
+    }
+    
+    # Save to database
+    await db.messages.insert_one(message_doc)
+    
+    # Create normalized response
+    normalized_message = {
+        "id": message_id,
+        "_id": message_id,
+        "chat_id": chat_id,
+        "author_id": user["_id"],
+        "author_name": message_doc["author_name"],
+        "type": "voice",
+        "voice_url": voice_url,
+        "duration_ms": duration_ms,
+        "status": "sent",
+        "reactions": message_doc["reactions"],
+        "created_at": message_doc["created_at"],
+        "server_timestamp": message_doc["server_timestamp"]
+    }
+    
+    # Broadcast to other chat members
+    websocket_payload = {
+        "type": "chat:new_message",
+        "chat_id": chat_id,
+        "message": normalized_message
+    }
+    
+    recipients = [m for m in chat.get("members", []) if m != user["_id"]]
+    await ws_broadcast_to_users(recipients, websocket_payload)
+    
+    async def broadcast_processed(updates: Dict[str, Any]):
+        # Waveform, measured duration and the transcoded URL arrive after the message
+        processed_payload = {
+            "type": "chat:voice_processed",
+            "chat_id": chat_id,
+            "message_id": message_id,
+            "voice_url": updates.get("voice_url", voice_url),
+            "waveform": updates.get("waveform"),
+            "duration_ms": updates.get("duration_ms", duration_ms),
+        }
+        await ws_broadcast_to_users(chat.get("members", []), processed_payload)
+
+    voice_processing.schedule(db, message_doc, on_done=broadcast_processed)
+    
+    logger.info(f"✅ Voice message sent: {message_id} by {user.get('name')}, broadcast to {len(recipients)} members")
+    return normalized_message
+
+@api_router.post("/chats/{chat_id}/voice/upload")
+async def upload_voice_message(
+    chat_id: str,
+    file: UploadFile = File(...),
+    duration_ms: int = Form(...),
+    user=Depends(get_current_user)
+):
+    """Send voice message to chat as a multipart file, streamed straight to storage"""
     try:
-        # Validate chat access
-        chat = await db.chats.find_one({"_id": chat_id})
-        if not chat:
-            raise HTTPException(status_code=404, detail="Chat not found")
+        chat = await authorize_voice_message(chat_id, user)
         
-        if user["_id"] not in chat.get("members", []):
-            raise HTTPException(status_code=403, detail="Not a member of this chat")
+        file_extension = file_extension_of(file.filename, "wav")
+        if file_extension[1:] not in VOICE_EXTENSIONS:
+            raise HTTPException(status_code=400, detail="Unsupported audio format")
+        if file.size is not None and file.size > VOICE_MAX_BYTES:
+            raise HTTPException(status_code=400, detail="Voice message too large. Maximum size is 10MB")
         
-        # Check rate limiting for voice messages
-        if not check_rate_limit(user["_id"]):
-            logger.warning(f"🚫 Voice message rate limit exceeded for user {user['_id']}")
-            raise HTTPException(status_code=429, detail="Too many voice messages. Please slow down.")
+        try:
+            blob = await blob_store.put_stream(db, iter_upload(file), file_extension, max_bytes=VOICE_MAX_BYTES)
+        except MediaTooLarge:
+            raise HTTPException(status_code=400, detail="Voice message too large. Maximum size is 10MB")
         
-        # Decode audio data
-        audio_data = base64.b64decode(payload.audio_data)
+        return await publish_voice_message(chat, user, blob, duration_ms)
         
-        # Generate filename
-        file_extension = "wav"  # Default to wav
-        if payload.filename:
-            file_extension = payload.filename.split('.')[-1].lower()
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"❌ Failed to send voice message: {e}")
+        raise HTTPException(status_code=400, detail=f"Failed to send voice message: {str(e)}")
+
+@api_router.post("/chats/{chat_id}/voice")
+async def send_voice_message(chat_id: str, payload: VoiceMessageCreate, user=Depends(get_current_user)):
+    """Send voice message to chat (base64 JSON; prefer /chats/{chat_id}/voice/upload)"""
+    try:
+        chat = await authorize_voice_message(chat_id, user)
         
-        filename = f"voice_{uuid.uuid4().hex}.{file_extension}"
+        # Decode audio data
+        audio_data = base64.b64decode(payload.audio_data)
+        if len(audio_data) > VOICE_MAX_BYTES:
+            raise HTTPException(status_code=400, detail="Voice message too large. Maximum size is 10MB")
         
-        # Create uploads directory
-        upload_dir = os.getenv('UPLOAD_DIR', './uploads/voices')
-        os.makedirs(upload_dir, exist_ok=True)
+        file_extension = file_extension_of(payload.filename, "wav")
+        if file_extension[1:] not in VOICE_EXTENSIONS:
+            raise HTTPException(status_code=400, detail="Unsupported audio format")
         
         # Save audio file
-        filepath = os.path.join(upload_dir, filename)
-        with open(filepath, "wb") as f:
-            f.write(audio_data)
+        blob = await blob_store.put_bytes(db, audio_data, file_extension)
         
-        # Create voice message document
-        message_id = str(uuid.uuid4())
-        voice_url = f"/uploads/voices/{filename}"
-        
-        message_doc = {
-            "_id": message_id,
-            "chat_id": chat_id,
-            "author_id": user["_id"],
-            "author_name": user.get("name", "Unknown User"),
-            "type": "voice",
-            "voice_url": voice_url,
-            "duration_ms": payload.duration_ms,
-            "status": "sent",
-            "reactions": {"like": 0, "heart": 0, "clap": 0, "star": 0},
-            "created_at": now_iso(),
-            "updated_at": now_iso(),
-            "server_timestamp": now_iso()
-        }
-        
-        # Save to database
-        await db.messages.insert_one(message_doc)
-        
-        # Create normalized response
-        normalized_message = {
-            "id": message_id,
-            "_id": message_id,
-            "chat_id": chat_id,
-            "author_id": user["_id"],
-            "author_name": message_doc["author_name"],
-            "type": "voice",
-            "voice_url": voice_url,
-            "duration_ms": payload.duration_ms,
-            "status": "sent",
-            "reactions": message_doc["reactions"],
-            "created_at": message_doc["created_at"],
-            "server_timestamp": message_doc["server_timestamp"]
-        }
-        
-        # Broadcast to other chat members
-        websocket_payload = {
-            "type": "chat:new_message",
-            "chat_id": chat_id,
-            "message": normalized_message
-        }
-        
-        broadcast_count = 0
-        for member_id in chat.get("members", []):
-            if member_id != user["_id"]:
-                try:
-                    await ws_broadcast_to_user(member_id, websocket_payload)
-                    broadcast_count += 1
-                except Exception as e:
-                    logger.error(f"❌ Failed to broadcast voice message to user {member_id}: {e}")
-        
-        logger.info(f"✅ Voice message sent: {message_id} by {user.get('name')}, broadcast to {broadcast_count} members")
-        return normalized_message
+        return await publish_voice_message(chat, user, blob, payload.duration_ms)
         
     except HTTPException:
         raise
@@ -1758,7 +2023,8 @@ async def react_to_message(chat_id: str, message_id: str, payload: PostReaction,
                 "message_id": message_id,
                 "user_id": user["_id"],
                 "type": reaction_type,
-                "created_at": now_iso()
+                # A datetime like the heart toggle writes, so the created_at cursor compares one BSON type
+                "created_at": datetime.now(timezone.utc)
             }
             await db.message_reactions.insert_one(reaction_doc)
             await db.messages.update_one(
@@ -1782,16 +2048,10 @@ async def react_to_message(chat_id: str, message_id: str, payload: PostReaction,
             "updated_reactions": updated_message.get("reactions", {})
         }
         
-        broadcast_count = 0
-        for member_id in chat.get("members", []):
-            if member_id != user["_id"]:
-                try:
-                    await ws_broadcast_to_user(member_id, websocket_payload)
-                    broadcast_count += 1
-                except Exception as e:
-                    logger.error(f"❌ Failed to broadcast reaction to user {member_id}: {e}")
+        recipients = [m for m in chat.get("members", []) if m != user["_id"]]
+        await ws_broadcast_to_users(recipients, websocket_payload)
 
-        logger.info(f"📡 Reaction update broadcast to {broadcast_count} chat members")
+        logger.info(f"📡 Reaction update broadcast to {len(recipients)} chat members")
 
         return {
             "reacted": reacted,
@@ -1830,7 +2090,7 @@ async def open_direct_chat(friend_id: str, user=Depends(get_current_user)):
     """Open or get existing 1-to-1 chat with a friend"""
     
     # Verify friend exists
-    friend = await db.users.find_one({"_id": friend_id})
+    friend = await db.users.find_one({"_id": friend_id}, {"name": 1})
     if not friend:
         raise HTTPException(status_code=404, detail="User not found")
         
@@ -1888,12 +2148,58 @@ async def list_chats(user=Depends(get_current_user)):
     chats = await db.chats.find({"members": user["_id"]}).sort("created_at", -1).to_list(200)
     return {"chats": chats}
 
+# Newest first; _id breaks ties between messages stored in the same instant
+MESSAGE_SORT = [("server_timestamp", -1), ("_id", -1)]
+
+async def backfill_message_timestamps() -> int:
+    """Give legacy messages the server_timestamp the history cursor pages on.
+
+    A missing field never matches the cursor's $lt, so such messages would be
+    unreachable once a client pages back. Copies created_at (or timestamp),
+    rendering BSON dates in the same ISO format now_iso() writes.
+    """
+    source = {"$ifNull": ["$created_at", "$timestamp"]}
+    result = await db.messages.update_many(
+        {"server_timestamp": {"$exists": False}},
+        [{"$set": {"server_timestamp": {"$cond": [
+            {"$eq": [{"$type": source}, "date"]},
+            {"$dateToString": {"date": source, "format": "%Y-%m-%dT%H:%M:%S.%L000+00:00"}},
+            source,
+        ]}}}],
+    )
+    if result.modified_count:
+        logger.info(f"🕒 Backfilled server_timestamp on {result.modified_count} messages")
+    return result.modified_count
+
 @api_router.get("/chats/{chat_id}/messages")
-async def list_messages(chat_id: str, limit: int = 50, user=Depends(get_current_user)):
-    chat = await db.chats.find_one({"_id": chat_id, "members": user["_id"]})
+async def list_messages(
+    chat_id: str,
+    limit: int = 50,
+    before: Optional[str] = None,
+    after: Optional[str] = None,
+    user=Depends(get_current_user)
+):
+    """List chat history one page at a time.
+
+    Without a cursor the newest `limit` messages are returned. Pass `before`
+    (the returned before_cursor) to scroll back, or `after` (after_cursor) to
+    fetch only messages newer than what the client already has.
+    """
+    chat = await db.chats.find_one({"_id": chat_id, "members": user["_id"]}, {"_id": 1})
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
-    msgs = await db.messages.find({"chat_id": chat_id}).sort("created_at", -1).limit(limit).to_list(limit)
+    if before and after:
+        raise HTTPException(status_code=400, detail="Use either before or after, not both")
+    
+    limit = clamp_limit(limit)
+    try:
+        if after:
+            msgs, next_cursor = await fetch_page(db.messages, {"chat_id": chat_id}, reverse_sort(MESSAGE_SORT), limit, after)
+        else:
+            msgs, next_cursor = await fetch_page(db.messages, {"chat_id": chat_id}, MESSAGE_SORT, limit, before)
+            msgs.reverse()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     
     # Normalize messages to ensure consistent structure (WhatsApp-style)
     normalized_msgs = []
@@ -1915,12 +2221,18 @@ async def list_messages(chat_id: str, limit: int = 50, user=Depends(get_current_
         if msg.get("type") == "voice":
             normalized_msg["voice_url"] = msg.get("voice_url")
             normalized_msg["duration_ms"] = msg.get("duration_ms")
+            normalized_msg["waveform"] = msg.get("waveform")
         else:
             normalized_msg["text"] = msg.get("text", "")
         
         normalized_msgs.append(normalized_msg)
     
-    return {"messages": list(reversed(normalized_msgs))}
+    return {
+        "messages": normalized_msgs,
+        "has_more": next_cursor is not None,
+        "before_cursor": encode_cursor(msgs[0], MESSAGE_SORT) if msgs else before,
+        "after_cursor": encode_cursor(msgs[-1], MESSAGE_SORT) if msgs else after
+    }
 
 @api_router.post("/chats/{chat_id}/messages")
 async def send_message(chat_id: str, payload: MessageCreate, user=Depends(get_current_user)):
@@ -2018,17 +2330,10 @@ async def send_message(chat_id: str, payload: MessageCreate, user=Depends(get_cu
         }
         
         # Send to all chat members except sender
-        broadcast_count = 0
-        for member_id in chat.get("members", []):
-            if member_id != user_id:  # Don't send to the sender
-                try:
-                    await ws_broadcast_to_user(member_id, websocket_payload)
-                    broadcast_count += 1
-                    logger.info(f"📨 Sent new message notification to user {member_id} for chat {chat_id}")
-                except Exception as e:
-                    logger.error(f"❌ Failed to broadcast to user {member_id}: {e}")
-        
-        logger.info(f"✅ Message broadcast to {broadcast_count} members")
+        recipients = [m for m in chat.get("members", []) if m != user_id]
+        await ws_broadcast_to_users(recipients, websocket_payload)
+        
+        logger.info(f"✅ Message broadcast to {len(recipients)} members")
         
         # 8. Return normalized message to sender (same shape as WebSocket)
         return normalized_message
@@ -2075,82 +2380,141 @@ async def react_chat_message(chat_id: str, message_id: str, payload: MessageReac
     }
     
     # Send to all chat members
-    for member_id in chat.get("members", []):
-        await ws_broadcast_to_user(member_id, reaction_payload)
-        logger.info(f"📨 Sent message reaction to user {member_id} for chat {chat_id}")
+    await ws_broadcast_to_users(chat.get("members", []), reaction_payload)
     
     return updated_msg
 
+CHAT_MEDIA_MAX_BYTES = 10 * 1024 * 1024  # 10MB
+CHAT_MEDIA_TYPES = {
+    'image/jpeg', 'image/jpg', 'image/png', 'image/webp', 'image/gif',
+    'video/mp4', 'video/webm', 'video/quicktime'
+}
+
+CHAT_MEDIA_EXTENSIONS = {"jpg", "jpeg", "png", "webp", "gif", "mp4", "webm", "mov"}
+
+class ChatMediaPresignRequest(BaseModel):
+    sha256: str
+    content_type: str
+    size: int
+    filename: str
+
+async def authorize_chat_member(chat_id: str, user: Dict[str, Any]) -> Dict[str, Any]:
+    chat = await db.chats.find_one({"_id": chat_id}, {"members": 1})
+    if not chat:
+        logger.error(f"❌ Chat not found: {chat_id}")
+        raise HTTPException(status_code=404, detail="Chat not found")
+    if user["_id"] not in chat.get("members", []):
+        logger.error(f"❌ User {user['_id']} not a member of chat {chat_id}")
+        raise HTTPException(status_code=403, detail="Not a member of this chat")
+    return chat
+
+def validate_chat_media_type(content_type: Optional[str]):
+    if content_type not in CHAT_MEDIA_TYPES:
+        raise HTTPException(
+            status_code=400, 
+            detail=f"Unsupported file type: {content_type}. Allowed: images and videos"
+        )
+
+def chat_media_extension(filename: Optional[str]) -> str:
+    """Extension the blob is stored under; it alone decides the served content type"""
+    file_extension = Path(filename or "").suffix.lower()
+    if file_extension[1:] not in CHAT_MEDIA_EXTENSIONS:
+        raise HTTPException(status_code=400, detail="Unsupported file extension. Allowed: images and videos")
+    return file_extension
+
+@api_router.post("/chats/{chat_id}/upload/presign")
+async def presign_chat_media_upload(chat_id: str, payload: ChatMediaPresignRequest, user=Depends(get_current_user)):
+    """Presigned PUT so the client can upload chat media straight to object storage.
+
+    After the PUT succeeds the client reports sha256/content_type/filename to
+    /chats/{chat_id}/upload instead of sending the file.
+    """
+    await authorize_chat_member(chat_id, user)
+    validate_chat_media_type(payload.content_type)
+    if payload.size > CHAT_MEDIA_MAX_BYTES:
+        raise HTTPException(status_code=400, detail="File too large. Maximum size is 10MB")
+    
+    sha256 = payload.sha256.lower()
+    file_extension = chat_media_extension(payload.filename)
+    try:
+        upload = blob_store.presign_upload(sha256, file_extension, payload.content_type)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if upload is None:
+        raise HTTPException(status_code=501, detail="Direct uploads are not available with this storage backend")
+    
+    # Identical bytes already stored - nothing to upload
+    existing = await blob_store.is_referenced(db, upload["name"])
+    return {"upload": None if existing else upload, "exists": bool(existing), "sha256": sha256}
+
 @api_router.post("/chats/{chat_id}/upload")
 async def upload_chat_media(
     chat_id: str, 
-    file: UploadFile = File(...),
+    file: Optional[UploadFile] = File(None),
+    sha256: Optional[str] = Form(None),
+    content_type: Optional[str] = Form(None),
+    filename: Optional[str] = Form(None),
     user=Depends(get_current_user)
 ):
-    """Upload media file for chat messages"""
+    """Upload media file for chat messages.
+
+    Either send the file itself, or - after a presigned direct upload - only
+    its sha256, content_type and filename.
+    """
     logger.info(f"📤 Processing media upload for chat {chat_id} from user {user['_id']}")
     
     try:
-        # Debug: Check chat and user membership
-        logger.info(f"🔍 Looking for chat with ID: {chat_id}")
-        chat = await db.chats.find_one({"_id": chat_id})
-        if not chat:
-            logger.error(f"❌ Chat not found: {chat_id}")
-            raise HTTPException(status_code=404, detail="Chat not found")
-        
-        logger.info(f"🔍 Chat found: {chat['_id']}, members: {chat.get('members', [])}")
-        logger.info(f"🔍 User ID: {user['_id']}")
-        
-        # Verify user has access to the chat  
-        if user["_id"] not in chat.get("members", []):
-            logger.error(f"❌ User {user['_id']} not a member of chat {chat_id}")
-            raise HTTPException(status_code=403, detail="Not a member of this chat")
-        
-        # Validate file type
-        allowed_types = {
-            'image/jpeg', 'image/jpg', 'image/png', 'image/webp', 'image/gif',
-            'video/mp4', 'video/webm', 'video/quicktime'
-        }
-        
-        if file.content_type not in allowed_types:
-            raise HTTPException(
-                status_code=400, 
-                detail=f"Unsupported file type: {file.content_type}. Allowed: images and videos"
-            )
-        
-        # Check file size (10MB limit)
-        max_size = 10 * 1024 * 1024  # 10MB
-        file_content = await file.read()
-        if len(file_content) > max_size:
-            raise HTTPException(
-                status_code=400, 
-                detail="File too large. Maximum size is 10MB"
-            )
-        
-        # Create uploads directory
-        upload_dir = Path(os.getenv('UPLOAD_DIR', './uploads/chat'))
-        upload_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Generate unique filename
-        file_extension = Path(file.filename).suffix.lower()
-        unique_filename = f"{chat_id}_{user['_id']}_{int(time.time())}{file_extension}"
-        file_path = upload_dir / unique_filename
+        await authorize_chat_member(chat_id, user)
         
-        # Write file
-        async with aio_open(file_path, 'wb') as f:
-            await f.write(file_content)
+        if file is None:
+            # Direct upload: the bytes are already in object storage
+            if not (sha256 and content_type and filename):
+                raise HTTPException(status_code=400, detail="Send a file, or sha256, content_type and filename")
+            validate_chat_media_type(content_type)
+            try:
+                stored = await blob_store.register_direct_upload(
+                    db, sha256.lower(), chat_media_extension(filename), max_bytes=CHAT_MEDIA_MAX_BYTES
+                )
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            file_type, original_name = content_type, filename
+        else:
+            validate_chat_media_type(file.content_type)
+            
+            # Check file size (10MB limit) - up front when the size is known,
+            # otherwise while streaming so oversized uploads stop at the limit
+            if file.size is not None and file.size > CHAT_MEDIA_MAX_BYTES:
+                raise HTTPException(
+                    status_code=400, 
+                    detail="File too large. Maximum size is 10MB"
+                )
+            
+            file_extension = chat_media_extension(file.filename)
+            
+            # Stream file into the blob store in fixed-size chunks; identical
+            # bytes forwarded to many chats are stored once
+            try:
+                stored = await blob_store.put_stream(db, iter_upload(file), file_extension, max_bytes=CHAT_MEDIA_MAX_BYTES)
+            except MediaTooLarge:
+                raise HTTPException(
+                    status_code=400, 
+                    detail="File too large. Maximum size is 10MB"
+                )
+            blob_store.schedule_derivatives(stored)
+            file_type, original_name = file.content_type, file.filename
         
         # Create media URL (relative path)
-        media_url = f"/uploads/chat/{unique_filename}"
+        media_url = blob_store.url_for(stored.name, prefix="")
         
         logger.info(f"✅ Media uploaded successfully: {media_url}")
         
         return {
             "success": True,
             "media_url": media_url,
-            "file_type": file.content_type,
-            "file_size": len(file_content),
-            "filename": file.filename
+            "file_type": file_type,
+            "file_size": stored.size,
+            "sha256": stored.sha256,
+            "filename": original_name
         }
         
     except HTTPException:
@@ -2744,20 +3108,9 @@ app.add_middleware(
 # REAL-TIME FRIEND REQUEST & CHAT EVENT SYSTEM
 # =====================================================
 
-# In-memory storage for WebSocket connections (user_id -> connection)
-websocket_connections: Dict[str, WebSocket] = {}
-
 async def broadcast_to_user(user_id: str, event_data: dict):
     """Send real-time event to specific user via WebSocket"""
-    if user_id in websocket_connections:
-        ws = websocket_connections[user_id]
-        try:
-            await ws.send_text(json.dumps(event_data))
-            logger.info(f"📡 Event sent to user {user_id}: {event_data['type']}")
-        except Exception as e:
-            logger.error(f"❌ Failed to send event to user {user_id}: {e}")
-            # Remove dead connection
-            websocket_connections.pop(user_id, None)
+    await ws_broadcast_to_user(user_id, event_data)
 
 @api_router.post("/friends/request")
 async def send_friend_request(request: dict, user=Depends(get_current_user)):
@@ -2768,7 +3121,7 @@ async def send_friend_request(request: dict, user=Depends(get_current_user)):
             raise HTTPException(status_code=400, detail="Email required")
         
         # Find recipient user
-        recipient = await db.users.find_one({"email": recipient_email})
+        recipient = await db.users.find_one({"email": recipient_email}, USER_ID_PROJECTION)
         if not recipient:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -2867,7 +3220,7 @@ async def accept_friend_request(request_id: str, user=Depends(get_current_user))
         await db.friendships.insert_one(friendship)
         
         # Get sender info for notifications
-        sender = await db.users.find_one({"_id": friend_request["sender_id"]})
+        sender = await db.users.find_one({"_id": friend_request["sender_id"]}, USER_PUBLIC_CARD_PROJECTION)
         
         # Send real-time updates to both users
         friend_data = {
@@ -2910,50 +3263,70 @@ async def accept_friend_request(request_id: str, user=Depends(get_current_user))
         raise HTTPException(status_code=500, detail=f"Failed to accept friend request: {str(e)}")
 
 @api_router.get("/friends/requests")
-async def get_friend_requests(user=Depends(get_current_user)):
+async def get_friend_requests(limit: int = 50, cursor: Optional[str] = None, user=Depends(get_current_user)):
     """Get pending friend requests for current user"""
     try:
-        requests = await db.friend_requests.find({
-            "recipient_id": user["_id"],
-            "status": "pending"
-        }).sort("created_at", -1).to_list(length=None)
+        requests, next_cursor = await fetch_page(
+            db.friend_requests,
+            {"recipient_id": user["_id"], "status": "pending"},
+            [("created_at", -1), ("_id", -1)],
+            clamp_limit(limit),
+            cursor
+        )
         
         return {
             "success": True,
-            "requests": requests
+            "requests": requests,
+            "next_cursor": next_cursor
         }
         
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"❌ Get friend requests error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to get friend requests: {str(e)}")
 
 @api_router.get("/friends/list")
-async def get_friends_list(user=Depends(get_current_user)):
+async def get_friends_list(include_presence: bool = False, user=Depends(get_current_user)):
     """Get friends list for current user"""
     try:
         # Get friendships where user is either user1 or user2
-        friendships = await db.friendships.find({
-            "$or": [
-                {"user1_id": user["_id"]},
-                {"user2_id": user["_id"]}
-            ]
-        }).to_list(length=None)
+        friendships = await db.friendships.find(
+            {
+                "$or": [
+                    {"user1_id": user["_id"]},
+                    {"user2_id": user["_id"]}
+                ]
+            },
+            {"user1_id": 1, "user2_id": 1, "created_at": 1}
+        ).to_list(length=None)
+        
+        # Hydrate all friends with one $in query instead of one find_one per friend
+        friend_ids = [
+            friendship["user2_id"] if friendship["user1_id"] == user["_id"] else friendship["user1_id"]
+            for friendship in friendships
+        ]
+        friend_docs = await db.users.find(
+            {"_id": {"$in": friend_ids}},
+            {"name": 1, "email": 1}
+        ).to_list(length=None)
+        friends_by_id = {friend["_id"]: friend for friend in friend_docs}
+        online = await presence_service.online_map(friend_ids) if include_presence else {}
         
         friends = []
-        for friendship in friendships:
-            # Get the other user's ID
-            friend_id = friendship["user2_id"] if friendship["user1_id"] == user["_id"] else friendship["user1_id"]
-            
-            # Get friend's details
-            friend = await db.users.find_one({"_id": friend_id})
+        for friendship, friend_id in zip(friendships, friend_ids):
+            friend = friends_by_id.get(friend_id)
             if friend:
-                friends.append({
+                entry = {
                     "friend_id": friend_id,
                     "friend_name": friend.get("name", friend["email"]),
                     "friend_email": friend["email"],
                     "friendship_id": friendship["_id"],
                     "friendship_created": friendship["created_at"]
-                })
+                }
+                if include_presence:
+                    entry["online"] = online.get(friend_id, False)
+                friends.append(entry)
         
         return {
             "success": True,
@@ -2966,7 +3339,7 @@ async def get_friends_list(user=Depends(get_current_user)):
 
 # WebSocket connection handler with real-time events  
 @app.websocket("/api/ws")
-async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
+async def websocket_endpoint(websocket: WebSocket, token: str = Query(...), last_event_id: Optional[str] = Query(None)):
     """Enhanced WebSocket endpoint with proper query parameter token handling"""
     try:
         # Authenticate user from query parameter token
@@ -2978,28 +3351,32 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
         user_id = user["_id"]
         
         # Accept connection and store it
-        await websocket.accept()
-        websocket_connections[user_id] = websocket
+        wire_format = await connection_hub.accept(websocket)
+        connection = await open_realtime_connection(user_id, websocket, last_event_id, wire_format)
         logger.info(f"🔌 WebSocket connected for user: {user.get('name', user_id)}")
         
         # Send initial connection confirmation
-        await websocket.send_text(json.dumps({
+        connection.send({
             "type": "connectionEstablished",
             "data": {
                 "user_id": user_id,
                 "timestamp": now_iso()
             }
-        }))
+        })
+        await send_presence_bulk(connection)
         
         try:
             while True:
                 # Listen for incoming messages
-                data = await websocket.receive_text()
+                data = await receive_client_text(websocket)
+                presence_service.heartbeat(user_id)
+                if data is None:
+                    continue
                 message = json.loads(data)
                 
                 if message.get("type") == "ping":
                     # Respond to heartbeat
-                    await websocket.send_text(json.dumps({"type": "pong"}))
+                    connection.send({"type": "pong"})
                     
                 elif message.get("type") == "chatMessage":
                     # Handle real-time chat message
@@ -3018,8 +3395,8 @@ async def websocket_endpoint(websocket: WebSocket, token: str = Query(...)):
         await websocket.close(code=4000, reason="Connection error")
     finally:
         # Clean up connection
-        if 'user_id' in locals() and user_id in websocket_connections:
-            websocket_connections.pop(user_id, None)
+        if 'connection' in locals():
+            close_realtime_connection(connection)
 
 async def handle_real_time_message(sender_id: str, message_data: dict):
     """Handle real-time chat message sending"""
@@ -3043,13 +3420,14 @@ async def handle_real_time_message(sender_id: str, message_data: dict):
             "sender_id": sender_id,
             "content": content,
             "timestamp": now_iso(),
+            "server_timestamp": now_iso(),
             "message_type": "text"
         }
         
         await db.messages.insert_one(message)
         
         # Get sender info
-        sender = await db.users.find_one({"_id": sender_id})
+        sender = await db.users.find_one({"_id": sender_id}, USER_PUBLIC_CARD_PROJECTION)
         
         # Broadcast to all chat members
         event_data = {
@@ -3064,9 +3442,8 @@ async def handle_real_time_message(sender_id: str, message_data: dict):
             }
         }
         
-        for member_id in chat.get("members", []):
-            if member_id != sender_id:  # Don't send back to sender
-                await broadcast_to_user(member_id, event_data)
+        recipients = [m for m in chat.get("members", []) if m != sender_id]  # Don't send back to sender
+        await ws_broadcast_to_users(recipients, event_data)
                 
     except Exception as e:
         logger.error(f"❌ Real-time message error: {e}")
@@ -3204,6 +3581,7 @@ async def get_all_reports(
     status: Optional[str] = None,
     type: Optional[str] = None,
     limit: int = 50,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get all reports for admin - Admin only endpoint"""
@@ -3217,7 +3595,9 @@ async def get_all_reports(
         if type:
             query["type"] = type
             
-        reports = await db.reports.find(query).sort("created_at", -1).limit(limit).to_list(length=None)
+        reports, next_cursor = await fetch_page(
+            db.reports, query, [("created_at", -1), ("_id", -1)], clamp_limit(limit), cursor
+        )
         
         # Format reports for admin
         for report in reports:
@@ -3230,9 +3610,12 @@ async def get_all_reports(
         return {
             "success": True,
             "reports": reports,
-            "total_count": len(reports)
+            "total_count": len(reports),
+            "next_cursor": next_cursor
         }
         
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"❌ Failed to get reports: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get reports: {str(e)}")
@@ -3397,6 +3780,7 @@ async def request_account_deletion(
 async def get_deletion_requests(
     status: Optional[str] = None,
     limit: int = 50,
+    cursor: Optional[str] = None,
     current_user: dict = Depends(get_current_user)
 ):
     """Get all deletion requests for admin - Admin only endpoint"""
@@ -3407,7 +3791,9 @@ async def get_deletion_requests(
         if status:
             query["status"] = status
             
-        deletion_requests = await db.deletion_requests.find(query).sort("requested_at", -1).limit(limit).to_list(length=None)
+        deletion_requests, next_cursor = await fetch_page(
+            db.deletion_requests, query, [("requested_at", -1), ("_id", -1)], clamp_limit(limit), cursor
+        )
         
         # Format deletion requests for admin
         for request in deletion_requests:
@@ -3420,9 +3806,12 @@ async def get_deletion_requests(
         return {
             "success": True,
             "deletion_requests": deletion_requests,
-            "total_count": len(deletion_requests)
+            "total_count": len(deletion_requests),
+            "next_cursor": next_cursor
         }
         
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"❌ Failed to get deletion requests: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get deletion requests: {str(e)}")
@@ -3443,7 +3832,7 @@ async def process_account_deletion(
             raise HTTPException(status_code=404, detail="Deletion request not found")
         
         # Get user data before deletion for email confirmation
-        user = await db.users.find_one({"_id": user_id})
+        user = await db.users.find_one({"_id": user_id}, {"name": 1, "email": 1})
         if not user:
             raise HTTPException(status_code=404, detail="User not found")
         
@@ -3465,15 +3854,24 @@ async def process_account_deletion(
         # Delete user account
         result = await db.users.delete_one({"_id": user_id})
         deletion_summary["user_data"] = result.deleted_count
+        user_cache.invalidate(user_id)
         
         # Delete posts by user
         result = await db.posts.delete_many({"author_id": user_id})
         deletion_summary["posts"] = result.deleted_count
+        await timeline_service.remove_user(db, user_id)
         
         # Delete community posts by user
         result = await db.community_posts.delete_many({"author_id": user_id})
         deletion_summary["posts"] += result.deleted_count
         
+        # Keep comments_count on other users' posts in step with the comments removed below
+        async for row in db.comments.aggregate([
+            {"$match": {"author_id": user_id}},
+            {"$group": {"_id": "$post_id", "count": {"$sum": 1}}}
+        ]):
+            await db.posts.update_one({"_id": row["_id"]}, {"$inc": {"comments_count": -row["count"]}})
+        
         # Delete comments by user
         result = await db.comments.delete_many({"author_id": user_id})
         deletion_summary["comments"] = result.deleted_count
@@ -3605,7 +4003,7 @@ async def block_user(user_id: str, current_user: dict = Depends(get_current_user
         blocker_id = current_user["_id"]
         
         # Validate user exists
-        blocked_user = await db.users.find_one({"_id": user_id})
+        blocked_user = await db.users.find_one({"_id": user_id}, {"name": 1})
         if not blocked_user:
             raise HTTPException(status_code=404, detail="User not found")
             
@@ -3634,6 +4032,8 @@ async def block_user(user_id: str, current_user: dict = Depends(get_current_user
         }
         
         await db.blocked_users.insert_one(block_record)
+        user_cache.invalidate(blocker_id, user_id)
+        presence_service.invalidate_friends(blocker_id, user_id)
         
         # Remove any existing friend connections
         await db.friends.delete_many({
@@ -3685,7 +4085,7 @@ async def unblock_user(user_id: str, current_user: dict = Depends(get_current_us
             raise HTTPException(status_code=404, detail="Block record not found")
             
         # Get blocked user info for response
-        blocked_user = await db.users.find_one({"_id": user_id})
+        blocked_user = await db.users.find_one({"_id": user_id}, {"name": 1})
         blocked_user_name = blocked_user["name"] if blocked_user else "Unknown User"
         
         logger.info(f"✅ User unblocked: {blocker_id} unblocked {user_id}")
@@ -3707,12 +4107,20 @@ async def unblock_user(user_id: str, current_user: dict = Depends(get_current_us
         raise HTTPException(status_code=500, detail=f"Failed to unblock user: {str(e)}")
 
 @api_router.get("/users/blocked")
-async def get_blocked_users(current_user: dict = Depends(get_current_user)):
+async def get_blocked_users(
+    limit: int = 50,
+    cursor: Optional[str] = None,
+    current_user: dict = Depends(get_current_user)
+):
     """Get list of users blocked by current user"""
     try:
-        blocked_records = await db.blocked_users.find({
-            "blocker_id": current_user["_id"]
-        }).sort("blocked_at", -1).to_list(length=None)
+        blocked_records, next_cursor = await fetch_page(
+            db.blocked_users,
+            {"blocker_id": current_user["_id"]},
+            [("blocked_at", -1), ("_id", -1)],
+            clamp_limit(limit),
+            cursor
+        )
         
         # Format response
         blocked_users = []
@@ -3729,9 +4137,12 @@ async def get_blocked_users(current_user: dict = Depends(get_current_user)):
         return {
             "success": True,
             "blocked_users": blocked_users,
-            "total_count": len(blocked_users)
+            "total_count": len(blocked_users),
+            "next_cursor": next_cursor
         }
         
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"❌ Failed to get blocked users: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get blocked users: {str(e)}")
@@ -3784,6 +4195,7 @@ async def create_comment(comment_data: CommentCreateNew, current_user = Depends(
         
         result = await db.comments.insert_one(comment_dict)
         comment_dict['_id'] = str(result.inserted_id)
+        await db.posts.update_one({"_id": comment_data.post_id}, {"$inc": {"comments_count": 1}})
         
         logger.info(f"✅ Comment created for post {comment_data.post_id} by {current_user['name']}")
         return {"success": True, "comment": comment_dict}
@@ -3792,17 +4204,21 @@ async def create_comment(comment_data: CommentCreateNew, current_user = Depends(
         raise HTTPException(status_code=500, detail=f"Failed to create comment: {str(e)}")
 
 @app.get("/api/comments/{post_id}")
-async def get_comments(post_id: str):
-    """Get all comments for a post"""
+async def get_comments(post_id: str, limit: int = 50, cursor: Optional[str] = None):
+    """Get comments for a post, oldest first, one page at a time"""
     try:
-        comments = await db.comments.find({"post_id": post_id}).sort("created_at", 1).to_list(length=None)
+        comments, next_cursor = await fetch_page(
+            db.comments, {"post_id": post_id}, [("created_at", 1), ("_id", 1)], clamp_limit(limit), cursor
+        )
         
         # Convert ObjectId to string for JSON serialization
         for comment in comments:
             comment['id'] = str(comment['_id'])
             del comment['_id']
             
-        return {"success": True, "comments": comments}
+        return {"success": True, "comments": comments, "next_cursor": next_cursor}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get comments: {str(e)}")
 
@@ -3876,17 +4292,21 @@ async def toggle_message_reaction(message_id: str, chat_id: str, current_user =
         raise HTTPException(status_code=500, detail=f"Failed to toggle reaction: {str(e)}")
 
 @app.get("/api/messages/{message_id}/reactions")
-async def get_message_reactions(message_id: str):
-    """Get all reactions for a message"""
+async def get_message_reactions(message_id: str, limit: int = 50, cursor: Optional[str] = None):
+    """Get reactions for a message, one page at a time"""
     try:
-        reactions = await db.message_reactions.find({"message_id": message_id}).to_list(length=None)
+        reactions, next_cursor = await fetch_page(
+            db.message_reactions, {"message_id": message_id}, [("created_at", 1), ("_id", 1)], clamp_limit(limit), cursor
+        )
         
         # Convert ObjectId to string
         for reaction in reactions:
             reaction['id'] = str(reaction['_id'])
             del reaction['_id']
             
-        return {"success": True, "reactions": reactions}
+        return {"success": True, "reactions": reactions, "next_cursor": next_cursor}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Failed to get reactions: {str(e)}")
 
@@ -3918,14 +4338,16 @@ async def create_community_post(post: CommunityPostCreate, current_user = Depend
         raise HTTPException(status_code=500, detail=f"Failed to create post: {str(e)}")
 
 @app.get("/api/community/posts")
-async def get_community_posts(category: Optional[str] = None, limit: int = 50):
+async def get_community_posts(category: Optional[str] = None, limit: int = 50, cursor: Optional[str] = None):
     """Get community posts, optionally filtered by category"""
     try:
         query = {}
         if category:
             query["category"] = category
             
-        posts = await db.community_posts.find(query).sort("timestamp", -1).limit(limit).to_list(length=None)
+        posts, next_cursor = await fetch_page(
+            db.community_posts, query, [("timestamp", -1), ("_id", -1)], clamp_limit(limit), cursor
+        )
         
         # Convert ObjectId to string and format for frontend
         for post in posts:
@@ -3934,7 +4356,9 @@ async def get_community_posts(category: Optional[str] = None, limit: int = 50):
                 del post['_id']
                 
         logger.info(f"📥 Retrieved {len(posts)} community posts for category: {category or 'all'}")
-        return {"success": True, "posts": posts}
+        return {"success": True, "posts": posts, "next_cursor": next_cursor}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"❌ Failed to get community posts: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get posts: {str(e)}")
@@ -4037,10 +4461,12 @@ async def reply_to_community_post(post_id: str, reply: CommunityReplyCreate, cur
         raise HTTPException(status_code=500, detail=f"Failed to create reply: {str(e)}")
 
 @app.get("/api/community/posts/{post_id}/replies")
-async def get_community_post_replies(post_id: str):
-    """Get all replies for a community post"""
+async def get_community_post_replies(post_id: str, limit: int = 50, cursor: Optional[str] = None):
+    """Get replies for a community post, oldest first, one page at a time"""
     try:
-        replies = await db.community_replies.find({"post_id": post_id}).sort("timestamp", 1).to_list(length=None)
+        replies, next_cursor = await fetch_page(
+            db.community_replies, {"post_id": post_id}, [("timestamp", 1), ("_id", 1)], clamp_limit(limit), cursor
+        )
         
         # Convert ObjectId to string
         for reply in replies:
@@ -4049,7 +4475,9 @@ async def get_community_post_replies(post_id: str):
                 del reply['_id']
                 
         logger.info(f"📥 Retrieved {len(replies)} replies for post {post_id}")
-        return {"success": True, "replies": replies}
+        return {"success": True, "replies": replies, "next_cursor": next_cursor}
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     except Exception as e:
         logger.error(f"❌ Failed to get replies: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to get replies: {str(e)}")
@@ -4080,6 +4508,59 @@ async def delete_community_post(post_id: str, current_user = Depends(get_current
         logger.error(f"❌ Failed to delete post: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to delete post: {str(e)}")
 
+@app.on_event("startup")
+async def ensure_db_indexes():
+    try:
+        await index_service.ensure_indexes(db)
+    except Exception as e:
+        logger.error(f"❌ Failed to ensure MongoDB indexes: {e}")
+    event_log.start(db)
+    await event_bus.start(deliver_event, db)
+    presence_service.start(ws_broadcast_to_users, load_friend_ids, db)
+    blob_store.start_gc(db)
+    asyncio.create_task(run_startup_migrations())
+
+async def run_startup_migrations():
+    """Backfill derived fields on older documents without delaying startup"""
+    try:
+        await user_search_service.backfill(db)
+    except Exception as e:
+        logger.error(f"❌ User search backfill failed: {e}")
+    try:
+        await backfill_message_timestamps()
+    except Exception as e:
+        logger.error(f"❌ Message timestamp backfill failed: {e}")
+    try:
+        await backfill_comment_dates()
+        await backfill_reaction_dates()
+    except Exception as e:
+        logger.error(f"❌ Comment and reaction date backfill failed: {e}")
+    try:
+        await avatar_service.migrate_embedded(db)
+    except Exception as e:
+        logger.error(f"❌ Avatar migration failed: {e}")
+    try:
+        await blob_store.migrate_refcount_keys(db)
+        await blob_store.migrate_legacy(db)
+        await blob_store.collect_garbage(db)
+    except Exception as e:
+        logger.error(f"❌ Blob store migration failed: {e}")
+    try:
+        # After the blob migration, so legacy notes resolve through their aliases
+        await voice_processing.backfill(db)
+    except Exception as e:
+        logger.error(f"❌ Voice note backfill failed: {e}")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    await presence_service.stop()
+    await event_bus.stop()
+    await connection_hub.shutdown()
+    await close_http_client()
+    blob_store.stop_gc()
+    password_hasher.shutdown()
+    media_writer.shutdown()
+    image_derivatives.shutdown()
+    # Last: the final event log flush still writes to Mongo
+    await event_log.stop()
     client.close()
\ No newline at end of file
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# The services are imported as app.services.*, relative to backend/
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
@@ -0,0 +1,80 @@
+import asyncio
+import base64
+from types import SimpleNamespace
+
+import pytest
+
+pytest.importorskip("httpx")
+
+from app.services import avatar_service as avatar_module  # noqa: E402
+from app.services.avatar_service import AvatarService, guess_extension  # noqa: E402
+from app.services.user_cache import UserCache  # noqa: E402
+
+PNG = b"\x89PNG\r\n\x1a\n" + b"0" * 16
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    async def to_list(self, n):
+        return self.docs
+
+
+class FakeUsers:
+    def __init__(self, docs):
+        self.docs = {doc["_id"]: doc for doc in docs}
+
+    def find(self, query, projection=None):
+        excluded = query.get("_id", {}).get("$nin", [])
+        return FakeCursor([
+            dict(doc) for doc in self.docs.values()
+            if isinstance(doc.get("photo_base64"), str) and doc["_id"] not in excluded
+        ])
+
+    async def update_one(self, query, update):
+        doc = self.docs[query["_id"]]
+        if doc.get("photo_base64") == query["photo_base64"]:
+            doc.update(update["$set"])
+            doc.pop("photo_base64")
+
+    async def update_many(self, query, update):
+        for doc in self.docs.values():
+            if "photo_base64" in doc and doc["photo_base64"] is None:
+                doc.pop("photo_base64")
+
+
+def test_guess_extension():
+    assert guess_extension(PNG) == "png"
+    assert guess_extension(b"RIFF\0\0\0\0WEBPVP8 ") == "webp"
+    assert guess_extension(b"unknown") == "jpg"
+
+
+def test_migrate_embedded_invalidates_cached_users(monkeypatch):
+    cache = UserCache()
+    monkeypatch.setattr(avatar_module, "user_cache", cache)
+    service = AvatarService()
+
+    async def store(db, data):
+        return f"/api/uploads/blobs/{len(data)}.png"
+
+    monkeypatch.setattr(service, "store", store)
+    users = FakeUsers([
+        {"_id": "a", "photo_base64": base64.b64encode(PNG).decode()},
+        {"_id": "b", "photo_base64": ""},
+        {"_id": "c", "photo_base64": None},
+        {"_id": "d", "name": "untouched"},
+    ])
+    for user_id in "abcd":
+        cache.set(user_id, dict(users.docs[user_id]))
+
+    assert asyncio.run(service.migrate_embedded(SimpleNamespace(users=users))) == 1
+    assert users.docs["a"] == {"_id": "a", "photo_url": "/api/uploads/blobs/24.png"}
+    assert "photo_base64" not in users.docs["c"]
+    # The migrated user is re-read on the next request; the others stay cached
+    assert cache.get("a") is None
+    assert cache.get("d") == {"_id": "d", "name": "untouched"}
@@ -0,0 +1,196 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+from types import SimpleNamespace
+
+import pytest
+
+from app.services.blob_store import BlobStore
+from app.services.media_writer import MediaWriter
+
+from test_storage_backends import MemoryBackend
+
+OPERATORS = {
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+    "$exists": lambda value, arg: (value is not None) == arg,
+}
+
+
+def matches(doc, query):
+    for field, condition in query.items():
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if not all(OPERATORS[op](value, arg) for op, arg in condition.items()):
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCollection:
+    def __init__(self):
+        self.docs = {}
+
+    def _find(self, query):
+        return [doc for doc in self.docs.values() if matches(doc, query)]
+
+    async def find_one(self, query, projection=None):
+        found = self._find(query)
+        return dict(found[0]) if found else None
+
+    def find(self, query, projection=None):
+        found = [dict(doc) for doc in self._find(query)]
+        return SimpleNamespace(to_list=lambda n: asyncio.sleep(0, found[:n]))
+
+    async def update_one(self, query, update, upsert=False):
+        found = self._find(query)
+        upserted_id = None
+        if found:
+            doc = found[0]
+        elif upsert:
+            doc = self.docs[query["_id"]] = {"_id": query["_id"], **update.get("$setOnInsert", {})}
+            upserted_id = doc["_id"]
+        else:
+            return SimpleNamespace(upserted_id=None, modified_count=0)
+        for field, amount in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + amount
+        doc.update(update.get("$set", {}))
+        for field in update.get("$unset", {}):
+            doc.pop(field, None)
+        return SimpleNamespace(upserted_id=upserted_id, modified_count=1)
+
+    async def find_one_and_update(self, query, update):
+        before = await self.find_one(query)
+        if before:
+            await self.update_one({"_id": before["_id"]}, update)
+        return before
+
+    async def find_one_and_delete(self, query):
+        found = self._find(query)
+        return self.docs.pop(found[0]["_id"]) if found else None
+
+
+@pytest.fixture
+def db():
+    return SimpleNamespace(media_blobs=FakeCollection(), media_aliases=FakeCollection())
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BlobStore(writer=MediaWriter(str(tmp_path)), backend=MemoryBackend(), gc_grace_seconds=60)
+
+
+def age_releases(db, seconds):
+    for doc in db.media_blobs.docs.values():
+        if "released_at" in doc:
+            doc["released_at"] -= timedelta(seconds=seconds)
+
+
+def test_identical_uploads_share_one_counted_blob(store, db):
+    async def run():
+        return await store.put_bytes(db, b"voice", ".m4a"), await store.put_bytes(db, b"voice", ".m4a")
+
+    first, second = asyncio.run(run())
+    assert first.name == second.name
+    assert (first.created, second.created) == (True, False)
+    assert db.media_blobs.docs[first.name]["refcount"] == 2
+    assert list(store.backend.objects) == [store.key_for(first.name)]
+    assert (store.blobs_written, store.dedup_hits) == (1, 1)
+
+
+def test_garbage_collection_waits_for_grace_and_last_reference(store, db):
+    async def run():
+        blob = await store.put_bytes(db, b"photo", ".jpg")
+        url = store.url_for(blob.name)
+        await store.put_bytes(db, b"photo", ".jpg")
+        await store.release(db, url)
+        age_releases(db, 120)
+        # One reference is left
+        assert await store.collect_garbage(db) == 0
+        await store.release(db, url)
+        await store.release(db, url)
+        assert db.media_blobs.docs[blob.name]["refcount"] == 0
+        # Released just now: still inside the grace period
+        assert await store.collect_garbage(db) == 0
+        age_releases(db, 120)
+        assert await store.collect_garbage(db) == 1
+        return blob
+
+    blob = asyncio.run(run())
+    assert blob.name not in db.media_blobs.docs
+    assert store.backend.objects == {}
+    assert store.stats()["blobs_collected"] == 1
+
+
+def test_new_reference_rescues_a_released_blob(store, db):
+    async def run():
+        blob = await store.put_bytes(db, b"chat", ".png")
+        await store.release(db, blob.name)
+        age_releases(db, 120)
+        await store.put_bytes(db, b"chat", ".png")
+        assert await store.collect_garbage(db) == 0
+        return blob
+
+    blob = asyncio.run(run())
+    assert db.media_blobs.docs[blob.name]["refcount"] == 1
+    assert "released_at" not in db.media_blobs.docs[blob.name]
+
+
+def test_migrate_legacy_is_idempotent_after_a_failed_move(store, db, tmp_path):
+    for category, filename in (("voices", "a.wav"), ("chat", "b.wav")):
+        (tmp_path / category).mkdir()
+        (tmp_path / category / filename).write_bytes(b"legacy audio")
+    put_file = store.backend.put_file
+    calls = []
+
+    async def flaky_put(key, source, content_type=None):
+        calls.append(source.name)
+        if len(calls) == 2:
+            raise OSError("disk full")
+        return await put_file(key, source, content_type)
+
+    store.backend.put_file = flaky_put
+    assert asyncio.run(store.migrate_legacy(db)) == 1
+    assert (tmp_path / "chat" / "b.wav").exists()
+
+    store.backend.put_file = put_file
+    assert asyncio.run(store.migrate_legacy(db)) == 1
+    assert asyncio.run(store.migrate_legacy(db)) == 0
+
+    (blob,) = db.media_blobs.docs.values()
+    # One reference per legacy file, however many runs it took
+    assert blob["refcount"] == 2
+    assert {alias["blob"] for alias in db.media_aliases.docs.values()} == {blob["_id"]}
+    assert not any(list((tmp_path / category).iterdir()) for category in ("voices", "chat"))
+
+
+def test_legacy_url_is_released_once(store, db, tmp_path):
+    (tmp_path / "profiles").mkdir()
+    (tmp_path / "profiles" / "me.png").write_bytes(b"avatar")
+
+    async def run():
+        await store.migrate_legacy(db)
+        for _ in range(2):
+            await store.release(db, "https://host/api/uploads/profiles/me.png")
+
+    asyncio.run(run())
+    (blob,) = db.media_blobs.docs.values()
+    assert blob["refcount"] == 0
+    assert asyncio.run(store.resolve(db, "profiles", "me.png")) == ("blobs", blob["_id"])
+
+
+def test_periodic_garbage_collection(store, db):
+    store.gc_interval_seconds = 0.01
+    store.gc_grace_seconds = 0
+    db.media_blobs.docs["old.jpg"] = {
+        "_id": "old.jpg", "refcount": 0, "released_at": datetime.now(timezone.utc) - timedelta(seconds=1),
+    }
+
+    async def run():
+        store.start_gc(db)
+        await asyncio.sleep(0.05)
+        store.stop_gc()
+
+    asyncio.run(run())
+    assert db.media_blobs.docs == {}
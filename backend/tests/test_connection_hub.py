@@ -0,0 +1,111 @@
+import asyncio
+import json
+
+import pytest
+
+pytest.importorskip("starlette")
+
+from app.services import connection_hub as hub_module  # noqa: E402
+from app.services.connection_hub import ConnectionHub, OutboundMessage  # noqa: E402
+
+
+class FakeSocket:
+    def __init__(self, subprotocols=()):
+        self.scope = {"subprotocols": list(subprotocols)}
+        self.sent = []
+        self.closed_with = None
+
+    async def accept(self, subprotocol=None):
+        self.subprotocol = subprotocol
+
+    async def send_text(self, text):
+        self.sent.append(text)
+
+    async def send_bytes(self, data):
+        self.sent.append(data)
+
+    async def close(self, code, reason=""):
+        self.closed_with = code
+
+
+async def drain():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_plain_pong_stays_text_for_json_clients():
+    async def run():
+        hub = ConnectionHub()
+        ws = FakeSocket()
+        connection = hub.register("u1", ws, await hub.accept(ws))
+        connection.send_text("pong")
+        connection.send({"type": "pong"})
+        await drain()
+        await hub.shutdown()
+        return ws
+
+    ws = asyncio.run(run())
+    assert ws.subprotocol is None
+    assert ws.sent == ["pong", '{"type": "pong"}']
+
+
+def test_publish_reaches_every_socket_of_each_user():
+    async def run():
+        hub = ConnectionHub()
+        sockets = [FakeSocket(), FakeSocket(), FakeSocket()]
+        hub.register("u1", sockets[0])
+        hub.register("u1", sockets[1])
+        hub.register("u2", sockets[2])
+        reached = hub.publish(["u1", "u1", "u3"], {"type": "event"})
+        await drain()
+        await hub.shutdown()
+        return hub, reached, sockets
+
+    hub, reached, sockets = asyncio.run(run())
+    assert reached == 2
+    assert [ws.sent for ws in sockets] == [['{"type": "event"}'], ['{"type": "event"}'], []]
+    assert hub.events_delivered == 1
+
+
+def test_slow_consumer_policies():
+    async def run(policy):
+        hub = ConnectionHub(queue_size=2, policy=policy)
+        ws = FakeSocket()
+        connection = hub.register("u1", ws)
+        # Queue faster than the writer task gets to run
+        results = [hub.offer(connection, str(i)) for i in range(3)]
+        await drain()
+        await hub.shutdown()
+        return hub, results, ws
+
+    hub, results, ws = asyncio.run(run("drop"))
+    assert results == [True, True, True]
+    assert hub.messages_dropped == 1
+    assert ws.sent[0] == json.dumps(hub_module.RESYNC_REQUIRED)
+    assert ws.sent[1:] == ["1", "2"]
+
+    hub, results, ws = asyncio.run(run("disconnect"))
+    assert results == [True, True, False]
+    assert hub.slow_disconnects == 1
+    assert ws.closed_with == hub_module.SLOW_CONSUMER_CLOSE_CODE
+    assert not hub.is_connected("u1")
+
+
+def test_msgpack_encoding_is_built_once():
+    msgpack = pytest.importorskip("msgpack")
+    message = OutboundMessage('{"type": "event"}', {"type": "event"})
+    assert message.binary() is message.binary()
+    assert msgpack.unpackb(message.binary()) == {"type": "event"}
+
+    async def run():
+        hub = ConnectionHub()
+        ws = FakeSocket(subprotocols=["msgpack", "json"])
+        connection = hub.register("u1", ws, await hub.accept(ws))
+        connection.send({"type": "pong"})
+        await drain()
+        await hub.shutdown()
+        return ws
+
+    ws = asyncio.run(run())
+    assert ws.subprotocol == "msgpack"
+    assert [msgpack.unpackb(frame) for frame in ws.sent] == [{"type": "pong"}]
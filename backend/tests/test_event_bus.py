@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from app.services.event_bus import RedisEventBus, RespConnection, RespError
+
+
+def read_reply(data: bytes):
+    async def run():
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        return await RespConnection(reader, None).read_reply()
+    return asyncio.run(run())
+
+
+def test_encode_command():
+    assert RespConnection.encode("PUBLISH", "realtime", b"a\r\nb") == (
+        b"*3\r\n$7\r\nPUBLISH\r\n$8\r\nrealtime\r\n$4\r\na\r\nb\r\n"
+    )
+
+
+def test_encode_counts_utf8_bytes():
+    assert RespConnection.encode("ü") == b"*1\r\n$2\r\n\xc3\xbc\r\n"
+
+
+@pytest.mark.parametrize("data, expected", [
+    (b"+OK\r\n", "OK"),
+    (b":42\r\n", 42),
+    (b"$5\r\nhello\r\n", b"hello"),
+    (b"$-1\r\n", None),
+    (b"*-1\r\n", None),
+    (b"$4\r\na\r\nb\r\n", b"a\r\nb"),
+])
+def test_read_simple_replies(data, expected):
+    assert read_reply(data) == expected
+
+
+def test_read_subscription_message():
+    data = b"*3\r\n$7\r\nmessage\r\n$8\r\nrealtime\r\n$3\r\nabc\r\n"
+    assert read_reply(data) == [b"message", b"realtime", b"abc"]
+
+
+def test_read_error_reply():
+    with pytest.raises(RespError, match="ERR unknown command"):
+        read_reply(b"-ERR unknown command\r\n")
+
+
+def test_read_closed_connection():
+    with pytest.raises(ConnectionError):
+        read_reply(b"")
+
+
+def test_pack_round_trip():
+    message = '{"type": "messageReceived", "text": "line one\\nline two"}'
+    data = RedisEventBus.pack("worker-a", ["u1", "u2"], message, "0001-ab-00000001")
+    assert RedisEventBus.unpack(data) == ("worker-a", ["u1", "u2"], message, "0001-ab-00000001")
+
+
+def test_pack_message_with_newlines_and_no_event_id():
+    message = "first\nsecond\nthird"
+    origin, users, unpacked, event_id = RedisEventBus.unpack(RedisEventBus.pack("w", ["u1"], message, None))
+    assert (origin, users, unpacked, event_id) == ("w", ["u1"], message, None)
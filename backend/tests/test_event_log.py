@@ -0,0 +1,186 @@
+import asyncio
+
+from app.services.event_log import EventLog
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, field, direction):
+        self.docs = sorted(self.docs, key=lambda d: d[field], reverse=direction < 0)
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    async def to_list(self, n):
+        return self.docs[:n]
+
+
+class FakeEventLogCollection:
+    def __init__(self):
+        self.docs = []
+
+    async def insert_many(self, docs, ordered=True):
+        self.docs.extend(docs)
+
+    def find(self, query, projection=None):
+        since = query["_id"]["$gte"]
+        return FakeCursor([d for d in self.docs if query["users"] in d["users"] and d["_id"] >= since])
+
+
+class FailingEventLogCollection(FakeEventLogCollection):
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = list(failures)
+
+    async def insert_many(self, docs, ordered=True):
+        if self.failures:
+            raise self.failures.pop(0)
+        await super().insert_many(docs, ordered)
+
+
+class BulkWriteError(Exception):
+    def __init__(self, details):
+        super().__init__("batch op errors occurred")
+        self.details = details
+
+
+class FakeDb:
+    def __init__(self):
+        self.event_log = FakeEventLogCollection()
+
+
+def publish(log: EventLog, user_ids, message):
+    """What the publishing worker does: log durably, then deliver locally"""
+    event_id = log.next_id()
+    log.append(user_ids, event_id, message)
+    log.remember(user_ids, event_id, message)
+    return event_id
+
+
+def make_log(**kwargs) -> EventLog:
+    log = EventLog(**kwargs)
+    log._db = FakeDb()
+    return log
+
+
+def test_ids_sort_in_publish_order():
+    log = make_log()
+    ids = [log.next_id() for _ in range(100)]
+    assert ids == sorted(ids)
+
+
+def test_replay_from_ring_returns_gap_in_order():
+    log = make_log(overlap_ms=0)
+    log.track("u1")
+    first = publish(log, ["u1"], "m1")
+    publish(log, ["u1"], "m2")
+    publish(log, ["u1"], "m3")
+
+    events = asyncio.run(log.replay("u1", first))
+    assert [message for _, message in events] == ["m2", "m3"]
+    assert log.ring_replays == 1
+
+
+def test_replay_falls_back_to_durable_log_when_ring_rolled_over():
+    log = make_log(ring_size=2)
+    log.track("u1")
+    first = publish(log, ["u1"], "m1")
+    for i in range(2, 6):
+        publish(log, ["u1"], f"m{i}")
+    publish(log, ["u2"], "other user")
+
+    events = asyncio.run(log.replay("u1", first))
+    assert [message for _, message in events] == ["m2", "m3", "m4", "m5"]
+    assert [event_id for event_id, _ in events] == sorted(event_id for event_id, _ in events)
+    assert log.durable_replays == 1
+
+
+def test_replay_on_another_worker_uses_durable_log():
+    publisher = make_log()
+    first = publish(publisher, ["u1"], "m1")
+    publish(publisher, ["u1"], "m2")
+    asyncio.run(publisher.flush())
+
+    other = EventLog()
+    other._db = publisher._db
+    events = asyncio.run(other.replay("u1", first))
+    assert [message for _, message in events] == ["m2"]
+
+
+def test_replay_too_long_requires_resync():
+    log = make_log(ring_size=2, max_replay=3)
+    log.track("u1")
+    first = publish(log, ["u1"], "m1")
+    for i in range(5):
+        publish(log, ["u1"], f"m{i}")
+
+    assert asyncio.run(log.replay("u1", first)) is None
+    assert log.resyncs == 1
+
+
+def test_replay_of_unknown_id_requires_resync():
+    log = make_log()
+    assert asyncio.run(log.replay("u1", "not-an-event-id")) is None
+    assert asyncio.run(log.replay("u1", "0000000000001-abcdef01-00000000")) is None
+
+
+def test_replay_includes_other_worker_events_sorting_before_the_last_id():
+    log = make_log()
+    log.track("u1")
+    last = publish(log, ["u1"], "seen")
+    # Same millisecond, but from a worker whose origin sorts first
+    ms = last[:13]
+    other = f"{ms}-00000000-00000000"
+    log.append(["u1"], other, "from another worker")
+    log.remember(["u1"], other, "from another worker")
+    publish(log, ["u1"], "after")
+
+    events = asyncio.run(log.replay("u1", last))
+    assert [message for _, message in events] == ["from another worker", "after"]
+
+
+def test_replay_skips_older_events_of_the_same_worker():
+    log = make_log(ring_size=1)
+    publish(log, ["u1"], "m1")
+    last = publish(log, ["u1"], "m2")
+    publish(log, ["u1"], "m3")
+
+    events = asyncio.run(log.replay("u1", last))
+    assert [message for _, message in events] == ["m3"]
+
+
+def test_failed_flush_is_retried():
+    log = make_log()
+    log._db.event_log = FailingEventLogCollection([ConnectionError("down")])
+    event_id = publish(log, ["u1"], "m1")
+
+    asyncio.run(log.flush())
+    assert log._db.event_log.docs == []
+    assert log.stats()["pending_writes"] == 1
+
+    asyncio.run(log.flush())
+    assert [doc["_id"] for doc in log._db.event_log.docs] == [event_id]
+
+
+def test_partial_bulk_failure_retries_only_unwritten_events():
+    log = make_log()
+    ids = [publish(log, ["u1"], f"m{i}") for i in range(3)]
+    error = BulkWriteError({"writeErrors": [{"index": 0, "code": 11000}, {"index": 2, "code": 91}]})
+    log._db.event_log = FailingEventLogCollection([error])
+
+    asyncio.run(log.flush())
+    assert [doc["_id"] for doc in log._pending] == [ids[2]]
+
+
+def test_retry_backlog_is_bounded():
+    log = make_log(max_pending=2)
+    log._db.event_log = FailingEventLogCollection([ConnectionError("down")])
+    ids = [publish(log, ["u1"], f"m{i}") for i in range(3)]
+
+    asyncio.run(log.flush())
+    assert [doc["_id"] for doc in log._pending] == ids[1:]
+    assert log.dropped_writes == 1
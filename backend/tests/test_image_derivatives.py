@@ -0,0 +1,84 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+from app.services import image_derivatives as derivatives_module  # noqa: E402
+from app.services.image_derivatives import (  # noqa: E402
+    DERIVATIVE_SIZES,
+    ImageDerivativeService,
+    _render,
+    derivative_name,
+)
+from app.services.media_writer import MediaWriter  # noqa: E402
+
+EXIF_ORIENTATION = 0x0112
+
+
+@pytest.fixture
+def writer(tmp_path, monkeypatch):
+    writer = MediaWriter(str(tmp_path))
+    monkeypatch.setattr(derivatives_module, "media_writer", writer)
+    return writer
+
+
+def test_render_resizes_rotates_and_strips_metadata(tmp_path):
+    source = tmp_path / "photo.jpg"
+    exif = Image.Exif()
+    exif[EXIF_ORIENTATION] = 6  # stored sideways, displayed rotated 90 degrees
+    Image.new("RGB", (2000, 1000), (200, 30, 30)).save(source, "JPEG", exif=exif.tobytes())
+
+    written = _render(str(source), {"xs": 96, "md": 1080})
+    assert sorted(written) == ["photo__md.jpg", "photo__md.webp", "photo__xs.jpg", "photo__xs.webp"]
+    with Image.open(tmp_path / "photo__xs.jpg") as small:
+        # Upright and bounded by the longest edge
+        assert small.size == (48, 96)
+        assert EXIF_ORIENTATION not in small.getexif()
+    with Image.open(tmp_path / "photo__md.webp") as medium:
+        assert medium.size == (540, 1080)
+    assert not list(tmp_path.glob(".*.tmp"))
+
+
+def test_render_flattens_transparency_for_jpeg(tmp_path):
+    source = tmp_path / "logo.png"
+    Image.new("RGBA", (50, 50), (0, 0, 0, 0)).save(source)
+
+    _render(str(source), {"xs": 96})
+    with Image.open(tmp_path / "logo__xs.jpg") as jpeg:
+        assert jpeg.mode == "RGB"
+        assert jpeg.getpixel((0, 0)) == (255, 255, 255)
+    with Image.open(tmp_path / "logo__xs.webp") as webp:
+        assert webp.mode == "RGBA"
+
+
+def test_generate_and_pick(writer, monkeypatch):
+    service = ImageDerivativeService()
+    # Same rendering code, without spawning processes in the test
+    service._executor = ThreadPoolExecutor(max_workers=1)
+    name = "ab" * 32 + ".png"
+    source = writer.path_for("blobs", name)
+    source.parent.mkdir(parents=True)
+    Image.new("RGB", (400, 300), (10, 120, 10)).save(source)
+
+    assert service.pick("blobs", name, "sm", "image/webp") is None
+    written = asyncio.run(service.generate("blobs", name))
+    assert len(written) == len(DERIVATIVE_SIZES) * 2
+    assert service.pick("blobs", name, "sm", "image/webp,*/*").name == derivative_name(name, "sm", "webp")
+    assert service.pick("blobs", name, "sm", "*/*").name == derivative_name(name, "sm", "jpg")
+    assert service.pick("blobs", name, "huge", "*/*") is None
+    assert asyncio.run(service.generate("blobs", "notes.wav")) == []
+    service.shutdown()
+
+
+def test_generate_counts_failures(writer):
+    service = ImageDerivativeService()
+    service._executor = ThreadPoolExecutor(max_workers=1)
+    broken = writer.path_for("chat", "broken.jpg")
+    broken.parent.mkdir(parents=True)
+    broken.write_bytes(b"not an image")
+
+    assert asyncio.run(service.generate("chat", "broken.jpg")) == []
+    assert service.stats()["failed"] == 1
+    service.shutdown()
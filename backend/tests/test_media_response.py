@@ -0,0 +1,42 @@
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("aiofiles")
+
+from app.services.media_response import parse_range  # noqa: E402
+
+SIZE = 1000
+
+
+@pytest.mark.parametrize("header, expected", [
+    ("bytes=0-99", (0, 99)),
+    ("bytes=100-", (100, 999)),
+    ("bytes=900-5000", (900, 999)),
+    ("bytes=-100", (900, 999)),
+    ("bytes=-5000", (0, 999)),
+    ("BYTES = 0-0", (0, 0)),
+])
+def test_satisfiable_ranges(header, expected):
+    assert parse_range(header, SIZE) == expected
+
+
+@pytest.mark.parametrize("header", [
+    "items=0-99",
+    "bytes=0-99,200-299",
+    "bytes=abc-",
+    "bytes=5",
+    "bytes=-",
+    "bytes=500-100",
+])
+def test_ignored_ranges_serve_the_whole_file(header):
+    assert parse_range(header, SIZE) is None
+
+
+@pytest.mark.parametrize("header", ["bytes=1000-", "bytes=2000-3000", "bytes=-0"])
+def test_unsatisfiable_ranges(header):
+    with pytest.raises(ValueError):
+        parse_range(header, SIZE)
+
+
+def test_empty_file_ignores_range():
+    assert parse_range("bytes=0-99", 0) is None
@@ -0,0 +1,63 @@
+from datetime import datetime, timezone
+
+import pytest
+
+pytest.importorskip("bson")
+
+from bson import ObjectId  # noqa: E402
+
+from app.services.pagination import (  # noqa: E402
+    decode_cursor, decode_offset_cursor, encode_cursor, encode_offset_cursor, keyset_condition,
+)
+
+SORT = [("server_timestamp", -1), ("_id", -1)]
+
+
+def test_single_key_condition():
+    assert keyset_condition([("created_at", 1)], [5]) == {"created_at": {"$gt": 5}}
+
+
+def test_compound_condition_breaks_ties_on_later_keys():
+    assert keyset_condition(SORT, ["2024-01-02", "m9"]) == {"$or": [
+        {"server_timestamp": {"$lt": "2024-01-02"}},
+        {"server_timestamp": "2024-01-02", "_id": {"$lt": "m9"}},
+    ]}
+
+
+def test_mixed_directions():
+    assert keyset_condition([("a", 1), ("b", -1)], [1, 2]) == {"$or": [
+        {"a": {"$gt": 1}},
+        {"a": 1, "b": {"$lt": 2}},
+    ]}
+
+
+def test_cursor_round_trip_keeps_types():
+    created = datetime(2024, 5, 1, 12, 30, tzinfo=timezone.utc)
+    oid = ObjectId()
+    sort = [("created_at", -1), ("_id", -1)]
+    cursor = encode_cursor({"created_at": created, "_id": oid}, sort)
+
+    assert "=" not in cursor
+    assert decode_cursor(cursor, sort) == [created, oid]
+
+
+def test_cursor_reads_nested_fields():
+    sort = [("stats.score", -1)]
+    assert decode_cursor(encode_cursor({"stats": {"score": 7}}, sort), sort) == [7]
+
+
+@pytest.mark.parametrize("token", ["not base64!", "bm90IGpzb24", encode_cursor({"a": 1}, [("a", 1)])])
+def test_bad_cursor_raises_value_error(token):
+    with pytest.raises(ValueError):
+        decode_cursor(token, SORT)
+
+
+def test_offset_cursor_round_trip():
+    assert decode_offset_cursor(encode_offset_cursor(40)) == 40
+
+
+@pytest.mark.parametrize("offset", [-20, 1.5, "20", True, None])
+def test_offset_cursor_rejects_anything_but_a_non_negative_int(offset):
+    token = encode_cursor({"offset": offset}, [("offset", 1)])
+    with pytest.raises(ValueError):
+        decode_offset_cursor(token)
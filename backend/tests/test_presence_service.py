@@ -0,0 +1,189 @@
+import asyncio
+
+from app.services.presence_service import PresenceService
+
+FRIENDS = {
+    "alice": ["bob", "carol"],
+    "dave": ["bob"],
+}
+
+
+def make_service(**kwargs):
+    sent = []
+
+    async def publish(user_ids, payload):
+        sent.extend((user_id, payload) for user_id in user_ids)
+
+    async def load_friends(user_id):
+        return FRIENDS.get(user_id, [])
+
+    service = PresenceService(**kwargs)
+    service._publish = publish
+    service._load_friends = load_friends
+    return service, sent
+
+
+def test_connect_notifies_friends_once():
+    service, sent = make_service()
+    service.connect("alice")
+    service.connect("alice")
+    asyncio.run(service.flush())
+
+    update = {"type": "presence:update", "user_id": "alice", "online": True}
+    assert sorted(sent, key=lambda s: s[0]) == [("bob", update), ("carol", update)]
+
+
+def test_reconnect_within_grace_period_is_not_published():
+    service, sent = make_service(offline_grace_seconds=60)
+    service.connect("alice")
+    asyncio.run(service.flush())
+    sent.clear()
+
+    service.disconnect("alice")
+    service.connect("alice")
+    asyncio.run(service.flush())
+
+    assert sent == []
+    assert service.suppressed_flaps == 1
+
+
+def test_flap_within_one_flush_nets_to_nothing():
+    service, sent = make_service(offline_grace_seconds=0)
+    service.connect("alice")
+    asyncio.run(service.flush())
+    sent.clear()
+
+    service.disconnect("alice")
+    service._expire(float("inf"))
+    service.connect("alice")
+    asyncio.run(service.flush())
+
+    assert sent == []
+    assert service.is_online("alice")
+
+
+def test_offline_after_grace_period():
+    service, sent = make_service(offline_grace_seconds=0)
+    service.connect("alice")
+    asyncio.run(service.flush())
+    sent.clear()
+
+    service.disconnect("alice")
+    asyncio.run(service.flush())
+
+    assert not service.is_online("alice")
+    assert ("bob", {"type": "presence:update", "user_id": "alice", "online": False}) in sent
+
+
+def test_several_changes_are_batched_into_one_diff():
+    service, sent = make_service()
+    service.connect("alice")
+    service.connect("dave")
+    asyncio.run(service.flush())
+
+    to_bob = [payload for user_id, payload in sent if user_id == "bob"]
+    assert to_bob == [{"type": "presence:diff", "online": {"alice": True, "dave": True}}]
+
+
+def test_friend_list_is_cached_until_invalidated():
+    service, _ = make_service()
+    asyncio.run(service.friends_of("alice"))
+    asyncio.run(service.friends_of("alice"))
+    assert (service.friend_cache_misses, service.friend_cache_hits) == (1, 1)
+
+    service.invalidate_friends("alice")
+    asyncio.run(service.friends_of("alice"))
+    assert service.friend_cache_misses == 2
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    async def to_list(self, n):
+        return self.docs
+
+
+class FakePresenceSockets:
+    """The subset of the shared presence_sockets collection the service uses"""
+
+    def __init__(self):
+        self.docs = {}
+
+    async def update_one(self, query, update, upsert=False):
+        self.docs.setdefault(query["_id"], {"_id": query["_id"]}).update(update["$set"])
+
+    async def update_many(self, query, update):
+        for doc in self.docs.values():
+            if doc["worker"] == query["worker"]:
+                doc.update(update["$set"])
+
+    async def delete_many(self, query):
+        if "_id" in query:
+            doomed = set(query["_id"]["$in"])
+        else:
+            doomed = {key for key, doc in self.docs.items() if doc["worker"] == query["worker"]}
+        for key in doomed:
+            self.docs.pop(key, None)
+
+    def find(self, query, projection=None):
+        return FakeCursor([
+            doc for doc in self.docs.values()
+            if doc["user_id"] in query["user_id"]["$in"]
+            and doc["worker"] != query["worker"]["$ne"]
+            and doc["updated_at"] >= query["updated_at"]["$gte"]
+        ])
+
+
+class FakeDb:
+    def __init__(self):
+        self.presence_sockets = FakePresenceSockets()
+
+
+def make_workers(count):
+    db = FakeDb()
+    workers = []
+    for _ in range(count):
+        service, sent = make_service(offline_grace_seconds=0)
+        service._db = db
+        workers.append((service, sent))
+    return db, workers
+
+
+def test_disconnect_on_one_worker_keeps_user_online_elsewhere():
+    db, [(a, sent_a), (b, sent_b)] = make_workers(2)
+    a.connect("alice")
+    b.connect("alice")
+    asyncio.run(a.flush())
+    asyncio.run(b.flush())
+    sent_a.clear()
+    sent_b.clear()
+
+    a.disconnect("alice")
+    asyncio.run(a.flush())
+    assert sent_a == []
+    assert a.held_elsewhere == 1
+    assert asyncio.run(a.online_map(["alice"])) == {"alice": True}
+
+    b.disconnect("alice")
+    asyncio.run(b.flush())
+    assert ("bob", {"type": "presence:update", "user_id": "alice", "online": False}) in sent_b
+    assert db.presence_sockets.docs == {}
+
+
+def test_online_map_sees_users_on_other_workers():
+    _, [(a, _), (b, _)] = make_workers(2)
+    b.connect("dave")
+    asyncio.run(b.flush())
+
+    assert asyncio.run(a.online_map(["dave", "carol"])) == {"dave": True, "carol": False}
+    assert not a.is_online("dave")
+
+
+def test_stopped_worker_no_longer_counts():
+    _, [(a, _), (b, _)] = make_workers(2)
+    b.connect("dave")
+    asyncio.run(b.flush())
+    asyncio.run(b.stop())
+
+    assert asyncio.run(a.online_map(["dave"])) == {"dave": False}
@@ -0,0 +1,128 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from app.services import storage_backends
+from app.services.blob_store import BlobStore
+from app.services.media_writer import MediaWriter
+from app.services.storage_backends import LocalStorageBackend, StorageBackend
+
+SHA = "ab" * 32
+
+
+class MemoryBackend(StorageBackend):
+    name = "memory"
+    supports_presign = True
+
+    def __init__(self):
+        self.objects = {}
+
+    async def put_file(self, key, source, content_type=None):
+        try:
+            if key in self.objects:
+                return False
+            self.objects[key] = source.read_bytes()
+            return True
+        finally:
+            source.unlink(missing_ok=True)
+
+    async def get_file(self, key, dest):
+        if key not in self.objects:
+            return False
+        dest.write_bytes(self.objects[key])
+        return True
+
+    async def size(self, key):
+        data = self.objects.get(key)
+        return None if data is None else len(data)
+
+    async def delete(self, key):
+        self.objects.pop(key, None)
+
+
+class FakeBlobs:
+    def __init__(self):
+        self.docs = {}
+
+    async def update_one(self, query, update, upsert=False):
+        doc = self.docs.get(query["_id"])
+        inserted = doc is None
+        if inserted:
+            doc = self.docs[query["_id"]] = {"_id": query["_id"], **update.get("$setOnInsert", {})}
+        for field, amount in update.get("$inc", {}).items():
+            doc[field] = doc.get(field, 0) + amount
+        return SimpleNamespace(upserted_id=query["_id"] if inserted else None)
+
+    async def find_one(self, query, projection=None):
+        doc = self.docs.get(query["_id"])
+        if doc and doc.get("refcount", 0) > query["refcount"]["$gt"]:
+            return doc
+        return None
+
+
+def test_backend_interface_is_abstract():
+    with pytest.raises(TypeError):
+        StorageBackend()
+
+    class Partial(StorageBackend):
+        async def size(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Partial()
+
+
+def test_local_backend_round_trip(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_backends, "media_writer", MediaWriter(str(tmp_path)))
+    backend = LocalStorageBackend()
+    key = f"blobs/{SHA}.jpg"
+    first, second = tmp_path / "first", tmp_path / "second"
+    first.write_bytes(b"image")
+    second.write_bytes(b"image")
+
+    async def run():
+        assert await backend.put_file(key, first) is True
+        # The same key again keeps the stored object and drops the source
+        assert await backend.put_file(key, second) is False
+        assert not second.exists()
+        assert await backend.size(key) == 5
+        assert await backend.get_file(key, tmp_path / "copy") is True
+        assert (tmp_path / "copy").read_bytes() == b"image"
+        await backend.delete(key)
+        assert await backend.get_file(key, tmp_path / "missing") is False
+        assert await backend.size(key) is None
+        await backend.delete(key)
+
+    asyncio.run(run())
+    assert backend.path_for(key) == tmp_path / "blobs" / "ab" / f"{SHA}.jpg"
+
+
+def test_direct_upload_counts_dedup_hits():
+    backend = MemoryBackend()
+    backend.objects[f"blobs/ab/{SHA}.jpg"] = b"image"
+    store = BlobStore(backend=backend)
+    db = SimpleNamespace(media_blobs=FakeBlobs())
+
+    async def run():
+        return [await store.register_direct_upload(db, SHA, ".jpg") for _ in range(2)]
+
+    first, second = asyncio.run(run())
+    assert (first.created, second.created) == (True, False)
+    assert (store.blobs_written, store.dedup_hits) == (1, 1)
+    assert db.media_blobs.docs[f"{SHA}.jpg"]["refcount"] == 2
+
+
+def test_direct_upload_missing_or_too_large():
+    backend = MemoryBackend()
+    backend.objects[f"blobs/ab/{SHA}.png"] = b"x" * 10
+    store = BlobStore(backend=backend)
+    db = SimpleNamespace(media_blobs=FakeBlobs())
+
+    with pytest.raises(ValueError, match="not found"):
+        asyncio.run(store.register_direct_upload(db, SHA, ".jpg"))
+    with pytest.raises(ValueError, match="exceeds"):
+        asyncio.run(store.register_direct_upload(db, SHA, ".png", max_bytes=4))
+    # Nobody else referenced the oversized object, so it is gone
+    assert backend.objects == {}
+    assert store.blobs_written == 0
@@ -0,0 +1,167 @@
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+pymongo_errors = pytest.importorskip("pymongo.errors")
+
+from app.services.timeline_service import TimelineService  # noqa: E402
+
+
+def matches(doc, query):
+    for field, condition in query.items():
+        if field == "$or":
+            if not any(matches(doc, branch) for branch in condition):
+                return False
+            continue
+        value = doc.get(field)
+        if isinstance(condition, dict):
+            if "$in" in condition and value not in condition["$in"]:
+                return False
+            if "$ne" in condition and value == condition["$ne"]:
+                return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, docs):
+        self.docs = docs
+
+    def sort(self, keys, direction=None):
+        if isinstance(keys, str):
+            keys = [(keys, direction)]
+        for field, order in reversed(keys):
+            self.docs.sort(key=lambda doc: str(doc.get(field) or ""), reverse=order == -1)
+        return self
+
+    def skip(self, n):
+        self.docs = self.docs[n:]
+        return self
+
+    def limit(self, n):
+        self.docs = self.docs[:n]
+        return self
+
+    async def to_list(self, n):
+        return [dict(doc) for doc in (self.docs if n is None else self.docs[:n])]
+
+
+class FakeCollection:
+    def __init__(self, docs=()):
+        self.docs = {doc["_id"]: dict(doc) for doc in docs}
+
+    def find(self, query, projection=None):
+        return FakeCursor([doc for doc in self.docs.values() if matches(doc, query)])
+
+    async def insert_many(self, docs, ordered=True):
+        errors = []
+        for doc in docs:
+            if doc["_id"] in self.docs:
+                errors.append({"code": 11000, "op": doc})
+            else:
+                self.docs[doc["_id"]] = dict(doc)
+        if errors:
+            raise pymongo_errors.BulkWriteError({"writeErrors": errors})
+
+    async def delete_many(self, query):
+        doomed = [key for key, doc in self.docs.items() if matches(doc, query)]
+        for key in doomed:
+            del self.docs[key]
+        return SimpleNamespace(deleted_count=len(doomed))
+
+    async def update_one(self, query, update):
+        self.docs[query["_id"]].update(update["$set"])
+
+
+def post(post_id, author_id, visibility="friends", minute=0, **extra):
+    return {"_id": post_id, "author_id": author_id, "visibility": visibility,
+            "created_at": f"2026-01-01T00:{minute:02d}:00", **extra}
+
+
+def make_db(posts=(), users=()):
+    return SimpleNamespace(timelines=FakeCollection(), posts=FakeCollection(posts), users=FakeCollection(users))
+
+
+def owners(db, post_id):
+    return sorted(entry["user_id"] for entry in db.timelines.docs.values() if entry["post_id"] == post_id)
+
+
+def test_fan_out_reaches_friends_but_not_private_or_pull_posts():
+    service = TimelineService(batch_size=2, trim_sample_rate=0)
+    db = make_db()
+
+    async def run():
+        assert await service.fan_out(db, post("p1", "a"), ["a", "b", "c", "d"]) == 3
+        # Re-delivery is harmless
+        assert await service.fan_out(db, post("p1", "a"), ["b"]) == 1
+        assert await service.fan_out(db, post("p2", "a", visibility="private"), ["b"]) == 0
+        assert await service.fan_out(db, post("p3", "a", fanout="pull"), ["b"]) == 0
+
+    asyncio.run(run())
+    assert owners(db, "p1") == ["b", "c", "d"]
+    assert owners(db, "p2") == owners(db, "p3") == []
+
+
+def test_visibility_change_adds_and_withdraws_entries():
+    service = TimelineService(trim_sample_rate=0)
+    db = make_db()
+    shared = post("p1", "a")
+
+    async def run():
+        await service.add_for_author(db, shared)
+        await service.fan_out(db, shared, ["b", "c"])
+        hidden = dict(shared, visibility="private")
+        assert await service.visibility_changed(db, hidden, "friends", ["b", "c"]) == 2
+        assert owners(db, "p1") == ["a"]
+        assert await service.visibility_changed(db, shared, "private", ["b", "c"]) == 2
+        assert await service.visibility_changed(db, dict(shared, visibility="public"), "friends", ["b"]) == 0
+
+    asyncio.run(run())
+    assert owners(db, "p1") == ["a", "b", "c"]
+
+
+def test_trim_keeps_newest_entries():
+    service = TimelineService(max_entries=2, trim_sample_rate=1)
+    db = make_db()
+
+    async def run():
+        for minute in range(4):
+            await service.add_for_author(db, post(f"p{minute}", "a", minute=minute))
+
+    asyncio.run(run())
+    assert sorted(entry["post_id"] for entry in db.timelines.docs.values()) == ["p2", "p3"]
+
+
+def test_read_feed_tops_up_pages_with_hidden_posts():
+    service = TimelineService(trim_sample_rate=0)
+    posts = [post(f"old{i}", "b", minute=i) for i in range(3)]
+    # Newer entries whose posts were made private or deleted since the fan-out
+    posts += [post(f"hidden{i}", "b", visibility="private", minute=10 + i) for i in range(3)]
+    db = make_db(posts, users=[{"_id": "a", "friends": ["b"]}])
+    user = {"_id": "a", "friends": ["b"], "timeline_built": True}
+
+    async def run():
+        for item in posts:
+            await service.fan_out(db, dict(item, visibility="friends"), ["a"])
+        await service.fan_out(db, post("gone", "b", minute=20), ["a"])
+        return await service.read_feed(db, user, limit=2)
+
+    feed = asyncio.run(run())
+    assert [item["_id"] for item in feed] == ["old2", "old1"]
+
+
+def test_read_feed_builds_timeline_and_merges_public_posts():
+    service = TimelineService(trim_sample_rate=0)
+    posts = [
+        post("mine", "a", visibility="private", minute=1),
+        post("friend", "b", minute=2),
+        post("stranger-public", "z", visibility="public", minute=3),
+        post("stranger-friends", "z", minute=4),
+    ]
+    db = make_db(posts, users=[{"_id": "a", "friends": ["b"]}])
+
+    feed = asyncio.run(service.read_feed(db, {"_id": "a", "friends": ["b"]}, limit=10))
+    assert [item["_id"] for item in feed] == ["stranger-public", "friend", "mine"]
+    assert db.users.docs["a"]["timeline_built"] is True
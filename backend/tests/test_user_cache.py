@@ -0,0 +1,45 @@
+from app.services import user_cache as cache_module
+from app.services.user_cache import UserCache
+
+
+def test_invalidate_forces_a_reload():
+    cache = UserCache()
+    cache.set("u1", {"_id": "u1", "name": "Old"})
+    assert cache.get("u1") == {"_id": "u1", "name": "Old"}
+
+    cache.invalidate("u1", "never-cached")
+    assert cache.get("u1") is None
+    assert cache.invalidations == 1
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_entries_are_copies():
+    cache = UserCache()
+    user = {"_id": "u1", "name": "Ada"}
+    cache.set("u1", user)
+    user["name"] = "changed by the caller"
+    cache.get("u1")["name"] = "changed by a handler"
+    assert cache.get("u1")["name"] == "Ada"
+
+
+def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache_module.time, "monotonic", lambda: now[0])
+    cache = UserCache(ttl_seconds=30)
+    cache.set("u1", {"_id": "u1"})
+    now[0] += 29
+    assert cache.get("u1") is not None
+    now[0] += 2
+    assert cache.get("u1") is None
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_is_evicted():
+    cache = UserCache(max_entries=2)
+    cache.set("a", {"_id": "a"})
+    cache.set("b", {"_id": "b"})
+    cache.get("a")
+    cache.set("c", {"_id": "c"})
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.evictions == 1
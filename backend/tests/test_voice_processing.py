@@ -0,0 +1,138 @@
+import asyncio
+import io
+import wave
+from types import SimpleNamespace
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from app.services import voice_processing as voice_module  # noqa: E402
+from app.services.blob_store import BlobRef, BlobStore  # noqa: E402
+from app.services.voice_processing import VoiceProcessingService, compute_peaks  # noqa: E402
+
+from test_storage_backends import MemoryBackend  # noqa: E402
+
+SHA = "cd" * 32
+
+
+def wav_bytes(seconds: float, rate: int = 8000) -> bytes:
+    samples = (np.sin(np.linspace(0, 200, int(seconds * rate))) * 20000).astype(np.int16)
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(samples.tobytes())
+    return buffer.getvalue()
+
+
+class FakeMessages:
+    def __init__(self, docs):
+        self.docs = {doc["_id"]: dict(doc) for doc in docs}
+
+    def find(self, query, projection=None):
+        async def cursor():
+            for doc in list(self.docs.values()):
+                if doc.get("type") == "voice" and "processed_at" not in doc:
+                    yield dict(doc)
+        return cursor()
+
+    async def update_one(self, query, update):
+        doc = self.docs[query["_id"]]
+        if "processed_at" in query and "processed_at" in doc:
+            return SimpleNamespace(modified_count=0)
+        if "$or" in query and "processing_claimed_at" in doc:
+            return SimpleNamespace(modified_count=0)
+        doc.update(update["$set"])
+        return SimpleNamespace(modified_count=1)
+
+
+class FakeAliases:
+    def __init__(self, aliases):
+        self.aliases = aliases
+
+    async def find_one(self, query, projection=None):
+        blob = self.aliases.get(query["_id"])
+        return {"blob": blob} if blob else None
+
+
+@pytest.fixture
+def remote_store(monkeypatch):
+    """A blob store backed by a non-local backend, as with S3"""
+    store = BlobStore(backend=MemoryBackend())
+    released = []
+
+    async def release(db, url):
+        released.append(url)
+
+    monkeypatch.setattr(store, "release", release)
+    monkeypatch.setattr(voice_module, "blob_store", store)
+    store.released = released
+    return store
+
+
+def test_compute_peaks_normalizes_per_bucket():
+    samples = np.array([0, 1, -4, 2, 0, 0, 8, -2], dtype=np.int16)
+    assert compute_peaks(samples, buckets=4) == [0.125, 0.5, 0.0, 1.0]
+    assert compute_peaks(np.array([], dtype=np.int16), buckets=3) == [0.0, 0.0, 0.0]
+
+
+def test_duration_tolerance():
+    assert VoiceProcessingService.duration_matches(10_300, 10_000)
+    assert not VoiceProcessingService.duration_matches(12_000, 10_000)
+    assert not VoiceProcessingService.duration_matches(None, 10_000)
+
+
+def test_process_downloads_remote_audio(remote_store):
+    remote_store.backend.objects[f"blobs/cd/{SHA}.wav"] = wav_bytes(2.0)
+    service = VoiceProcessingService(ffmpeg_path="")
+    service.ffmpeg = None
+    db = SimpleNamespace(messages=FakeMessages([{"_id": "m1", "type": "voice"}]))
+    message = {"_id": "m1", "voice_url": f"/uploads/blobs/{SHA}.wav", "duration_ms": 9000}
+
+    updates = asyncio.run(service.process(db, message))
+    assert updates["duration_ms"] == 2000
+    assert updates["reported_duration_ms"] == 9000
+    assert len(updates["waveform"]) == 64
+    assert db.messages.docs["m1"]["waveform"] == updates["waveform"]
+
+
+def test_backfill_transcodes_legacy_notes_once(remote_store, monkeypatch):
+    remote_store.backend.objects[f"blobs/cd/{SHA}.wav"] = wav_bytes(1.0)
+    service = VoiceProcessingService(ffmpeg_path="/usr/bin/ffmpeg")
+    transcoded = []
+
+    async def transcode(db, path):
+        transcoded.append(path.read_bytes()[:4])
+        return BlobRef(sha256="ef" * 32, name=f"{'ef' * 32}.m4a", size=10, created=True)
+
+    monkeypatch.setattr(service, "transcode", transcode)
+    db = SimpleNamespace(
+        messages=FakeMessages([
+            {"_id": "legacy", "type": "voice", "voice_url": "/uploads/voices/old.wav", "duration_ms": 1000},
+            {"_id": "missing", "type": "voice", "voice_url": "/uploads/voices/gone.wav"},
+            {"_id": "done", "type": "voice", "voice_url": "/uploads/blobs/x.m4a", "processed_at": "earlier"},
+            {"_id": "text", "type": "text"},
+        ]),
+        media_aliases=FakeAliases({"voices/old.wav": f"{SHA}.wav"}),
+    )
+
+    assert asyncio.run(service.backfill(db)) == 2
+    legacy = db.messages.docs["legacy"]
+    assert legacy["voice_url"] == f"/uploads/blobs/{'ef' * 32}.m4a"
+    assert legacy["original_voice_url"] == "/uploads/voices/old.wav"
+    assert transcoded == [b"RIFF"]
+    assert remote_store.released == ["/uploads/voices/old.wav"]
+    assert db.messages.docs["missing"]["processing_error"] is True
+    assert db.messages.docs["done"]["processed_at"] == "earlier"
+
+    # A second run finds nothing left to do
+    assert asyncio.run(service.backfill(db)) == 0
+    assert len(transcoded) == 1
+
+
+def test_backfill_needs_ffmpeg():
+    service = VoiceProcessingService(ffmpeg_path="")
+    service.ffmpeg = None
+    assert asyncio.run(service.backfill(SimpleNamespace())) == 0
@@ -49,6 +49,11 @@ export function RuntimeConfigProvider({ children, token }: { children: React.Rea
     let pollingTimer: NodeJS.Timeout | null = null;
     let reconnectAttempts = 0;
     const maxReconnectAttempts = 5;
+    // Sent on reconnect so the server replays what was missed; replays can
+    // repeat a few events, which are dropped by id
+    let lastEventId: string | null = null;
+    const seenEventIds = new Set<string>();
+    const maxSeenEventIds = 500;
 
     const handleTokenUpdated = async (event: any) => {
       console.log('🔄 WebSocket: Token updated, reconnecting...');
@@ -163,7 +168,8 @@ export function RuntimeConfigProvider({ children, token }: { children: React.Rea
         console.log('🔍 Token ends with:', cleanToken.substring(cleanToken.length - 10));
         
         // Don't encode the token - pass it directly
-        const wsUrl = `${process.env.EXPO_PUBLIC_BACKEND_URL?.replace('http', 'ws')}/api/ws?token=${cleanToken}`;
+        const replayParam = lastEventId ? `&last_event_id=${encodeURIComponent(lastEventId)}` : '';
+        const wsUrl = `${process.env.EXPO_PUBLIC_BACKEND_URL?.replace('http', 'ws')}/api/ws?token=${cleanToken}${replayParam}`;
         console.log('🔌 RuntimeConfig: Connecting WebSocket with clean URL');
         
         ws = new WebSocket(wsUrl);
@@ -192,6 +198,18 @@ export function RuntimeConfigProvider({ children, token }: { children: React.Rea
               return;
             }
             
+            if (data.event_id) {
+              if (seenEventIds.has(data.event_id)) {
+                return;
+              }
+              seenEventIds.add(data.event_id);
+              if (seenEventIds.size > maxSeenEventIds) {
+                // Sets iterate in insertion order: forget the oldest
+                seenEventIds.delete(seenEventIds.values().next().value as string);
+              }
+              lastEventId = data.event_id;
+            }
+            
             if (data.type === 'connectionEstablished') {
               console.log('✅ RuntimeConfig: WebSocket connection established');
               setWsEnabled(true);